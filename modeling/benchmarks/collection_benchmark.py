@@ -0,0 +1,333 @@
+"""
+Benchmark of the collection pipeline with synthetic weld images.
+
+Times each stage (preprocess, augment, split, stream) and the task chain of initial_dataset_flow
+(without Prefect or network) at several dataset sizes and resolutions, and reports images/sec,
+peak RSS and bytes written. The results are saved as JSON and can be compared with a previous run.
+
+Usage (from the modeling folder):
+    python -m benchmarks.collection_benchmark --scales 1000 10000 --resolutions 640x480 1280x960
+    python -m benchmarks.collection_benchmark --baseline benchmarks/results/collection_<...>.json
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from benchmarks.harness import (
+    RESULTS_PATH,
+    compare_results,
+    folder_size,
+    measure,
+    print_table,
+    save_results,
+)
+from flows import collection_pipeline
+from options import (
+    AUGMENTED_PATH,
+    CLASS_NAMES,
+    COLLECTION_MODE,
+    INITIAL_PATH,
+    PROCESSED_PATH,
+    RAW_PATH,
+)
+from service.image_transformations import (
+    augment_images,
+    preprocess_images,
+    split_images,
+    stream_images,
+)
+
+DATA_PATH = "benchmarks/data"  # Generated datasets, reused by later runs
+STAGES = ["preprocess", "augment", "split", "stream", "chain"]
+GENERATION_CHUNK_SIZE = 256
+
+
+def weld_image(rng, width, height):
+    """
+    Generates an RGB image that looks like a weld: a brushed metal plate crossed by a rippled bead,
+    with some spatters.
+    """
+    y = np.linspace(-1, 1, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    plate = 80 + 50 * x + rng.normal(0, 10, (height, 1)).astype(np.float32)
+    plate = plate + rng.normal(0, 6, (height, width)).astype(np.float32)
+    center = rng.uniform(-0.4, 0.4) + 0.1 * np.sin(x * rng.uniform(3, 12))
+    bead = np.exp(-(((y - center) / rng.uniform(0.06, 0.2)) ** 2))
+    ripples = 0.5 + 0.5 * np.sin(x * rng.uniform(80, 200))
+    gray = plate + bead * (60 + 50 * ripples)
+    spatters = rng.integers(0, 40)
+    gray[rng.integers(0, height, spatters), rng.integers(0, width, spatters)] = 255
+    tint = np.array([1.0, 0.93, 0.82], dtype=np.float32)
+    return np.clip(gray[..., None] * tint, 0, 255).astype(np.uint8)
+
+
+def weld_labels(rng):
+    """
+    Gets random labels with one or two classes, formatted as in the file names.
+    """
+    labels = np.zeros(len(CLASS_NAMES), dtype=int)
+    labels[rng.choice(len(CLASS_NAMES), rng.integers(1, 3), replace=False)] = 1
+    return "_".join(map(str, labels))
+
+
+def _generate_chunk(folder, start, stop, width, height, seed):
+    rng = np.random.default_rng([seed, start])
+    for i in range(start, stop):
+        image = Image.fromarray(weld_image(rng, width, height))
+        image.save(os.path.join(folder, f"{i}_{weld_labels(rng)}.jpg"), quality=90)
+    return stop - start
+
+
+def generate_dataset(count, width, height, seed=0, path=DATA_PATH):
+    """
+    Generates a folder of synthetic raw images named as <id>_<class1>_..._<class7>.jpg.
+    The folder is reused if it was already generated with the same parameters.
+
+    Returns:
+        str: The folder of the images.
+    """
+    folder = os.path.join(path, f"{count}_{width}x{height}_{seed}")
+    if os.path.isfile(f"{folder}.complete"):
+        return folder
+    shutil.rmtree(folder, ignore_errors=True)
+    os.makedirs(folder)
+    print(f"Generating {count} images of {width}x{height}...")
+    with ProcessPoolExecutor() as executor:
+        chunks = range(0, count, GENERATION_CHUNK_SIZE)
+        futures = [
+            executor.submit(
+                _generate_chunk,
+                folder,
+                start,
+                min(start + GENERATION_CHUNK_SIZE, count),
+                width,
+                height,
+                seed,
+            )
+            for start in chunks
+        ]
+        for future in futures:
+            future.result()
+    open(f"{folder}.complete", "w").close()  # Marks the folder as fully generated
+    return folder
+
+
+def link_folder(source, destination):
+    """
+    Hard links the images of a folder into another one, so the stages can delete them.
+    """
+    os.makedirs(destination, exist_ok=True)
+    for name in os.listdir(source):
+        if name.endswith(".jpg"):
+            os.link(os.path.join(source, name), os.path.join(destination, name))
+
+
+def disk_write_bytes():
+    """
+    Gets the bytes written to disk by this process so far (Linux only, otherwise None).
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            for line in f:
+                if line.startswith("write_bytes:"):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def run_stage(stage, dataset, work, augments, workers):
+    """
+    Runs a stage in the work folder. The stages run in order, each one reading the previous output.
+
+    Returns:
+        int: The number of images the stage read.
+    """
+    processed = os.path.join(work, "processed")
+    augmented = os.path.join(work, "augmented")
+    os.makedirs(processed, exist_ok=True)
+    os.makedirs(augmented, exist_ok=True)
+    if stage == "preprocess":
+        preprocess_images(dataset, processed, workers=workers, cache_size=0)
+        return len(os.listdir(dataset))
+    if stage == "augment":
+        augment_images(augments, processed, augmented)
+        return len(os.listdir(processed))
+    if stage == "split":
+        return split_images(os.path.join(work, "splits"), source=augmented)
+    if stage == "stream":
+        stream_images(os.path.join(work, "stream"), augments, dataset, cache_size=0)
+        return len(os.listdir(dataset))
+    if stage == "chain":
+        return run_chain(dataset, os.path.join(work, "chain"), augments)
+    raise ValueError(f"Unknown stage {stage}")
+
+
+def run_chain(dataset, work, augments):
+    """
+    Runs the stages of initial_dataset_flow after the download (without Prefect, so the shards run
+    one after another) in a work folder.
+    """
+    os.makedirs(work, exist_ok=True)
+    os.chdir(work)  # The tasks use the relative data folders
+    for path in [PROCESSED_PATH, AUGMENTED_PATH, INITIAL_PATH]:
+        os.makedirs(path, exist_ok=True)
+    link_folder(dataset, RAW_PATH)
+    count = len(os.listdir(RAW_PATH))
+    if COLLECTION_MODE == "streaming":
+        collection_pipeline.stream_files(augments)
+    else:
+        collection_pipeline.preprocess_files()
+        collection_pipeline.augment_files(augments)
+        collection_pipeline.split_files()
+    return count
+
+
+def stage_output(stage, work):
+    return os.path.join(
+        work,
+        {
+            "preprocess": "processed",
+            "augment": "augmented",
+            "split": "splits",
+            "stream": "stream",
+            "chain": os.path.join("chain", INITIAL_PATH),
+        }[stage],
+    )
+
+
+def _measured_stage(stage, dataset, work, augments, workers):
+    before = disk_write_bytes()
+    images = run_stage(stage, dataset, work, augments, workers)
+    after = disk_write_bytes()
+    return images, None if before is None else after - before
+
+
+def benchmark(
+    scales,
+    resolutions,
+    stages=STAGES,
+    augments=1,
+    workers=1,
+    seed=0,
+    data_path=DATA_PATH,
+):
+    """
+    Runs the stages for every scale and resolution.
+    The peak RSS includes the memory of the benchmark itself, which is the same for every stage.
+
+    Returns:
+        list: The results of each stage, scale and resolution.
+    """
+    results = []
+    for count in scales:
+        for width, height in resolutions:
+            dataset = os.path.abspath(
+                generate_dataset(count, width, height, seed, data_path)
+            )
+            work = tempfile.mkdtemp(prefix="collection_benchmark_")
+            try:
+                for stage in stages:
+                    m = measure(
+                        _measured_stage, stage, dataset, work, augments, workers
+                    )
+                    images, disk_bytes = m["result"]
+                    results.append(
+                        {
+                            "stage": stage,
+                            "scale": count,
+                            "resolution": f"{width}x{height}",
+                            "images": images,
+                            "seconds": round(m["seconds"], 3),
+                            "cpu_seconds": round(m["cpu_seconds"], 3),
+                            "images_per_second": round(images / m["seconds"], 2),
+                            "peak_rss_mb": round(m["peak_rss_mb"], 1),
+                            "bytes_written": folder_size(stage_output(stage, work)),
+                            "disk_write_bytes": disk_bytes,
+                        }
+                    )
+                    print(
+                        f"{stage} ({count} images of {width}x{height}): "
+                        f"{results[-1]['images_per_second']} images/sec"
+                    )
+            finally:
+                shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def parse_resolution(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--scales", type=int, nargs="+", default=[1000])
+    parser.add_argument(
+        "--resolutions", type=parse_resolution, nargs="+", default=[(640, 480)]
+    )
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--augments", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Allowed drop of images/sec compared with the baseline (0.1 = 10%%)",
+    )
+    args = parser.parse_args(args)
+
+    results = benchmark(
+        args.scales,
+        args.resolutions,
+        args.stages,
+        args.augments,
+        args.workers,
+        args.seed,
+    )
+    print_table(
+        results,
+        [
+            "stage",
+            "scale",
+            "resolution",
+            "images_per_second",
+            "peak_rss_mb",
+            "bytes_written",
+        ],
+    )
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ["output", "baseline"]
+    }
+    print(
+        f"Results saved to {save_results('collection', results, config, args.output)}"
+    )
+    if args.baseline:
+        regressions = compare_results(
+            results,
+            args.baseline,
+            ["stage", "scale", "resolution"],
+            "images_per_second",
+            args.threshold,
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+Helpers shared by the benchmarks: isolated measurements, JSON results and regression checks.
+"""
+
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import time
+import traceback
+from datetime import datetime
+
+import numpy as np
+
+RESULTS_PATH = "benchmarks/results"
+
+
+def folder_size(path):
+    """
+    Gets the total size in bytes of the files inside a folder (recursively).
+    """
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.path.getsize(os.path.join(root, name))
+            except FileNotFoundError:  # Removed while walking
+                pass
+    return size
+
+
+def peak_rss_mb():
+    """
+    Gets the peak resident memory of the process and its finished children in MB (Linux reports KB).
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def _run_measured(function, args, connection):
+    try:
+        start = time.perf_counter()
+        cpu_start = time.process_time()
+        result = function(*args)
+        connection.send(
+            {
+                "seconds": time.perf_counter() - start,
+                "cpu_seconds": time.process_time() - cpu_start,
+                "peak_rss_mb": peak_rss_mb(),
+                "result": result,
+            }
+        )
+    except Exception:
+        connection.send({"error": traceback.format_exc()})
+    finally:
+        connection.close()
+
+
+def measure(function, *args, start_method="fork"):
+    """
+    Runs a function in a new process, so its peak memory is not mixed with the other measurements.
+    Use start_method="spawn" to measure a cold start (e.g., nothing imported yet, as a new service).
+
+    Returns:
+        dict: The wall and CPU seconds, the peak RSS in MB and the result of the function.
+    """
+    context = multiprocessing.get_context(start_method)
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_measured, args=(function, args, sender))
+    process.start()
+    sender.close()
+    try:
+        measurement = receiver.recv()
+    except EOFError:
+        measurement = {"error": f"The benchmark process died ({process.exitcode})."}
+    process.join()
+    if "error" in measurement:
+        raise RuntimeError(measurement["error"])
+    return measurement
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(name, results, config, path=RESULTS_PATH):
+    """
+    Saves the results of a benchmark as <path>/<name>_<timestamp>.json.
+
+    Returns:
+        str: The path of the results file.
+    """
+    os.makedirs(path, exist_ok=True)
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    file_path = os.path.join(path, f"{name}_{timestamp}.json")
+    report = {
+        "benchmark": name,
+        "timestamp": timestamp,
+        "commit": git_commit(),
+        "machine": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "config": config,
+        "results": results,
+    }
+    with open(file_path, "w") as f:
+        json.dump(report, f, indent=2)
+    return file_path
+
+
+def compare_results(
+    results, baseline_path, keys, metric, threshold, higher_is_better=True
+):
+    """
+    Compares the results with a previous run and finds the regressions.
+
+    Args:
+        results (list): The results of this run (dicts).
+        baseline_path (str): The JSON file saved by a previous run.
+        keys (list): The fields identifying the same measurement in both runs.
+        metric (str): The field compared.
+        threshold (float): The relative change allowed (e.g., 0.1 = 10% worse).
+        higher_is_better (bool): Whether higher values of the metric are better (e.g., images/sec).
+
+    Returns:
+        list: Messages describing each regression (empty if there are none).
+    """
+    with open(baseline_path, "r") as f:
+        baseline = {
+            tuple(result.get(key) for key in keys): result
+            for result in json.load(f)["results"]
+        }
+    regressions = []
+    for result in results:
+        previous = baseline.get(tuple(result.get(key) for key in keys))
+        if previous is None or not previous.get(metric):
+            continue
+        change = result[metric] / previous[metric] - 1
+        if not higher_is_better:
+            change = -change
+        if change < -threshold:
+            name = ", ".join(f"{key}={result.get(key)}" for key in keys)
+            regressions.append(
+                f"{name}: {metric} {previous[metric]:.4g} -> {result[metric]:.4g} "
+                f"({change:+.1%})"
+            )
+    return regressions
+
+
+def print_table(results, columns):
+    """
+    Prints the results as an aligned table.
+    """
+    rows = [[str(result.get(column, "")) for column in columns] for result in results]
+    widths = [max([len(c), *(len(r[i]) for r in rows)]) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(v.ljust(w) for v, w in zip(row, widths)))
+
+
+def latency_percentiles(seconds):
+    """
+    Gets the p50, p95 and p99 of some latencies in milliseconds.
+    """
+    p50, p95, p99 = np.percentile(np.asarray(seconds) * 1000, [50, 95, 99])
+    return {"p50_ms": round(p50, 3), "p95_ms": round(p95, 3), "p99_ms": round(p99, 3)}
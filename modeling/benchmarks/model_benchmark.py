@@ -0,0 +1,372 @@
+"""
+Benchmark of the models: training throughput, inference latency and cold start.
+
+For mobilenet_model and sequential_model it measures, with synthetic batches on the CPU:
+- Training steps/sec (and images/sec) at several batch sizes.
+- Inference latency (p50/p95/p99) of single images and batches, for the Keras model and for the
+  .tflite files produced by model_convert with each quantization mode.
+- Cold start of model_load in a new process (imports and loading).
+- Optionally, training steps/sec with several CPU configurations (threads, XLA, precision, oneDNN).
+The results are saved as JSON and can be compared with a previous run.
+
+Usage (from the modeling folder):
+    python -m benchmarks.model_benchmark --models mobilenet sequential --batch-sizes 8 16 32
+    python -m benchmarks.model_benchmark --baseline benchmarks/results/model_<...>.json
+    python -m benchmarks.model_benchmark --only-cpu-configs --cpu-configs 0:0:0:float32:1 0:0:1:auto:1
+"""
+
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.harness import (
+    RESULTS_PATH,
+    compare_results,
+    latency_percentiles,
+    measure,
+    print_table,
+    save_results,
+)
+from options import CLASS_NAMES, QUANTIZATION_MODES, TARGET_SIZE
+
+MODELS = ["mobilenet", "sequential"]
+
+
+def build_model(name):
+    from service.model_creation import mobilenet_model, sequential_model
+
+    if name == "mobilenet":
+        # Random weights have the same speed as the imagenet ones, without downloading them
+        return mobilenet_model(weights=None)
+    return sequential_model()
+
+
+def synthetic_batch(batch_size, seed=0):
+    """
+    Gets a batch of random images and multi-hot labels as the training data.
+    """
+    rng = np.random.default_rng(seed)
+    images = rng.random(
+        (batch_size, TARGET_SIZE[1], TARGET_SIZE[0], 3), dtype=np.float32
+    )
+    labels = (rng.random((batch_size, len(CLASS_NAMES))) < 0.3).astype(np.float32)
+    return images, labels
+
+
+def training_throughput(model, batch_size, steps=10, warmup=2):
+    """
+    Measures the training steps per second of a model on synthetic batches.
+    The first steps build the graph, so they are not measured.
+    """
+    images, labels = synthetic_batch(batch_size)
+    for _ in range(warmup):
+        model.train_on_batch(images, labels)
+    start = time.perf_counter()
+    for _ in range(steps):
+        model.train_on_batch(images, labels)
+    seconds = time.perf_counter() - start
+    return {
+        "steps_per_second": round(steps / seconds, 3),
+        "images_per_second": round(steps * batch_size / seconds, 2),
+    }
+
+
+def keras_latency(model, batch_size, runs=50, warmup=5):
+    """
+    Measures the latency of calling the Keras model on a batch (as a service would).
+    """
+    images, _ = synthetic_batch(batch_size)
+    for _ in range(warmup):
+        model(images, training=False)
+    latencies = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        model(images, training=False)
+        latencies.append(time.perf_counter() - start)
+    return latency_percentiles(latencies)
+
+
+def tflite_latency(path, batch_size, runs=50, warmup=5):
+    """
+    Measures the latency of the TFLite interpreter on a batch.
+    """
+    from service.tflite_inference import TFLiteModel, measure_latency
+
+    images, _ = synthetic_batch(batch_size)
+    latency = measure_latency(TFLiteModel(path), images, runs, warmup)
+    return {name: round(value, 3) for name, value in latency.items()}
+
+
+def synthetic_calibration(samples=8):
+    images, _ = synthetic_batch(samples, seed=1)
+
+    def generator():
+        for image in images:
+            yield [image[np.newaxis]]
+
+    return generator
+
+
+def cold_load(path):
+    """
+    Loads a model in a new process, timing the imports and model_load separately.
+    """
+    start = time.perf_counter()
+    from service.model_creation import model_load
+
+    imported = time.perf_counter()
+    model_load(path)
+    loaded = time.perf_counter()
+    return {
+        "import_seconds": round(imported - start, 3),
+        "load_seconds": round(loaded - imported, 3),
+    }
+
+
+def cpu_training(name, batch_size, steps, config):
+    """
+    Measures the training throughput with a CPU configuration, in a new process (the thread pools and
+    oneDNN can only be set before TensorFlow starts).
+    """
+    os.environ["TF_ENABLE_ONEDNN_OPTS"] = "1" if config["onednn"] else "0"
+    from service.training_configuration import configure_cpu_training
+
+    settings = configure_cpu_training(
+        config["intra_threads"], config["inter_threads"], config["precision"]
+    )
+    model = build_model(name)
+    model.jit_compile = config["xla"]
+    return {
+        **settings,
+        "xla": model.jit_compile,
+        **training_throughput(model, batch_size, steps),
+    }
+
+
+def parse_cpu_config(value):
+    """
+    Parses a CPU configuration as intra_threads:inter_threads:xla:precision:onednn (e.g., 0:0:1:auto:1).
+    """
+    intra, inter, xla, precision, onednn = value.split(":")
+    return {
+        "intra_threads": int(intra),
+        "inter_threads": int(inter),
+        "xla": xla == "1",
+        "precision": precision,
+        "onednn": onednn == "1",
+    }
+
+
+def benchmark_cpu_training(models, batch_sizes, configs, steps=10):
+    """
+    Measures the training steps/sec of every CPU configuration, to choose the fastest one for a node.
+    """
+    results = []
+    for name in models:
+        for batch_size in batch_sizes:
+            for config in configs:
+                m = measure(
+                    cpu_training, name, batch_size, steps, config, start_method="spawn"
+                )
+                results.append(
+                    {
+                        "kind": "cpu_training",
+                        "model": name,
+                        "batch_size": batch_size,
+                        "config": ":".join(
+                            str(int(v) if isinstance(v, bool) else v)
+                            for v in config.values()
+                        ),
+                        **m["result"],
+                    }
+                )
+                print(f"{name} CPU training (batch {batch_size}): {results[-1]}")
+    return results
+
+
+def benchmark(
+    models=MODELS,
+    batch_sizes=(8, 16, 32),
+    latency_batch_sizes=(1, 16),
+    steps=10,
+    runs=50,
+    quantization_modes=QUANTIZATION_MODES,
+):
+    """
+    Runs the training, inference and cold start benchmarks of every model.
+
+    Returns:
+        list: The results, with a kind (training, inference or cold_start) each.
+    """
+    from service.model_creation import model_convert, model_store
+
+    results = []
+    work = tempfile.mkdtemp(prefix="model_benchmark_")
+    try:
+        for name in models:
+            for batch_size in batch_sizes:
+                model = build_model(name)  # New weights and optimizer for each size
+                result = training_throughput(model, batch_size, steps)
+                results.append(
+                    {
+                        "kind": "training",
+                        "model": name,
+                        "batch_size": batch_size,
+                        **result,
+                    }
+                )
+                print(f"{name} training (batch {batch_size}): {result}")
+
+            model = build_model(name)
+            keras_path = os.path.join(work, f"{name}.keras")
+            model_store(model, keras_path)
+            runtimes = {"keras": None}
+            for mode in quantization_modes:
+                runtimes[f"tflite_{mode}"] = os.path.join(work, f"{name}_{mode}.tflite")
+                model_convert(
+                    model, runtimes[f"tflite_{mode}"], mode, synthetic_calibration()
+                )
+            for batch_size in latency_batch_sizes:
+                for runtime, tflite_path in runtimes.items():
+                    if tflite_path is None:
+                        result = keras_latency(model, batch_size, runs)
+                    else:
+                        result = tflite_latency(tflite_path, batch_size, runs)
+                    results.append(
+                        {
+                            "kind": "inference",
+                            "model": name,
+                            "runtime": runtime,
+                            "batch_size": batch_size,
+                            **result,
+                        }
+                    )
+                    print(f"{name} {runtime} inference (batch {batch_size}): {result}")
+
+            cold = measure(cold_load, keras_path, start_method="spawn")
+            result = {
+                **cold["result"],
+                "process_seconds": round(cold["seconds"], 3),
+                "peak_rss_mb": round(cold["peak_rss_mb"], 1),
+            }
+            results.append({"kind": "cold_start", "model": name, **result})
+            print(f"{name} cold start: {result}")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return results
+
+
+def find_regressions(results, baseline, threshold):
+    """
+    Compares each kind of result with the baseline by its own metric.
+    """
+    return [
+        *compare_results(
+            results,
+            baseline,
+            ["kind", "model", "batch_size", "config"],
+            "steps_per_second",
+            threshold,
+        ),
+        *compare_results(
+            results,
+            baseline,
+            ["kind", "model", "runtime", "batch_size"],
+            "p95_ms",
+            threshold,
+            higher_is_better=False,
+        ),
+        *compare_results(
+            results,
+            baseline,
+            ["kind", "model"],
+            "load_seconds",
+            threshold,
+            higher_is_better=False,
+        ),
+    ]
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--models", nargs="+", choices=MODELS, default=MODELS)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[8, 16, 32])
+    parser.add_argument("--latency-batch-sizes", type=int, nargs="+", default=[1, 16])
+    parser.add_argument("--steps", type=int, default=10)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument(
+        "--quantization-modes",
+        nargs="+",
+        choices=QUANTIZATION_MODES,
+        default=QUANTIZATION_MODES,
+    )
+    parser.add_argument(
+        "--cpu-configs",
+        type=parse_cpu_config,
+        nargs="*",
+        default=[],
+        help="CPU training configurations as intra_threads:inter_threads:xla:precision:onednn "
+        "(e.g., 0:0:0:float32:1 0:0:1:auto:1), each one measured in a new process",
+    )
+    parser.add_argument(
+        "--only-cpu-configs",
+        action="store_true",
+        help="Skip the other benchmarks",
+    )
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Allowed relative change for the worse compared with the baseline",
+    )
+    args = parser.parse_args(args)
+
+    results = []
+    if not args.only_cpu_configs:
+        results = benchmark(
+            args.models,
+            args.batch_sizes,
+            args.latency_batch_sizes,
+            args.steps,
+            args.runs,
+            args.quantization_modes,
+        )
+    results += benchmark_cpu_training(
+        args.models, args.batch_sizes, args.cpu_configs, args.steps
+    )
+    for kind, columns in [
+        ("training", ["steps_per_second", "images_per_second"]),
+        ("inference", ["runtime", "p50_ms", "p95_ms", "p99_ms"]),
+        ("cold_start", ["import_seconds", "load_seconds", "process_seconds"]),
+        (
+            "cpu_training",
+            ["config", "precision", "xla", "steps_per_second", "images_per_second"],
+        ),
+    ]:
+        rows = [r for r in results if r["kind"] == kind]
+        if rows:
+            print_table(rows, ["kind", "model", "batch_size", *columns])
+    config = {
+        key: value
+        for key, value in vars(args).items()
+        if key not in ["output", "baseline"]
+    }
+    print(f"Results saved to {save_results('model', results, config, args.output)}")
+    if args.baseline:
+        regressions = find_regressions(results, args.baseline, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
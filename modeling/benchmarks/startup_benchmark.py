@@ -0,0 +1,135 @@
+"""
+Benchmark of the startup of app.main and the entry points of the flows.
+
+Each entry point is imported in a new process (as a worker starting a flow run), measuring the import
+time, the peak RSS and which heavy modules (TensorFlow, scikit-learn, SciPy, Firebase, Roboflow) were loaded.
+The results are saved as JSON and can be compared with a previous run.
+
+Usage (from the modeling folder):
+    python -m benchmarks.startup_benchmark --repeats 5
+    python -m benchmarks.startup_benchmark --baseline benchmarks/results/startup_<...>.json
+"""
+
+import argparse
+import importlib
+import statistics
+import sys
+import time
+
+from benchmarks.harness import (
+    RESULTS_PATH,
+    compare_results,
+    measure,
+    print_table,
+    save_results,
+)
+
+ENTRY_POINTS = {
+    "app": "app:main",
+    "initial_dataset_flow": "flows.collection_pipeline:initial_dataset_flow",
+    "periodic_monitoring_flow": "flows.collection_pipeline:periodic_monitoring_flow",
+    "initial_training_flow": "flows.training_pipeline:initial_training_flow",
+    "periodic_retraining_flow": "flows.training_pipeline:periodic_retraining_flow",
+    "register_flows": "flows.register_flows:register_flows",
+}
+# Modules only the code paths that need them should load
+HEAVY_MODULES = [
+    "tensorflow",
+    "sklearn",
+    "scipy",
+    "firebase_admin",
+    "roboflow",
+    "matplotlib",
+]
+
+
+def load_entry_point(entry_point):
+    """
+    Imports the module of an entry point (module:function) and gets the function, in a new process.
+    """
+    module, name = entry_point.split(":")
+    start = time.perf_counter()
+    getattr(importlib.import_module(module), name)
+    seconds = time.perf_counter() - start
+    return {
+        "import_seconds": round(seconds, 3),
+        "modules": len(sys.modules),
+        "heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+
+
+def benchmark(entry_points=tuple(ENTRY_POINTS), repeats=3):
+    """
+    Measures the startup of each entry point, taking the median of the repeats.
+
+    Returns:
+        list: The results of each entry point.
+    """
+    results = []
+    for name in entry_points:
+        runs = [
+            measure(load_entry_point, ENTRY_POINTS[name], start_method="spawn")
+            for _ in range(repeats)
+        ]
+        result = {
+            "entry_point": name,
+            "import_seconds": statistics.median(
+                r["result"]["import_seconds"] for r in runs
+            ),
+            "process_seconds": round(statistics.median(r["seconds"] for r in runs), 3),
+            "peak_rss_mb": round(max(r["peak_rss_mb"] for r in runs), 1),
+            "modules": runs[-1]["result"]["modules"],
+            "heavy_modules": runs[-1]["result"]["heavy_modules"],
+        }
+        results.append(result)
+        print(f"{name}: {result}")
+    return results
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--entry-points",
+        nargs="+",
+        choices=list(ENTRY_POINTS),
+        default=list(ENTRY_POINTS),
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--output", default=RESULTS_PATH)
+    parser.add_argument("--baseline", help="Results of a previous run to compare with")
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.1,
+        help="Allowed relative change for the worse compared with the baseline",
+    )
+    args = parser.parse_args(args)
+
+    results = benchmark(args.entry_points, args.repeats)
+    rows = [
+        {**r, "heavy_modules": ",".join(r["heavy_modules"]) or "-"} for r in results
+    ]
+    print_table(
+        rows,
+        ["entry_point", "import_seconds", "peak_rss_mb", "modules", "heavy_modules"],
+    )
+    config = {"entry_points": args.entry_points, "repeats": args.repeats}
+    print(f"Results saved to {save_results('startup', results, config, args.output)}")
+    if args.baseline:
+        regressions = compare_results(
+            results,
+            args.baseline,
+            ["entry_point"],
+            "import_seconds",
+            args.threshold,
+            higher_is_better=False,
+        )
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -3,27 +3,33 @@ import shutil
 import zipfile
 from datetime import datetime
 
-from prefect import flow, task
+from prefect import flow, task, unmapped
+from prefect.context import FlowRunContext
 from prefect.events import emit_event
-from prefect.task_runners import SequentialTaskRunner
+from prefect.task_runners import ConcurrentTaskRunner
 
-from options import AUGMENTED_PATH,CLASS_NAMES,PROCESSED_PATH,RAW_PATH,SPLIT_NAMES,SPLIT_PATH,AUC_THRESHOLD
+from options import AUGMENTED_PATH,CLASS_NAMES,COLLECTION_MODE,PROCESSED_PATH,RAW_PATH,SPLIT_NAMES,SPLIT_PATH,AUC_THRESHOLD,COLLECTION_MIN_SHARD_SIZE,COLLECTION_SHARDS,COLLECTION_TASK_RETRIES,SPLIT_FORMAT,PREPROCESS_CACHE_SIZE
 from service.cloud_storage import download_firebase, download_roboflow
+from service.dataset_index import list_images, open_index
+from service.drift_monitor import DriftMonitor
 from service.image_transformations import (
     augment_images,
     preprocess_images,
     split_images,
+    stream_images,
 )
+from service.instrumentation import instrumented, published
 from service.metric_monitoring import drift_detection
+from service.preprocess_cache import PreprocessCache
 
 DATA_DIR = "data"
 INITIAL_ZIP = "data/initial.zip"
 INITIAL_PATH = "data/initial"
 
 
-def empty_folder(path):
+def empty_folder(path, index=None):
     """
-    Empties images in the directory.
+    Empties images in the directory (and removes them from the dataset index).
     """
     count = 0
     for image in os.listdir(path):
@@ -31,67 +37,261 @@ def empty_folder(path):
         if os.path.isfile(file_path):
             os.remove(file_path)
             count += 1
+    if index is not None:
+        index.remove(path)
     return count
 
 
-@task
+def close_index(index):
+    if index is not None:
+        index.close()
+
+
+def list_shards(
+    folder, stage, shards=COLLECTION_SHARDS, min_size=COLLECTION_MIN_SHARD_SIZE
+):
+    """
+    Split the images of a stage folder into shards of consecutive names.
+
+    Args:
+        folder (str): The stage folder.
+        stage (str): The stage of the images (raw, processed or augmented).
+        shards (int): The number of shards (0 = one per CPU core).
+        min_size (int): The minimum number of images of a shard.
+
+    Returns:
+        list: The names of the images of each shard.
+        int: The number of images of each shard (the last one may have fewer).
+    """
+    index = open_index()
+    files = sorted(list_images(folder, index, stage))
+    close_index(index)
+    shards = shards or os.cpu_count() or 1
+    size = max(-(-len(files) // shards), min_size)
+    return [files[i : i + size] for i in range(0, len(files), size)], size
+
+
+def map_shards(shard_task, mapped, **kwargs):
+    """
+    Run a task on each shard as concurrent mapped tasks, so a failed shard is retried on its own.
+    Outside a flow (e.g., in the benchmarks), the shards are run one after another.
+
+    Args:
+        shard_task: The task run on each shard.
+        mapped (dict): The list of values of each argument that changes with the shard.
+        kwargs: The arguments shared by every shard.
+
+    Returns:
+        list: The result of each shard.
+    """
+    if FlowRunContext.get() is None:
+        return [
+            shard_task.fn(**dict(zip(mapped, values)), **kwargs)
+            for values in zip(*mapped.values())
+        ]
+    futures = shard_task.map(
+        **mapped, **{name: unmapped(value) for name, value in kwargs.items()}
+    )
+    return [future.result() for future in futures]
+
+
+def validate_preprocess_cache():
+    """
+    Empties the preprocess cache if its parameters changed, once before the shards use it.
+    """
+    if PREPROCESS_CACHE_SIZE > 0 and PreprocessCache().validate():
+        print("Preprocess cache emptied after its parameters changed.")
+
+
+def empty_stage(path):
+    index = open_index()
+    deleted = empty_folder(path, index)
+    close_index(index)
+    return deleted
+
+
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=10)
+@instrumented()
 def download_files_initial():
     """
     Downloads the initial dataset from Roboflow and extracts our background images zip.
     """
     with zipfile.ZipFile(INITIAL_ZIP, "r") as zip_ref:
         zip_ref.extractall(DATA_DIR)
-    downloaded = download_roboflow()
+    index = open_index()
+    downloaded = download_roboflow(index=index)
+    if index is not None:
+        # Add the extracted images, which were written without the index
+        index.sync_folder(RAW_PATH, "raw", source="initial")
+    close_index(index)
     print(f"Downloaded {downloaded} images from Roboflow.")
     return downloaded
 
 
-@task
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=10)
+@instrumented()
 def download_files():
     """
     Retrieves new images from Firebase.
     """
-    count = download_firebase()
+    index = open_index()
+    count = download_firebase(index=index)
+    close_index(index)
     print(f"Downloaded and deleted {count} images from Firebase.")
     return count
 
 
-@task
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=5)
+@instrumented()
+def preprocess_shard(files):
+    index = open_index()
+    processed = preprocess_images(index=index, files=files)
+    close_index(index)
+    return processed
+
+
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=5)
+@instrumented()
+def augment_shard(files, start, augments=1):
+    index = open_index()
+    augmented, total = augment_images(augments, index=index, files=files, start=start)
+    close_index(index)
+    return augmented, total
+
+
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=5)
+@instrumented()
+def split_shard(files, destination=INITIAL_PATH):
+    index = open_index()
+    split = split_images(destination, index=index, files=files)
+    close_index(index)
+    return split
+
+
+@task(retries=COLLECTION_TASK_RETRIES, retry_delay_seconds=5)
+@instrumented()
+def stream_shard(files, start, augments=1, destination=INITIAL_PATH):
+    index = open_index()
+    split = stream_images(destination, augments, index=index, files=files, start=start)
+    close_index(index)
+    return split
+
+
+@instrumented()
 def preprocess_files():
-    processed = preprocess_images()
-    deleted = empty_folder(RAW_PATH)
-    print(f"Preprocessed {processed}/{deleted} images.")
+    """
+    Preprocesses the raw images in concurrent shards.
+    """
+    shards, _ = list_shards(RAW_PATH, "raw")
+    validate_preprocess_cache()
+    processed = sum(map_shards(preprocess_shard, {"files": shards}))
+    deleted = empty_stage(RAW_PATH)
+    print(f"Preprocessed {processed}/{deleted} images in {len(shards)} shards.")
     return processed
 
 
-@task
+@instrumented()
 def augment_files(augments=1):
-    augmented, total = augment_images(augments)
-    deleted = empty_folder(PROCESSED_PATH)
-    print(f"Augmented {augmented}/{deleted} images.")
+    """
+    Augments the processed images in concurrent shards.
+    The augmented images of each shard are numbered after the ones of the previous shards.
+    """
+    shards, size = list_shards(PROCESSED_PATH, "processed")
+    starts = [i * size * augments for i in range(len(shards))]
+    results = map_shards(
+        augment_shard, {"files": shards, "start": starts}, augments=augments
+    )
+    augmented = sum(count for count, _ in results)
+    total = sum(total for _, total in results)
+    deleted = empty_stage(PROCESSED_PATH)
+    print(f"Augmented {augmented}/{deleted} images in {len(shards)} shards.")
     return total
 
 
-@task
+@instrumented()
 def split_files(destination=INITIAL_PATH):
-    split = split_images(destination)
-    deleted = empty_folder(AUGMENTED_PATH)
-    print(f"Split {split}/{deleted} images.")
+    """
+    Splits the augmented images in concurrent shards.
+    TFRecord splits are written by a single shard, as the writers append to the same shard files.
+    """
+    shards, _ = list_shards(
+        AUGMENTED_PATH,
+        "augmented",
+        1 if SPLIT_FORMAT == "tfrecord" else COLLECTION_SHARDS,
+    )
+    split = sum(map_shards(split_shard, {"files": shards}, destination=destination))
+    deleted = empty_stage(AUGMENTED_PATH)
+    print(f"Split {split}/{deleted} images in {len(shards)} shards.")
     return split
 
 
+@instrumented()
+def stream_files(augments=1, destination=INITIAL_PATH):
+    """
+    Preprocesses, augments and splits the raw images in memory (streaming collection mode),
+    in concurrent shards.
+    """
+    shards, size = list_shards(
+        RAW_PATH, "raw", 1 if SPLIT_FORMAT == "tfrecord" else COLLECTION_SHARDS
+    )
+    starts = [i * size * augments for i in range(len(shards))]
+    validate_preprocess_cache()
+    split = sum(
+        map_shards(
+            stream_shard,
+            {"files": shards, "start": starts},
+            augments=augments,
+            destination=destination,
+        )
+    )
+    deleted = empty_stage(RAW_PATH)
+    print(f"Streamed {split} images from {deleted} raw images in {len(shards)} shards.")
+    return split
+
+
+@task
+@instrumented()
+def monitor_drift():
+    """
+    Adds the downloaded feedback to the drift monitor and checks the drift in its windows of days.
+    Runs before drift_detection renames the files, as it reads the confidences from their names.
+    """
+    monitor = DriftMonitor()
+    index = open_index()
+    added = monitor.update_files(list_images(RAW_PATH, index, "raw"))
+    close_index(index)
+    monitor.save()
+    print(f"Added {added} images to the drift monitor.")
+    for window in monitor.windows:
+        aucs = {
+            class_name: m["auc"]
+            for class_name, m in monitor.summary(window).items()
+            if m["auc"] is not None
+        }
+        print(f"Approximate AUC in the last {window} days: {aucs}")
+    window, class_name = monitor.drift()
+    if class_name is not None:
+        print(f"Drift of {class_name} detected in the last {window} days.")
+    return class_name
+
+
 @flow(
     name="Initial Dataset Collection Pipeline",
-    task_runner=SequentialTaskRunner(),
+    task_runner=ConcurrentTaskRunner(),
     log_prints=True,
-    retries=5,
+    retries=1,
     retry_delay_seconds=15,
 )
+@published("initial_dataset_flow")
 def initial_dataset_flow():
     download_initial = download_files_initial()
     if download_initial == 0:
         print("Skipping after no initial images downloaded.")
         return
+    if COLLECTION_MODE == "streaming":
+        if stream_files(1) == 0:
+            print("No initial images to split.")
+        return
     preprocess = preprocess_files()
     if preprocess == 0:
         print("Skipping after no initial images preprocessed.")
@@ -107,42 +307,52 @@ def initial_dataset_flow():
 
 @flow(
     name="Daily Dataset Collection Pipeline",
-    task_runner=SequentialTaskRunner(),
+    task_runner=ConcurrentTaskRunner(),
     log_prints=True,
-    retries=3,
+    retries=1,
     retry_delay_seconds=10,
 )
+@published("periodic_monitoring_flow")
 def periodic_monitoring_flow():
     download = download_files()
     if download == 0:
         print("Skipping after no cloud images downloaded.")
         return
-    metrics, drift = drift_detection()
-    if metrics is not None:
-        print("Metrics obtained:")
-        fails = 0
-        corrects = 0
-        for class_name, m in metrics.items():
-            print(f"{class_name}: {m}")
-            fails += m["FP"] + m["FN"]
-            corrects += m["TP"] + m["TN"]
-        margin = fails / (fails + corrects)
-        drift = margin < AUC_THRESHOLD
-    if drift:
-        print("skipping after no drift detected.")
-        empty_folder(RAW_PATH)
-        return
-    preprocess = preprocess_files()
-    if preprocess == 0:
-        print("Skipping after no images preprocess.")
-        return
-    augment = augment_files(8)
-    if augment == 0:
-        print("Skipping after no images preprocess.")
-        return
-    split = split_files(
-        destination=f"{SPLIT_PATH}/{datetime.now().strftime('%Y%m%d')}/"
-    )
+    trend = monitor_drift()
+    index = open_index()
+    try:
+        metrics, drift = drift_detection(index)
+        drift = drift or trend  # Class with drift in today's images or in the last days
+        if metrics is not None:
+            print("Metrics obtained:")
+            fails = 0
+            corrects = 0
+            for class_name, m in metrics.items():
+                print(f"{class_name}: {m}")
+                fails += m["FP"] + m["FN"]
+                corrects += m["TP"] + m["TN"]
+            margin = fails / (fails + corrects)
+            if drift is None and margin >= AUC_THRESHOLD:
+                drift = "error rate"
+        if drift is None:
+            print("skipping after no drift detected.")
+            empty_folder(RAW_PATH, index)
+            return
+    finally:  # Also when the drift detection fails, so the index is not left open
+        close_index(index)
+    destination = f"{SPLIT_PATH}/{datetime.now().strftime('%Y%m%d')}/"
+    if COLLECTION_MODE == "streaming":
+        split = stream_files(8, destination)
+    else:
+        preprocess = preprocess_files()
+        if preprocess == 0:
+            print("Skipping after no images preprocess.")
+            return
+        augment = augment_files(8)
+        if augment == 0:
+            print("Skipping after no images preprocess.")
+            return
+        split = split_files(destination=destination)
     if split == 0:
         print("No images to split.")
         return
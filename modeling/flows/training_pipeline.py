@@ -1,73 +1,162 @@
+import json
 import os
+import shutil
 
 from prefect import flow, task
 
-from options import AUC_THRESHOLD, INITIAL_PATH, SPLIT_PATH
-from service.cloud_storage import upload_tflite
-from service.model_creation import (
-    mobilenet_model,
-    model_convert,
-    model_load,
-    model_store,
+from options import (
+    AUC_THRESHOLD,
+    BEST_MODELS_PATH,
+    DEPLOY_PATH,
+    INITIAL_PATH,
+    MODEL_REGISTRY_PATH,
+    RETRAIN_MODE,
+    SPLIT_PATH,
+    TRAINING_DATA,
+    TRAINING_MODE,
 )
-from service.model_optimization import measure_performance, model_training
-from service.training_configuration import get_split_generators
+from service.cloud_storage import upload_tflite
+from service.dataset_index import open_index
+from service.instrumentation import instrumented, published
+from service.model_registry import ModelRegistry
+
+# The modules using TensorFlow are imported by the tasks that need them, so registering or
+# importing the flows doesn't load it
 
 SKIP_EVAL = True  # Bypass evaluation of the model performance
-current_version = 0  # Latest version of the model
-path_models_best = "models/best"  # Path to the best models
-path_models_tflite = "models/deploy"  # Path to the converted models to upload
+path_models_tflite = DEPLOY_PATH  # Path to the converted models to upload
 latest_split = ""  # Latest split of the dataset collected and used for retraining
 
 
-def last_model_path():
-    return f"{path_models_best}/weld_{current_version}.keras"
+def open_registry(root="."):
+    return ModelRegistry(f"{root}/{MODEL_REGISTRY_PATH}", f"{root}/{BEST_MODELS_PATH}")
+
 
+def configure_training():
+    """
+    Set the GPU memory growth, and the thread pools and precision of the CPU training mode,
+    before the models are built.
+    """
+    from service.training_configuration import configure_cpu_training, configure_gpus
 
-def next_model_path(root="."):
-    global current_version
-    current_version += 1
-    return f"{root}/{path_models_best}/weld_{current_version}.keras"
+    configure_gpus()
+    if TRAINING_MODE == "cpu":
+        print(f"CPU training settings: {configure_cpu_training()}")
 
 
 @task
+@instrumented()
 def create_model():
+    from service.model_creation import mobilenet_model
+
     return mobilenet_model()
 
 
 @task
+@instrumented()
 def train_model(model, data, epochs=5):
+    from service.model_optimization import model_training
+
     print("Starting model training...")
     return model_training(model, data[0], data[1], epochs)
 
 
 @task
-def save_model(model, path=""):
-    final_path = next_model_path(path)
-    print(f"Saving model to {final_path}")
-    model_store(model, final_path)
+@instrumented()
+def train_head_model(model, data, split_path, epochs=5):
+    """
+    Train only the classifier head on the cached backbone embeddings of the split images.
+    A replay sample caches the embeddings of its images, wherever they are.
+    Splits stored as TFRecord shards have no image files to cache, so the whole model is trained.
+    """
+    from service.embedding_cache import train_head
+    from service.model_optimization import model_training
+    from service.tfrecord_dataset import is_tfrecord_split
+
+    if getattr(data[0], "paths", None) is not None:
+        print("Starting head training on the cached embeddings of the replay sample...")
+        sets = [(d.paths, d.labels) for d in data[:2]]
+        return train_head(model, split_path, epochs, sets=sets)
+    if is_tfrecord_split(split_path):
+        print("Training the whole model, the split has no image files to cache.")
+        return model_training(model, data[0], data[1], epochs)
+    print("Starting head training on cached embeddings...")
+    return train_head(model, split_path, epochs)
 
 
 @task
-def load_model(path):
-    return model_load(path)
+@instrumented()
+def save_model(model, root=".", tags=None, parent=None):
+    """
+    Register the model as the next version.
+
+    Returns:
+        int: The version of the model.
+    """
+    return open_registry(root).register(model, tags=tags, parent=parent)
 
 
 @task
-def deploy_model(path, valid=True, tags=["unknown"]):
+@instrumented()
+def load_model(version=None, copy=False):
+    """
+    Load a version of the model (the champion by default), cached after the first load.
+    With copy, a copy of the cached model is returned, to be retrained.
+    """
+    return open_registry().load(version, copy)
+
+
+@task
+@instrumented()
+def deploy_model(
+    path,
+    version,
+    valid=True,
+    tags=["unknown"],
+    test_data=None,
+    train_data=None,
+    root=".",
+):
     """
     Upload the model to Firebase.
 
+    With test data, the model is converted to every quantization mode and the fastest variant within
+    the AUC tolerance is deployed. The report of the variants is saved next to them as JSON.
+
     Args:
         path: The path to the model file.
+        version: The registered version of the model, which becomes the champion if valid.
         valid: Whether the model should be deployed to clients.
         tags: Tags to associate with the model (e.g., staging, weld, mobilenet, test).
+        test_data: Test data to compare the quantized variants with the float model.
+        train_data: Train data sampled to calibrate the int8 variant.
+        root: The folder of the models.
     """
-    convert_output = f"{path_models_tflite}/weld_{current_version}.tflite"
-    model_convert(path, convert_output)
+    from service.model_creation import model_convert
+    from service.model_optimization import choose_variant, quantize_model
+
+    convert_output = f"{root}/{path_models_tflite}/weld_{version}.tflite"
+    if test_data is None:
+        model_convert(path, convert_output)
+    else:
+        variants_path = f"{root}/{path_models_tflite}/weld_{version}"
+        reports = quantize_model(path, variants_path, test_data, train_data)
+        chosen = choose_variant(reports)
+        if chosen is None:
+            model_convert(path, convert_output)
+        else:
+            print(f"Deploying the {chosen['mode']} variant.")
+            shutil.copyfile(chosen["path"], convert_output)
+        with open(f"{variants_path}_quantization.json", "w") as f:
+            json.dump(
+                {"chosen": chosen and chosen["mode"], "variants": reports}, f, indent=2
+            )
     if valid:
         print("Uploading model to Firebase...")
         upload_tflite(convert_output, tags)
+        registry = open_registry(root)
+        registry.update(version, tags=tags)
+        registry.set_champion(version)
     else:
         print(
             "Ignoring model deployment due to poor performance. You can still manually upload it."
@@ -75,33 +164,46 @@ def deploy_model(path, valid=True, tags=["unknown"]):
 
 
 @task
-def evaluate_performance(model, initial_test, test=None):
+@instrumented()
+def evaluate_performance(model, initial_test, test=None, version=None):
     """
     Evaluate the model's performance on the test data.
 
-    This saves confusion matrices in the logs/predict folder as general_.png (the global performance compared with our prestablished initial test dataset)
-    and test_.png (based on the new data provided).
+    Each test set is read once. The confusion matrices are logged to TensorBoard in the logs/predict folder
+    as general (the global performance compared with our prestablished initial test dataset)
+    and test (based on the new data provided).
 
     Args:
         model: The trained model
         initial_test: Initial test data to use for evaluation.
         test: Additional test data to use in addition to the initial.
+        version: The registered version of the model, whose metrics are recorded.
 
     Returns:
         True if the model's performance is acceptable, False otherwise.
     """
     if SKIP_EVAL:
         return True
+    from service.model_optimization import measure_performance
+
     auc = measure_performance(model, initial_test, "general")
+    metrics = {"auc_general": auc}
     if test is not None:
         auc_t = measure_performance(model, test)
+        metrics["auc_test"] = auc_t
         if auc_t < auc:
             auc = auc_t
+    if version is not None:
+        open_registry().update(version, metrics)
     return auc >= AUC_THRESHOLD
 
 
 @task
+@instrumented()
 def find_data(initial=False, root="."):
+    from service.replay_dataset import get_replay_splits
+    from service.training_configuration import get_split_generators
+
     global latest_split
     if initial:
         print("Looking for initial data")
@@ -119,40 +221,68 @@ def find_data(initial=False, root="."):
     path = sorted(directories, reverse=True)[0]
     repeating = path == latest_split
     latest_split = path
+    if TRAINING_DATA == "replay":
+        index = open_index()
+        if index is not None:
+            print("Sampling the initial and daily splits to replay")
+            with index:
+                data = get_replay_splits(index, split_path=f"{root}/{SPLIT_PATH}")
+            return *data, repeating
+        print(
+            "WARNING: The replay needs the dataset index, training on the latest split."
+        )
     return *get_split_generators(f"{root}/{SPLIT_PATH}/{path}"), repeating
 
 
 @flow
+@published("initial_training_flow")
 def initial_training_flow():
+    configure_training()
     model = create_model()
     data = find_data(initial=True)
     print(f"Found data generators: {data}")
     train_model(model, data, epochs=5)
-    save_model(model)
-    deploy_model(model, tags=["initial", "weld", "mobilenet"])
-    evaluation = evaluate_performance(model, data[2])
+    tags = ["initial", "weld", "mobilenet"]
+    version = save_model(model, tags=tags)
+    deploy_model(model, version, tags=tags, test_data=data[2], train_data=data[0])
+    evaluation = evaluate_performance(model, data[2], version=version)
     print(evaluation)
 
 
 @flow
+@published("periodic_retraining_flow")
 def periodic_retraining_flow():
+    configure_training()  # Before the datasets start TensorFlow
     data = find_data()
     if data is None or data[0] is None or data[3]:
         print("Skipping after no new drift split found.")
         return
     else:
-        current_path = last_model_path()
-        print(f"Loading model from {current_path}")
-        model = load_model(current_path)
-        train_model(model, data)
-        save_model(model)
-        evaluation = evaluate_performance(model, find_data(True)[2], data[2])
+        champion = open_registry().champion
+        model = load_model(champion, copy=True)  # The cached champion stays as it is
+        if model is None:
+            print("Skipping after no trained model found to retrain.")
+            return
+        if RETRAIN_MODE == "head":
+            train_head_model(model, data, f"{SPLIT_PATH}/{latest_split}")
+        else:
+            train_model(model, data)
+        version = save_model(model, tags=["weld", "mobilenet"], parent=champion)
+        evaluation = evaluate_performance(
+            model, find_data(True)[2], data[2], version=version
+        )
         if evaluation:
             print("Model performance is sufficient.")
-            deploy_model(model, tags=["weld", "mobilenet", f"v{current_version}"])
+            deploy_model(
+                model,
+                version,
+                tags=["weld", "mobilenet", f"v{version}"],
+                test_data=data[2],
+                train_data=data[0],
+            )
         else:
             print("Model performance is insufficient.")
-            deploy_model(model, valid=False)
+            deploy_model(model, version, valid=False)
 
 
 if __name__ == "__main__":
@@ -161,10 +291,10 @@ if __name__ == "__main__":
     os.makedirs("temp", exist_ok=True)
     data = find_data(True, "temp")
     print("Train model")
+    from service.model_optimization import model_training
+
     model_training(model, data[0], data[1], 10)
     print("Model trained")
-    os.makedirs("temp/models", exist_ok=True)
-    os.makedirs("temp/models/best", exist_ok=True)
     os.makedirs("temp/models/deploy", exist_ok=True)
-    save_model(model, "temp")
-    deploy_model(model, False)
+    version = save_model(model, "temp")
+    deploy_model(model, version, False, root="temp")
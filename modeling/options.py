@@ -13,10 +13,72 @@ load_dotenv()  # Load the .env file
 FIREBASE_SDK_ADMIN_FILE_PATH = Path(__file__).parent / "private/serviceAdmin.json"
 FIREBASE_STORAGE_BUCKET_NAME = os.environ.get("FIREBASE_STORAGE_BUCKET")
 ROBOFLOW_API_KEY = os.environ.get("ROBOFLOW_API_KEY")
+# Number of images downloaded at the same time from Firebase
+FIREBASE_DOWNLOAD_WORKERS = 8
+# Number of images listed per request to Firebase
+FIREBASE_PAGE_SIZE = 1000
+# Number of downloaded images deleted from Firebase per request (the storage API allows up to 100)
+FIREBASE_DELETE_BATCH_SIZE = 100
 
 # Batch size = the number of images passed together to the train step (higher = faster but more memory)
 TRAIN_BATCH_SIZE = os.environ.get("BATCH_SIZE", 16)  # Load from .env file or use default value 16.
 TRAIN_EPOCHS = os.environ.get("EPOCHS", 10)  # More epochs = more training (better but slower)
+# How the split images are loaded for training: "tfdata" (parallel tf.data pipeline), "generator" (Keras ImageDataGenerator)
+# or "tensorstore" (decoded once to memory-mapped uint8 arrays in <split>/tensors, reused by every epoch and retrain)
+DATA_BACKEND = "tfdata"
+# Where tf.data keeps the decoded images after the first epoch ("none" = decoded every epoch, "memory"
+# for small splits, or a folder on disk)
+DATA_CACHE = "none"
+
+# TFLite variants converted for deployment: "float32" (no quantization), "dynamic" (int8 weights),
+# "float16" (half precision weights) and "int8" (full integer with float input/output, calibrated with the train split)
+QUANTIZATION_MODES = ["float32", "dynamic", "float16", "int8"]
+# Maximum AUC drop of any class allowed for a quantized variant compared with the float model
+QUANTIZATION_TOLERANCE = 0.01
+# Number of train images used to calibrate the ranges of the int8 variant
+REPRESENTATIVE_SAMPLES = 200
+# Number of loaded models kept in memory by the model registry (the least recently used are released)
+MODEL_CACHE_SIZE = 2
+
+# Where the models are trained: "default" (the GPU if there is one, with the default settings) or "cpu" (CPU-only nodes,
+# with the thread pools, XLA and precision below)
+TRAINING_MODE = os.environ.get("TRAINING_MODE", "default")
+# Threads used inside each operation (e.g., a convolution) in cpu mode (0 = one per core)
+CPU_INTRA_OP_THREADS = int(os.environ.get("CPU_INTRA_OP_THREADS", 0))
+# Independent operations run at the same time in cpu mode (0 = chosen by TensorFlow)
+CPU_INTER_OP_THREADS = int(os.environ.get("CPU_INTER_OP_THREADS", 0))
+# Compile the train step with XLA in cpu mode (fuses operations, slower first epoch)
+XLA_JIT = os.environ.get("XLA_JIT", "0") == "1"
+# Precision of the new models in cpu mode: "auto" (mixed bfloat16 if the CPU has bfloat16 instructions, as AVX512_BF16 or AMX),
+# "bfloat16" (always mixed bfloat16) or "float32". Loaded models keep the precision they were built with.
+MIXED_PRECISION = os.environ.get("MIXED_PRECISION", "auto")
+# oneDNN optimizations of the CPU operations and the highest instruction set they use ("" = all the supported ones,
+# or e.g. "AVX2", "AVX512_CORE_BF16", "AVX512_CORE_AMX"). TensorFlow reads them when it is imported, after this module.
+ONEDNN_OPTS = os.environ.get("TF_ENABLE_ONEDNN_OPTS", "1") == "1"
+ONEDNN_MAX_CPU_ISA = os.environ.get("ONEDNN_MAX_CPU_ISA", "")
+os.environ["TF_ENABLE_ONEDNN_OPTS"] = "1" if ONEDNN_OPTS else "0"
+if ONEDNN_MAX_CPU_ISA:
+    os.environ["ONEDNN_MAX_CPU_ISA"] = ONEDNN_MAX_CPU_ISA
+
+# How the periodic retraining adapts the model: "full" (trains the whole model on the images) or "head" (runs the backbone
+# once per image, caches its embeddings and only trains the classifier head on them, much faster)
+RETRAIN_MODE = os.environ.get("RETRAIN_MODE", "full")
+
+# Record the wall/CPU time, images/sec, bytes read/written and peak RSS of each stage of the flows ("0" = disabled,
+# the stages run without any measurement)
+INSTRUMENTATION = os.environ.get("INSTRUMENTATION", "1") == "1"
+# Maximum number of stage records kept in memory until a flow publishes them (the oldest are dropped)
+INSTRUMENTATION_MAX_RECORDS = 10000
+
+# What the periodic retraining trains on: "latest" (the newest daily split) or "replay" (a sample of the initial split
+# and every daily split, listed from the dataset index without copying files)
+TRAINING_DATA = os.environ.get("TRAINING_DATA", "latest")
+# Fraction of each replay set taken from the history (the initial split and the daily splits older than the window)
+REPLAY_RATIO = 0.3
+# Days of daily splits considered recent by the replay sample
+REPLAY_WINDOW_DAYS = 14
+# Maximum number of images of each replay set, so the cost of retraining doesn't grow with the days collected
+REPLAY_MAX_IMAGES = 10000
 
 # Verbosity of the training process.
 TRAINING_VERBOSITY = 1 # 0 = silent, 1 = single progress bar, 2 = one progress per epoch (most detailed)
@@ -24,16 +86,64 @@ TRAINING_VERBOSITY = 1 # 0 = silent, 1 = single progress bar, 2 = one progress p
 CLASS_THRESHOLD = 0.6  # For example, in inference, 0.6 (60%) chance of being a class or above to consider it.
 # Threshold for detecting drift in AUC. AUC (Area Under the Curve) is a metric.
 AUC_THRESHOLD = 0.75  # If evaluation AUC is below this value, drift is detected and retrain is required.
+# Sliding windows (in days) of the feedback checked by the drift monitor
+DRIFT_WINDOWS = [7, 30]
+# Number of bins of the histograms of the confidences used to approximate the AUC (higher = more precise)
+DRIFT_HISTOGRAM_BINS = 20
+# Minimum positive and negative images of a class in a window to check its drift
+DRIFT_MIN_SAMPLES = 20
+# Where the drift detection gets the confidences of the feedback images: "client" (encoded in the names by the app)
+# or "server" (the images are scored again with the latest deployed .tflite model)
+DRIFT_SCORING = "client"
+# Number of threads scoring images in bulk, each one with its own TFLite interpreter (0 = one per CPU core)
+SCORING_WORKERS = 0
+# Number of images run together by each interpreter when scoring in bulk
+SCORING_BATCH_SIZE = 32
 
 SPLIT_TRAIN = 0.8  # Percentage of the dataset used for training
 SPLIT_VALID = 0.15  # Percentage of the dataset used for validation
 SPLIT_TEST = 0.05  # Percentage of the dataset used for testing and evaluation
+# How images are assigned to the splits:
+# "hash" uses a stable hash of the original image id (reproducible, augmented copies stay together, files are moved).
+# "random" splits each class randomly (images with several classes are copied once per class).
+SPLIT_MODE = "hash"
+# How the split images are stored: "jpeg" (a folder per class) or "tfrecord" (shards with the multi-hot labels)
+SPLIT_FORMAT = "jpeg"
+# Approximate size in bytes of each TFRecord shard
+TFRECORD_SHARD_SIZE = 100 * 1024 * 1024  # 100 MB
 
 TEMP_PATH = "tmp"  # Folder for temporary files
 # Number of (additional) augmented images generated from each image
 AUGMENTATION_INCREASE = 8
+# Augmentation engine: "batch" (vectorized with NumPy over stacked images) or "pil" (one image at a time)
+AUGMENTATION_ENGINE = "batch"
+# Number of images whose augmented copies are stacked and augmented together by the batch engine
+AUGMENTATION_BATCH_SIZE = 4
+# Seed for the random augmentations of the batch engine (None = different on each run)
+AUGMENTATION_SEED = None
 # The target size of the images used by the model (higher = more accurate but slower to train/infer)
 TARGET_SIZE = (256,256)
+# Number of processes used to preprocess images (1 = sequential, 0 = one per CPU core)
+PREPROCESS_WORKERS = int(os.environ.get("PREPROCESS_WORKERS", 1))
+# Number of images each preprocessing worker takes at once (higher = less overhead, worse balancing)
+PREPROCESS_CHUNK_SIZE = 64
+# Filters applied to remove the noise of the images when preprocessing
+MEDIAN_FILTER_SIZE = 3
+GAUSSIAN_FILTER_RADIUS = 1
+# Maximum size in bytes of the cache of preprocessed images (0 = disabled). Least recently used are removed first.
+PREPROCESS_CACHE_SIZE = 2 * 1024 * 1024 * 1024  # 2 GB
+# How the collection flows treat the images:
+# "streaming" chains preprocess, augment and split in memory and only saves the final split images.
+# "staged" saves every stage to its folder (processed, augmented), which is useful for debugging.
+COLLECTION_MODE = "streaming"
+# Maximum number of preprocessed images waiting in memory to be augmented in streaming mode
+STREAM_QUEUE_SIZE = 32
+# Number of shards of the images run as concurrent tasks by the collection flows (0 = one per CPU core)
+COLLECTION_SHARDS = int(os.environ.get("COLLECTION_SHARDS", 0))
+# Minimum number of images of each shard (fewer images are run in fewer shards)
+COLLECTION_MIN_SHARD_SIZE = 64
+# Times a failed task of the collection flows (a download or a shard) is retried on its own before the flow fails
+COLLECTION_TASK_RETRIES = 3
 
 # Don't change the following:
 # Stores the initial dataset downloaded from Roboflow
@@ -46,6 +156,26 @@ PROCESSED_PATH = "data/processed"
 AUGMENTED_PATH = "data/augmented"
 # Stores images from augmented that get split into training, validation, and test sets and into their classes
 SPLIT_PATH = "data/splits"
+# Stores the trained models (weld_<version>.keras)
+BEST_MODELS_PATH = "models/best"
+# Records the version, hash, metrics and tags of each trained model, and the champion (deployed) version
+MODEL_REGISTRY_PATH = "models/registry.json"
+# Stores the models converted to .tflite (weld_<version>.tflite) to upload to the clients
+DEPLOY_PATH = "models/deploy"
+# Keeps track of the images downloaded/deleted from Firebase, so an interrupted download can resume
+FIREBASE_MANIFEST_PATH = "data/firebase_manifest.jsonl"
+# Index of the images of every stage with their labels, split and date ("" = disabled, the folders are scanned)
+DATASET_INDEX_PATH = "data/index.sqlite"
+# Keeps the daily counts of the feedback to detect drift over several days
+DRIFT_MONITOR_PATH = "data/drift_monitor.json"
+# Stores the backbone embeddings of the images by the hash of the image and the backbone weights (head retraining)
+EMBEDDING_CACHE_PATH = "data/cache/embeddings"
+# Stores the stage metrics of each flow: a JSON line per run (<flow>.jsonl) and a Prometheus textfile (<flow>.prom)
+METRICS_PATH = "logs/metrics"
+# Stores the downloaded Roboflow datasets as <workspace>/<project>/<version>, so a version is only downloaded once
+ROBOFLOW_CACHE_PATH = "data/cache/roboflow"
+# Stores the preprocessed images by the hash of the raw image, so they are not preprocessed again
+PREPROCESS_CACHE_PATH = "data/cache/preprocessed"
 
 SPLIT_NAMES = ["train", "valid", "test"]  # Folders names for image splits.
 CLASS_NAMES = [
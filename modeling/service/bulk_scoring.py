@@ -0,0 +1,209 @@
+"""
+Module for scoring many images at once with a deployed TFLite model.
+
+The images are read in batches by a pool of threads, each one with its own interpreter
+(the interpreters release the GIL while running, so the threads run in parallel).
+The scores of the 7 classes of each image are written to a CSV file, or returned as an array.
+Images that can't be read (e.g., truncated) get NaN scores instead of stopping the others.
+
+Usage (from the modeling folder):
+    python -m service.bulk_scoring data/raw --output data/scores.csv
+    python -m service.bulk_scoring images.txt --model models/deploy/weld_3.tflite
+"""
+
+import argparse
+import csv
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from options import (
+    CLASS_NAMES,
+    DEPLOY_PATH,
+    SCORING_BATCH_SIZE,
+    SCORING_WORKERS,
+    TARGET_SIZE,
+)
+from service.instrumentation import instrumented
+from service.tflite_inference import TFLiteModel
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+MODEL_PATTERN = re.compile(r"weld_(\d+)\.tflite")
+
+
+def latest_model(path=DEPLOY_PATH):
+    """
+    Find the deployed model with the highest version (weld_<version>.tflite).
+
+    Returns:
+        str: The path of the model, or None if there is none.
+    """
+    if not os.path.isdir(path):
+        return None
+    versions = [
+        (int(match.group(1)), name)
+        for name in os.listdir(path)
+        if (match := MODEL_PATTERN.fullmatch(name))
+    ]
+    return os.path.join(path, max(versions)[1]) if versions else None
+
+
+def list_sources(source):
+    """
+    List the images of a folder, or of a manifest (a text file with an image path per line,
+    relative to the manifest folder unless absolute).
+    """
+    if os.path.isdir(source):
+        return [
+            os.path.join(source, name)
+            for name in sorted(os.listdir(source))
+            if name.lower().endswith(IMAGE_EXTENSIONS)
+        ]
+    folder = os.path.dirname(source)
+    with open(source, "r") as f:
+        return [os.path.join(folder, line.strip()) for line in f if line.strip()]
+
+
+def load_image(path):
+    """
+    Load an image as the model input: RGB, resized to the target size and scaled to [0, 1].
+    """
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        if image.size != TARGET_SIZE:
+            image = image.resize(TARGET_SIZE, Image.BILINEAR)
+        return np.asarray(image, dtype=np.float32) / 255.0
+
+
+class BulkScorer:
+    """
+    Pool of threads scoring batches of images, each thread with its own TFLite interpreter.
+    The number of images that failed to load is kept in failures.
+    """
+
+    def __init__(
+        self, model_path, workers=SCORING_WORKERS, batch_size=SCORING_BATCH_SIZE
+    ):
+        self.model_path = model_path
+        self.workers = workers or os.cpu_count() or 1
+        self.batch_size = batch_size
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.failures = 0
+
+    def interpreter(self):
+        if not hasattr(self.local, "model"):
+            self.local.model = TFLiteModel(self.model_path, num_threads=1)
+        return self.local.model
+
+    def score_batch(self, paths):
+        """
+        Score a batch of images, with a row of NaN for each image that failed to load.
+        """
+        images = []
+        loaded = []
+        for i, path in enumerate(paths):
+            try:
+                images.append(load_image(path))
+                loaded.append(i)
+            except Exception as e:
+                print(f"Failed to load {path}: {e}")
+        with self.lock:
+            self.failures += len(paths) - len(loaded)
+        scores = np.full((len(paths), len(CLASS_NAMES)), np.nan, dtype=np.float32)
+        if images:
+            scores[loaded] = self.interpreter().predict(np.stack(images))
+        return scores
+
+    def score(self, paths):
+        """
+        Score the images in order, a batch at a time.
+
+        Yields:
+            tuple: The paths of a batch and their scores (N, 7).
+        """
+        batches = [
+            paths[start : start + self.batch_size]
+            for start in range(0, len(paths), self.batch_size)
+        ]
+        with ThreadPoolExecutor(self.workers) as executor:
+            # Only a few batches are submitted ahead, so the memory doesn't grow with the images
+            pending = []
+            for batch in batches:
+                pending.append((batch, executor.submit(self.score_batch, batch)))
+                if len(pending) > 2 * self.workers:
+                    batch, future = pending.pop(0)
+                    yield batch, future.result()
+            for batch, future in pending:
+                yield batch, future.result()
+
+
+@instrumented(images=len)
+def score_files(paths, model_path=None, workers=SCORING_WORKERS):
+    """
+    Score some images with a TFLite model (the latest deployed one by default).
+
+    Returns:
+        np.ndarray: The scores of the 7 classes of each image (N, 7), NaN for the images that failed.
+    """
+    model_path = model_path or latest_model()
+    if model_path is None:
+        raise FileNotFoundError(f"No deployed model found in {DEPLOY_PATH}")
+    scorer = BulkScorer(model_path, workers)
+    scores = [batch for _, batch in scorer.score(paths)]
+    if scorer.failures:
+        print(f"Failed to score {scorer.failures} of {len(paths)} images.")
+    if not scores:
+        return np.zeros((0, len(CLASS_NAMES)), dtype=np.float32)
+    return np.concatenate(scores)
+
+
+def score_to_csv(
+    source,
+    output,
+    model_path=None,
+    workers=SCORING_WORKERS,
+    batch_size=SCORING_BATCH_SIZE,
+):
+    """
+    Score the images of a folder or manifest, writing a row per image with the scores of each class.
+
+    Returns:
+        int: The number of images scored.
+    """
+    model_path = model_path or latest_model()
+    if model_path is None:
+        raise FileNotFoundError(f"No deployed model found in {DEPLOY_PATH}")
+    paths = list_sources(source)
+    print(f"Scoring {len(paths)} images with {model_path}")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output), exist_ok=True)
+    with open(output, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["path", *CLASS_NAMES])
+        scorer = BulkScorer(model_path, workers, batch_size)
+        for batch, scores in scorer.score(paths):
+            writer.writerows(
+                [path, *map("{:.6f}".format, row)] for path, row in zip(batch, scores)
+            )
+    if scorer.failures:
+        print(f"Failed to score {scorer.failures} of {len(paths)} images.")
+    return len(paths)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Score images with a TFLite model.")
+    parser.add_argument("source", help="A folder of images or a manifest of paths")
+    parser.add_argument("--output", default="scores.csv")
+    parser.add_argument("--model", help="The .tflite model (default latest deployed)")
+    parser.add_argument("--workers", type=int, default=SCORING_WORKERS)
+    parser.add_argument("--batch-size", type=int, default=SCORING_BATCH_SIZE)
+    args = parser.parse_args()
+    count = score_to_csv(
+        args.source, args.output, args.model, args.workers, args.batch_size
+    )
+    print(f"Scored {count} images to {args.output}")
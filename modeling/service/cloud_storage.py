@@ -2,22 +2,28 @@
 Module used for accessing remote storage from Firebase (using the Firebase Admin SDK) and from Roboflow.
 """
 
+import base64
 import csv
+import functools
+import hashlib
+import json
 import os
 import shutil
-
-import firebase_admin
-import roboflow
-from firebase_admin import credentials, ml, storage
+from concurrent.futures import ThreadPoolExecutor
 
 from options import (
+    FIREBASE_DELETE_BATCH_SIZE,
+    FIREBASE_DOWNLOAD_WORKERS,
+    FIREBASE_MANIFEST_PATH,
+    FIREBASE_PAGE_SIZE,
     FIREBASE_SDK_ADMIN_FILE_PATH,
     FIREBASE_STORAGE_BUCKET_NAME,
     RAW_PATH,
     ROBOFLOW_API_KEY,
+    ROBOFLOW_CACHE_PATH,
     SPLIT_NAMES,
-    TEMP_PATH,
 )
+from service.instrumentation import instrumented
 
 ROBOFLOW_WELDING_DATASET_WORKSPACE = "welding-2bplp"
 ROBOFLOW_WELDING_DATASET_PROJECT = "weld-quality-inspection-rei9l"
@@ -31,6 +37,10 @@ def init_firebase_storage():
     Returns:
         firebase_admin.storage.bucket.Bucket: The initialized Firebase storage bucket.
     """
+    # Imported here, as firebase_admin.ml loads TensorFlow and only the Firebase paths need it
+    import firebase_admin
+    from firebase_admin import credentials, storage
+
     cred = credentials.Certificate(FIREBASE_SDK_ADMIN_FILE_PATH)
     firebase_admin.initialize_app(
         cred, {"storageBucket": f"{FIREBASE_STORAGE_BUCKET_NAME}.appspot.com"}
@@ -75,62 +85,336 @@ def delete_content(storage, filename):
     print(f"File {filename} deleted")
 
 
-def download_roboflow(path=RAW_PATH):
+def roboflow_downloader(
+    workspace=ROBOFLOW_WELDING_DATASET_WORKSPACE,
+    project=ROBOFLOW_WELDING_DATASET_PROJECT,
+    version=ROBOFLOW_WELDING_DATASET_VERSION,
+):
+    """
+    Gets a function downloading a version of a Roboflow dataset to a folder (a folder per split with
+    its images and _classes.csv).
+    """
+
+    def download(location):
+        import roboflow
+
+        rf = roboflow.Roboflow(api_key=ROBOFLOW_API_KEY)
+        dataset = rf.workspace(workspace).project(project).version(version)
+        dataset.download(model_format="multiclass", location=location)
+
+    return download
+
+
+def roboflow_cache(
+    downloader=None,
+    cache_path=ROBOFLOW_CACHE_PATH,
+    workspace=ROBOFLOW_WELDING_DATASET_WORKSPACE,
+    project=ROBOFLOW_WELDING_DATASET_PROJECT,
+    version=ROBOFLOW_WELDING_DATASET_VERSION,
+):
+    """
+    Gets the folder of a dataset version in the local cache, downloading it only if it is not cached yet.
+    The version is downloaded to a temporary folder and renamed when complete, so an interrupted
+    download is never taken as cached.
+
+    Args:
+        downloader (function): Downloads the dataset to a folder (default from the Roboflow API).
+        cache_path (str): The folder of the cached datasets, as <workspace>/<project>/<version>.
+
+    Returns:
+        str: The folder of the dataset version.
+    """
+    folder = os.path.join(cache_path, workspace, project, str(version))
+    if os.path.isdir(folder):
+        print(f"Using the cached Roboflow dataset {folder}")
+        return folder
+    if downloader is None:
+        downloader = roboflow_downloader(workspace, project, version)
+    temp_folder = f"{folder}.tmp"
+    shutil.rmtree(temp_folder, ignore_errors=True)
+    os.makedirs(os.path.dirname(folder), exist_ok=True)
+    downloader(temp_folder)
+    os.replace(temp_folder, folder)
+    return folder
+
+
+def read_split_classes(folder, split):
+    """
+    Read the _classes.csv of a split.
+
+    Returns:
+        list: The image path and the joined labels of each row (None if the split has no csv).
+    """
+    try:
+        with open(os.path.join(folder, split, "_classes.csv"), mode="r") as csvfile:
+            reader = csv.reader(csvfile)
+            next(reader)  # Skip the header row
+            return [
+                # First is the file name.
+                (
+                    os.path.join(folder, split, row[0]),
+                    "_".join(r.strip() for r in row[1:]),
+                )
+                for row in reader
+            ]
+    except FileNotFoundError:
+        print(f"Error: {split} split index not found.")
+        return None
+
+
+def link_file(source, destination):
+    """
+    Place a file by hard linking it, copying it only if the folders are in different file systems.
+    """
+    if os.path.exists(destination):
+        os.remove(destination)
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copy(source, destination)
+
+
+def link_split(rows, first, path):
+    """
+    Link the images of a split to the path, numbering them from first.
+
+    Returns:
+        list: The names of the linked images.
+    """
+    names = []
+    for count, (image_path, classes) in enumerate(rows, first):
+        dest_name = f"{count}_0_{classes}.jpg"  # All are non-background.
+        link_file(image_path, os.path.join(path, dest_name))
+        names.append(dest_name)
+    return names
+
+
+@instrumented()
+def download_roboflow(
+    path=RAW_PATH, index=None, downloader=None, cache_path=ROBOFLOW_CACHE_PATH
+):
     """
     Downloads the Roboflow Welding dataset to the specified path.
+    The dataset version is downloaded once to the local cache, and its images are hard linked to the path.
+    The splits are processed in parallel, numbering the images in the order of the splits.
 
     Args:
         path (str): The path to save the downloaded dataset to.
-    """
-    rf = roboflow.Roboflow(api_key=ROBOFLOW_API_KEY)
-    project = rf.workspace(ROBOFLOW_WELDING_DATASET_WORKSPACE).project(
-        ROBOFLOW_WELDING_DATASET_PROJECT
-    )
-    version = project.version(ROBOFLOW_WELDING_DATASET_VERSION)
-    version.download(model_format="multiclass", location=TEMP_PATH)
-    # Process each split index csv
-    count = 0
-    for split in SPLIT_NAMES:
-        try:
-            csv_path = os.path.join(TEMP_PATH, split, "_classes.csv")
-            with open(csv_path, mode="r") as csvfile:
-                reader = csv.reader(csvfile)
-                next(reader)  # Skip the header row
-                for row in reader:
-                    image_name = row[0]
-                    image_path = os.path.join(TEMP_PATH, split, image_name)
-                    count += 1
-                    classes = "_".join(
-                        [r.strip() for r in row[1:]]
-                    )  # First is the file name.
-                    dest_name = f"{count}_0_{classes}.jpg"  # All are non-background.
-                    dest_path = os.path.join(path, dest_name)
-                    shutil.copy(image_path, dest_path)
-        except FileNotFoundError:
-            print(f"Error: {split} split index not found.")
-    shutil.rmtree(TEMP_PATH)
-    return count
+        index (DatasetIndex): The dataset index to add the downloaded images to.
+        downloader (function): Downloads the dataset to a folder (default from the Roboflow API).
+        cache_path (str): The folder of the cached datasets.
 
+    Returns:
+        int: The number of images.
+    """
+    folder = roboflow_cache(downloader, cache_path)
+    with ThreadPoolExecutor(max_workers=len(SPLIT_NAMES)) as executor:
+        splits = list(
+            executor.map(functools.partial(read_split_classes, folder), SPLIT_NAMES)
+        )
+        splits = [rows for rows in splits if rows is not None]
+        firsts = [1]
+        for rows in splits[:-1]:
+            firsts.append(firsts[-1] + len(rows))
+        linked = executor.map(link_split, splits, firsts, [path] * len(splits))
+        names = [name for split_names in linked for name in split_names]
+    if index is not None:
+        index.add(path, names, "raw", source="roboflow")
+    return len(names)
+
+
+def file_md5(path):
+    """
+    Gets the MD5 of a local file encoded in base64, as Cloud Storage reports it.
+    """
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            md5.update(chunk)
+    return base64.b64encode(md5.digest()).decode()
 
-def download_firebase(path=RAW_PATH):
-    bucket = init_firebase_storage()
-    count = 0
 
-    blobs = bucket.list_blobs()
-    blobs = [blob for blob in blobs if blob.name.endswith(".jpg")]
-    path = "data/raw"
-    os.makedirs(path, exist_ok=True)
+def load_manifest(manifest_path=FIREBASE_MANIFEST_PATH):
+    """
+    Reads the last state of each blob recorded in the download manifest.
 
+    Returns:
+        dict: With the blob names as keys and their last record ({"md5", "state"}) as values.
+    """
+    manifest = {}
+    try:
+        with open(manifest_path, "r") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:  # Partial line written when the run was interrupted
+                    continue
+                manifest[record["name"]] = record
+    except FileNotFoundError:
+        pass
+    return manifest
+
+
+def record_manifest(manifest_file, blobs, state):
+    """
+    Appends the new state of the blobs to the download manifest.
+    """
     for blob in blobs:
-        file_path = os.path.join(path, blob.name)
+        record = {"name": blob.name, "md5": blob.md5_hash, "state": state}
+        manifest_file.write(json.dumps(record) + "\n")
+    manifest_file.flush()
+
+
+def compact_manifest(manifest_path=FIREBASE_MANIFEST_PATH):
+    """
+    Rewrites the download manifest with only the last record of the blobs not deleted yet,
+    so it doesn't grow with every run while some downloads keep failing.
+    The new manifest is written to a temporary file and renamed, so a crash never loses it.
+
+    Returns:
+        int: The number of records kept.
+    """
+    pending = [
+        record
+        for record in load_manifest(manifest_path).values()
+        if record["state"] != "deleted"
+    ]
+    temp_path = f"{manifest_path}.tmp"
+    with open(temp_path, "w") as f:
+        for record in pending:
+            f.write(json.dumps(record) + "\n")
+    os.replace(temp_path, manifest_path)
+    return len(pending)
+
+
+def verify_download(blob, file_path):
+    """
+    Checks that the local file is the same as the blob (by MD5, or by size if the blob has none).
+    """
+    if not os.path.isfile(file_path):
+        return False
+    if blob.md5_hash:
+        return file_md5(file_path) == blob.md5_hash
+    return os.path.getsize(file_path) == blob.size
+
+
+def download_blob(blob, path, manifest):
+    """
+    Downloads a blob to the folder, unless a previous run already downloaded it.
+    A failed download (e.g., a network error) or an unverified file is removed, so it isn't processed.
+
+    Returns:
+        bool: True if the local file is verified to match the blob.
+    """
+    file_path = os.path.join(path, blob.name)
+    previous = manifest.get(blob.name)
+    if (
+        previous
+        and previous["md5"] == blob.md5_hash
+        and verify_download(blob, file_path)
+    ):
+        return True
+    try:
         blob.download_to_filename(file_path)
-        blob.delete()
-        count += 1
+        if verify_download(blob, file_path):
+            return True
+        print(f"Downloaded {blob.name} doesn't match its checksum.")
+    except Exception as e:
+        print(f"Failed to download {blob.name}: {e}")
+    if os.path.isfile(file_path):
+        os.remove(file_path)
+    return False
+
+
+def delete_blobs(bucket, blobs):
+    """
+    Deletes the blobs from the bucket in a single batch request.
+    """
+    with bucket.client.batch():
+        for blob in blobs:
+            blob.delete()
+
+
+@instrumented()
+def download_firebase(
+    path=RAW_PATH,
+    bucket=None,
+    workers=FIREBASE_DOWNLOAD_WORKERS,
+    manifest_path=FIREBASE_MANIFEST_PATH,
+    index=None,
+):
+    """
+    Downloads the images uploaded to Firebase and deletes them from the bucket.
 
+    The bucket is listed page by page and each page is downloaded by a pool of threads.
+    Blobs are only deleted (in batches) after the checksum of their local copy is verified.
+    Every step is recorded in a manifest so an interrupted run resumes without downloading again.
+    When some images are kept, the manifest is rewritten with only their records at the end.
+
+    Args:
+        path (str): The folder to save the images to.
+        bucket: The storage bucket (by default the Firebase one).
+        workers (int): The number of images downloaded at the same time.
+        manifest_path (str): The file that records the downloaded, deleted and failed images.
+        index (DatasetIndex): The dataset index to add the downloaded images to (with their MD5).
+
+    Returns:
+        int: The number of images downloaded.
+    """
+    bucket = bucket or init_firebase_storage()
+    os.makedirs(path, exist_ok=True)
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    manifest = load_manifest(manifest_path)
+    count = 0
+    failed = 0
+    verified = []
+
+    with ThreadPoolExecutor(max_workers=workers) as executor, open(
+        manifest_path, "a"
+    ) as manifest_file:
+        for page in bucket.list_blobs(page_size=FIREBASE_PAGE_SIZE).pages:
+            blobs = [blob for blob in page if blob.name.endswith(".jpg")]
+            results = list(
+                executor.map(lambda b: download_blob(b, path, manifest), blobs)
+            )
+            downloaded = [blob for blob, ok in zip(blobs, results) if ok]
+            record_manifest(manifest_file, downloaded, "downloaded")
+            record_manifest(
+                manifest_file, [b for b, ok in zip(blobs, results) if not ok], "failed"
+            )
+            if index is not None:
+                index.add(
+                    path,
+                    [blob.name for blob in downloaded],
+                    "raw",
+                    source="firebase",
+                    hashes=[blob.md5_hash for blob in downloaded],
+                )
+            count += len(downloaded)
+            failed += len(blobs) - len(downloaded)
+            verified.extend(downloaded)
+            while len(verified) >= FIREBASE_DELETE_BATCH_SIZE:
+                batch = verified[:FIREBASE_DELETE_BATCH_SIZE]
+                delete_blobs(bucket, batch)
+                record_manifest(manifest_file, batch, "deleted")
+                verified = verified[FIREBASE_DELETE_BATCH_SIZE:]
+        if verified:
+            delete_blobs(bucket, verified)
+            record_manifest(manifest_file, verified, "deleted")
+
+    if failed:
+        print(
+            f"Kept {failed} images in Firebase after their download failed or didn't pass verification."
+        )
+        compact_manifest(manifest_path)  # Only the failed images are left to record
+    else:
+        os.remove(manifest_path)  # Everything is downloaded and deleted
     return count
 
 
 def upload_tflite(model_path, model_tags):
+    from firebase_admin import ml
+
     bucket = init_firebase_storage()
     model_name = os.path.splitext(os.path.basename(model_path))[0]
     source = ml.TFLiteGCSModelSource.from_tflite_model_file(model_path)
@@ -0,0 +1,322 @@
+"""
+Module for keeping an index of the images of the dataset in a SQLite database.
+
+Each image file of a stage folder (raw, processed, augmented, split) has a row with its id, source,
+content hash, labels, confidences, stage, split, date and path, and a row per class it belongs to.
+The stages list their folders from the index instead of scanning them, and the images can be looked up
+by class, split or date with the indexes of the database.
+The stages keep the index up to date as they change the folders, and a folder is scanned again when its
+modification time changes (e.g., after images are copied into it without the index), adding only the
+missing images and removing the deleted ones.
+"""
+
+import os
+import sqlite3
+from datetime import datetime
+
+from options import CLASS_NAMES, CLASS_THRESHOLD, DATASET_INDEX_PATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    source TEXT,
+    hash TEXT,
+    labels TEXT NOT NULL,
+    confidences TEXT,
+    stage TEXT NOT NULL,
+    split TEXT,
+    date TEXT NOT NULL,
+    path TEXT NOT NULL,
+    PRIMARY KEY (folder, name)
+);
+CREATE TABLE IF NOT EXISTS image_classes (
+    folder TEXT NOT NULL,
+    name TEXT NOT NULL,
+    class_name TEXT NOT NULL,
+    PRIMARY KEY (class_name, folder, name),
+    FOREIGN KEY (folder, name) REFERENCES images (folder, name)
+        ON DELETE CASCADE ON UPDATE CASCADE
+);
+CREATE TABLE IF NOT EXISTS folders (folder TEXT PRIMARY KEY, mtime INTEGER);
+CREATE INDEX IF NOT EXISTS images_stage ON images (stage);
+CREATE INDEX IF NOT EXISTS images_split ON images (split);
+CREATE INDEX IF NOT EXISTS images_date ON images (date);
+CREATE INDEX IF NOT EXISTS image_classes_image ON image_classes (folder, name);
+"""
+
+
+def parse_image_name(name):
+    """
+    Parse an image name formatted as <id>_<class1>_..._<class7>.jpg, where each class may have
+    its confidence as <label>-<confidence>.
+
+    Returns:
+        str: The id of the image.
+        str: The labels joined by "_".
+        str: The confidences joined by "_" (None if the name has none).
+        list: The names of the classes of the image.
+    """
+    parts = os.path.splitext(os.path.basename(name))[0].split("_")
+    labels = []
+    confidences = []
+    for part in parts[1:]:
+        label, _, confidence = part.partition("-")
+        labels.append(label)
+        confidences.append(confidence)
+    classes = [
+        class_name
+        for class_name, label in zip(CLASS_NAMES, labels)
+        if float(label) >= CLASS_THRESHOLD
+    ]
+    return (
+        parts[0],
+        "_".join(labels),
+        "_".join(confidences) if any(confidences) else None,
+        classes,
+    )
+
+
+def normalize_folder(folder):
+    return os.path.normpath(str(folder))
+
+
+def folder_mtime(folder):
+    """
+    Gets the modification time of a folder in ns, which changes when files are added, removed or renamed.
+    """
+    try:
+        return os.stat(folder).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+class DatasetIndex:
+    """
+    SQLite index of the images of the dataset, one row per image file and folder.
+    """
+
+    def __init__(self, path=DATASET_INDEX_PATH):
+        if os.path.dirname(str(path)):
+            os.makedirs(os.path.dirname(str(path)), exist_ok=True)
+        # The shards of the collection flows write to the index at the same time
+        self.connection = sqlite3.connect(str(path), timeout=60)
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.executescript(SCHEMA)
+        # Indexes created before the folders had their mtime
+        cursor = self.connection.execute("PRAGMA table_info(folders)")
+        if "mtime" not in [row[1] for row in cursor]:
+            with self.connection:
+                self.connection.execute("ALTER TABLE folders ADD COLUMN mtime INTEGER")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.connection.close()
+
+    def add(
+        self, folder, names, stage, source=None, split=None, hashes=None, paths=None
+    ):
+        """
+        Add (or replace) the rows of some images of a folder.
+
+        Args:
+            folder (str): The folder of the images.
+            names (list): The file names of the images.
+            stage (str): The stage of the images (raw, processed, augmented or split).
+            source (str): Where the images come from (e.g., firebase, roboflow, initial).
+            split (str): The split of the images, if any.
+            hashes (list): The hash of the content of each image, if known.
+            paths (list): The path of each file, if not <folder>/<name> (e.g., a class folder).
+
+        Returns:
+            int: The number of rows added.
+        """
+        folder = normalize_folder(folder)
+        date = datetime.now().strftime("%Y%m%d")
+        rows = []
+        classes = []
+        for i, name in enumerate(names):
+            try:
+                image_id, labels, confidences, image_classes = parse_image_name(name)
+            except ValueError:  # Not named as a labeled image
+                continue
+            path = paths[i] if paths else os.path.join(folder, name)
+            content_hash = hashes[i] if hashes else None
+            rows.append(
+                (folder, name, image_id, source, content_hash, labels, confidences)
+                + (stage, split, date, path)
+            )
+            classes.extend((folder, name, class_name) for class_name in image_classes)
+        with self.connection:
+            self.connection.executemany(
+                "DELETE FROM images WHERE folder = ? AND name = ?",
+                [row[:2] for row in rows],
+            )
+            self.connection.executemany(
+                "INSERT INTO images VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO image_classes VALUES (?, ?, ?)", classes
+            )
+        return len(rows)
+
+    def remove(self, folder, names=None):
+        """
+        Remove the rows of some images of a folder (all of them if names is None).
+        """
+        folder = normalize_folder(folder)
+        with self.connection:
+            if names is None:
+                self.connection.execute(
+                    "DELETE FROM images WHERE folder = ?", (folder,)
+                )
+            else:
+                self.connection.executemany(
+                    "DELETE FROM images WHERE folder = ? AND name = ?",
+                    [(folder, name) for name in names],
+                )
+
+    def rename(self, folder, renames):
+        """
+        Update the names of renamed images, keeping the rest of their data (e.g., the confidences).
+        """
+        folder = normalize_folder(folder)
+        with self.connection:
+            self.connection.executemany(
+                "UPDATE images SET name = ?, path = ? WHERE folder = ? AND name = ?",
+                [(new, os.path.join(folder, new), folder, old) for old, new in renames],
+            )
+
+    def is_indexed(self, folder):
+        """
+        Check if the folder was scanned and hasn't changed since (by its modification time).
+        """
+        folder = normalize_folder(folder)
+        cursor = self.connection.execute(
+            "SELECT mtime FROM folders WHERE folder = ?", (folder,)
+        )
+        row = cursor.fetchone()
+        return row is not None and row[0] == folder_mtime(folder)
+
+    def sync_folder(self, folder, stage, source=None, split=None):
+        """
+        Scan a folder to add the images missing in the index and remove the deleted ones.
+        Then the folder is listed from the index.
+
+        Returns:
+            list: The file names of the images in the folder.
+        """
+        folder = normalize_folder(folder)
+        # Taken before listing, so the changes made meanwhile are scanned next time
+        mtime = folder_mtime(folder)
+        indexed = set(self.list_folder(folder, sync=False))
+        names = set(os.listdir(folder)) if os.path.isdir(folder) else set()
+        self.add(folder, sorted(names - indexed), stage, source, split)
+        # Only the files still missing, as a stage may have written some after the listing
+        deleted = [
+            name
+            for name in sorted(indexed - names)
+            if not os.path.exists(os.path.join(folder, name))
+        ]
+        self.remove(folder, deleted)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime)
+            )
+        return self.list_folder(folder, sync=False)
+
+    def sync_split(self, folder, split):
+        """
+        Scan a set of a split folder (with a folder per class) as sync_folder, if any of its folders
+        changed since the last scan. Each image has a single row, with the path of its first class folder.
+        """
+        folder = normalize_folder(folder)
+        class_dirs = [
+            os.path.join(folder, class_name)
+            for class_name in CLASS_NAMES
+            if os.path.isdir(os.path.join(folder, class_name))
+        ]
+        mtime = max(folder_mtime(path) or 0 for path in [folder, *class_dirs])
+        cursor = self.connection.execute(
+            "SELECT mtime FROM folders WHERE folder = ?", (folder,)
+        )
+        row = cursor.fetchone()
+        if row is not None and row[0] == mtime:
+            return
+        images = {}
+        for class_dir in class_dirs:
+            for name in os.listdir(class_dir):
+                images.setdefault(name, os.path.join(class_dir, name))
+        indexed = set(self.list_folder(folder, sync=False))
+        missing = sorted(set(images) - indexed)
+        paths = [images[name] for name in missing]
+        self.add(folder, missing, "split", split=split, paths=paths)
+        self.remove(folder, sorted(indexed - set(images)))
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?)", (folder, mtime)
+            )
+
+    def list_folder(self, folder, stage="raw", sync=True):
+        """
+        List the file names of the images of a folder, scanning it first if it changed since the last scan.
+        """
+        if sync and not self.is_indexed(folder):
+            return self.sync_folder(folder, stage)
+        cursor = self.connection.execute(
+            "SELECT name FROM images WHERE folder = ? ORDER BY name",
+            (normalize_folder(folder),),
+        )
+        return [name for (name,) in cursor]
+
+    def query(self, stage=None, split=None, class_name=None, date=None, folder=None):
+        """
+        Find the images by stage, split, class name, date (YYYYMMDD) and/or folder.
+
+        Returns:
+            list: The rows of the images as dicts.
+        """
+        query = "SELECT images.* FROM images"
+        conditions = []
+        values = []
+        if class_name is not None:
+            query += " JOIN image_classes USING (folder, name)"
+            conditions.append("class_name = ?")
+            values.append(class_name)
+        for column, value in [
+            ("stage", stage),
+            ("split", split),
+            ("date", date),
+            ("folder", normalize_folder(folder) if folder else None),
+        ]:
+            if value is not None:
+                conditions.append(f"images.{column} = ?")
+                values.append(value)
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        cursor = self.connection.execute(query + " ORDER BY images.path", values)
+        columns = [description[0] for description in cursor.description]
+        return [dict(zip(columns, row)) for row in cursor]
+
+
+def open_index(path=DATASET_INDEX_PATH):
+    """
+    Open the dataset index, or get None if it is disabled (empty path).
+    """
+    return DatasetIndex(path) if path else None
+
+
+def list_images(folder, index=None, stage="raw"):
+    """
+    List the files of a stage folder from the index, or scanning the folder without it.
+    """
+    if index is None:
+        return os.listdir(folder)
+    return index.list_folder(folder, stage)
@@ -0,0 +1,223 @@
+"""
+Module for monitoring the drift of the model from the feedback images over several days.
+
+Instead of keeping the actual classes and confidences of every image, the monitor keeps per day and class
+the confusion counts and the histograms of the confidences of the positive and negative images.
+The state has a fixed size per day, is saved to a small JSON file and is aggregated over sliding windows
+(e.g., the last 7 and 30 days) to compute the confusion counts and an approximate AUC of each class.
+"""
+
+import hashlib
+import json
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+
+from options import (
+    AUC_THRESHOLD,
+    CLASS_NAMES,
+    CLASS_THRESHOLD,
+    DRIFT_HISTOGRAM_BINS,
+    DRIFT_MIN_SAMPLES,
+    DRIFT_MONITOR_PATH,
+    DRIFT_WINDOWS,
+)
+from service.metric_monitoring import parse_feedback
+
+DAY_FORMAT = "%Y%m%d"
+COUNT_NAMES = ["TP", "FP", "TN", "FN"]
+# File names parsed at once, so the memory doesn't grow with the batch
+PARSE_CHUNK_SIZE = 10000
+
+
+def batch_fingerprint(files):
+    """
+    Gets an id of a batch of feedback files that doesn't depend on their order.
+    """
+    digest = hashlib.sha256()
+    for file in sorted(files):
+        digest.update(file.encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+
+def histogram_auc(positives, negatives):
+    """
+    Approximate the AUC from the histograms of the confidences of the positive and negative images.
+    Images in the same bin are counted as ties (half a correct order).
+
+    Args:
+        positives (np.ndarray): Array of shape (C, bins) with the counts of positive images.
+        negatives (np.ndarray): Array of shape (C, bins) with the counts of negative images.
+
+    Returns:
+        list: The AUC of each class (None if it has no positives or negatives).
+    """
+    negatives_below = np.cumsum(negatives, axis=1) - negatives
+    pairs = positives.sum(axis=1) * negatives.sum(axis=1)
+    correct = (positives * (negatives_below + negatives / 2)).sum(axis=1)
+    return [float(c / p) if p > 0 else None for c, p in zip(correct, pairs)]
+
+
+class DriftMonitor:
+    """
+    Persisted per-day confusion counts and confidence histograms of each class.
+
+    The state is {"bins": bins, "days": {<YYYYMMDD>: {"TP": [7], "FP": [7], "TN": [7], "FN": [7],
+    "positives": [7][bins], "negatives": [7][bins], "batches": [fingerprints]}}}.
+    Days older than the longest window are removed when saving.
+    """
+
+    def __init__(
+        self, path=DRIFT_MONITOR_PATH, bins=DRIFT_HISTOGRAM_BINS, windows=DRIFT_WINDOWS
+    ):
+        self.path = path
+        self.bins = bins
+        self.windows = windows
+        self.days = {}
+        try:
+            with open(path, "r") as f:
+                state = json.load(f)
+            if state.get("bins") == bins:
+                self.days = state["days"]
+            else:
+                print("Drift monitor reset after the number of histogram bins changed.")
+        except FileNotFoundError:
+            pass
+
+    def empty_day(self):
+        classes = len(CLASS_NAMES)
+        day = {name: [0] * classes for name in COUNT_NAMES}
+        day["positives"] = [[0] * self.bins for _ in range(classes)]
+        day["negatives"] = [[0] * self.bins for _ in range(classes)]
+        day["batches"] = []
+        return day
+
+    def has_batch(self, fingerprint):
+        return any(fingerprint in day["batches"] for day in self.days.values())
+
+    def update(self, actuals, confidences, day=None):
+        """
+        Add the feedback of some images to the counts of a day.
+
+        Args:
+            actuals (np.ndarray): Array of shape (N, 7) with the actual classes (0 or 1).
+            confidences (np.ndarray): Array of shape (N, 7) with the confidence of each class.
+            day (str): The day as YYYYMMDD (default today).
+        """
+        day = day or datetime.now().strftime(DAY_FORMAT)
+        counts = self.days.setdefault(day, self.empty_day())
+        positive = actuals == 1
+        predicted = confidences >= CLASS_THRESHOLD
+        masks = {
+            "TP": positive & predicted,
+            "FP": ~positive & predicted,
+            "TN": ~positive & ~predicted,
+            "FN": positive & ~predicted,
+        }
+        for name, mask in masks.items():
+            counts[name] = (np.array(counts[name]) + mask.sum(axis=0)).tolist()
+
+        # Index of the histogram bin of every class and confidence, flattened as class * bins + bin
+        bins = np.clip((confidences * self.bins).astype(np.int64), 0, self.bins - 1)
+        bins += np.arange(len(CLASS_NAMES)) * self.bins
+        size = len(CLASS_NAMES) * self.bins
+        for name, mask in [("positives", positive), ("negatives", ~positive)]:
+            histogram = np.bincount(bins[mask], minlength=size).reshape(-1, self.bins)
+            counts[name] = (np.array(counts[name]) + histogram).tolist()
+
+    def update_files(self, files, day=None):
+        """
+        Add a batch of feedback files (<id>_<actual>-<confidence>_...jpg) to the counts of a day.
+        A batch already added (with the same file names) is ignored, so runs can be repeated.
+
+        Returns:
+            int: The number of images added (0 if the batch was already added).
+        """
+        fingerprint = batch_fingerprint(files)
+        if self.has_batch(fingerprint):
+            print("Skipping feedback batch already added to the drift monitor.")
+            return 0
+        day = day or datetime.now().strftime(DAY_FORMAT)
+        total = 0
+        for start in range(0, len(files), PARSE_CHUNK_SIZE):
+            parsed, _, actuals, confidences = parse_feedback(
+                files[start : start + PARSE_CHUNK_SIZE]
+            )
+            self.update(actuals, confidences, day)
+            total += len(parsed)
+        self.days.setdefault(day, self.empty_day())["batches"].append(fingerprint)
+        return total
+
+    def aggregate(self, window, today=None):
+        """
+        Sum the counts of the days in a window.
+
+        Args:
+            window (int): The number of days, including today.
+            today (str): The last day of the window as YYYYMMDD (default today).
+
+        Returns:
+            dict: The confusion counts (arrays of 7) and histograms (arrays of 7 x bins).
+        """
+        end = datetime.strptime(today, DAY_FORMAT) if today else datetime.now()
+        start = (end - timedelta(days=window - 1)).strftime(DAY_FORMAT)
+        end = end.strftime(DAY_FORMAT)
+        empty = self.empty_day()
+        names = [*COUNT_NAMES, "positives", "negatives"]
+        total = {name: np.array(empty[name]) for name in names}
+        for day, counts in self.days.items():
+            if start <= day <= end:
+                for name in total:
+                    total[name] += np.array(counts[name])
+        return total
+
+    def summary(self, window, today=None):
+        """
+        Get the confusion counts, the number of images and the approximate AUC of each class in a window.
+        """
+        total = self.aggregate(window, today)
+        aucs = histogram_auc(total["positives"], total["negatives"])
+        return {
+            class_name: {
+                **{name: int(total[name][i]) for name in COUNT_NAMES},
+                "positives": int(total["positives"][i].sum()),
+                "negatives": int(total["negatives"][i].sum()),
+                "auc": aucs[i],
+            }
+            for i, class_name in enumerate(CLASS_NAMES)
+        }
+
+    def drift(self, today=None, threshold=AUC_THRESHOLD, min_samples=DRIFT_MIN_SAMPLES):
+        """
+        Find a class whose approximate AUC is below the threshold in any of the windows.
+        Classes with fewer than min_samples positive or negative images in the window are ignored.
+
+        Returns:
+            tuple: The window (days) and the class name with drift, or (None, None).
+        """
+        for window in self.windows:
+            for class_name, metrics in self.summary(window, today).items():
+                if (
+                    metrics["auc"] is not None
+                    and metrics["positives"] >= min_samples
+                    and metrics["negatives"] >= min_samples
+                    and metrics["auc"] < threshold
+                ):
+                    return window, class_name
+        return None, None
+
+    def save(self, today=None):
+        """
+        Save the state, removing the days older than the longest window.
+        """
+        end = datetime.strptime(today, DAY_FORMAT) if today else datetime.now()
+        oldest = (end - timedelta(days=max(self.windows) - 1)).strftime(DAY_FORMAT)
+        self.days = {day: c for day, c in sorted(self.days.items()) if day >= oldest}
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump({"bins": self.bins, "days": self.days}, f)
+        os.replace(temp_path, self.path)  # Never leave a partial state
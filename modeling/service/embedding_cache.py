@@ -0,0 +1,210 @@
+"""
+Module for retraining only the classifier head of the model on cached backbone embeddings.
+
+The model is split at its GlobalAveragePooling2D layer: the backbone (MobileNet and the pooling) turns
+each image into an embedding, and the head (the Dense and Dropout layers) classifies it.
+The embeddings are computed once per image and saved in <cache>/<backbone fingerprint>/, keyed by the
+hash of the image file. The fingerprint is a hash of the backbone weights, so the cache is reused while
+the backbone doesn't change (e.g., by every head retraining) and a retrained backbone gets a new one.
+The head model shares its layers with the full model, so training it updates the full model in place,
+ready for model_store and model_convert.
+"""
+
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+
+from options import (
+    CLASS_NAMES,
+    EMBEDDING_CACHE_PATH,
+    PREPROCESS_WORKERS,
+    TRAIN_BATCH_SIZE,
+)
+from service.image_transformations import divide_image_labels
+from service.model_registry import file_hash
+from service.tensor_store import decode_resized, list_split_images
+from service.tfrecord_dataset import label_vector
+
+EMBEDDINGS_FILE = "embeddings.npy"
+HASHES_FILE = "hashes.json"
+
+
+def split_model(model):
+    """
+    Split the model at its GlobalAveragePooling2D layer.
+
+    Returns:
+        tf.keras.Model: The backbone, from the images to the embeddings.
+        tf.keras.Model: The head, from the embeddings to the classes, sharing the layers of the model.
+    """
+    pooling = [
+        i
+        for i, layer in enumerate(model.layers)
+        if isinstance(layer, tf.keras.layers.GlobalAveragePooling2D)
+    ]
+    if not pooling:
+        raise ValueError("The model has no GlobalAveragePooling2D layer to split it.")
+    split = pooling[-1]
+    backbone = tf.keras.Model(model.inputs, model.layers[split].output)
+    embeddings = tf.keras.Input(shape=backbone.output.shape[1:])
+    x = embeddings
+    for layer in model.layers[split + 1 :]:
+        x = layer(x)
+    head = tf.keras.Model(embeddings, x)
+    return backbone, head
+
+
+def backbone_fingerprint(backbone):
+    """
+    Gets a hash of the weights of the backbone.
+    """
+    digest = hashlib.sha256()
+    for weights in backbone.get_weights():
+        digest.update(np.ascontiguousarray(weights).tobytes())
+    return digest.hexdigest()[:16]
+
+
+class EmbeddingCache:
+    """
+    Embeddings of the images computed by a backbone, saved as a float32 array with the image hash of each row.
+    """
+
+    def __init__(self, fingerprint, path=EMBEDDING_CACHE_PATH):
+        self.folder = os.path.join(path, fingerprint)
+        self.rows = {}
+        self.embeddings = None
+        self.new = []
+        try:
+            with open(os.path.join(self.folder, HASHES_FILE), "r") as f:
+                hashes = json.load(f)
+            self.embeddings = np.load(os.path.join(self.folder, EMBEDDINGS_FILE))
+            self.rows = {image_hash: i for i, image_hash in enumerate(hashes)}
+        except FileNotFoundError:
+            pass
+
+    def __contains__(self, image_hash):
+        return image_hash in self.rows
+
+    def get(self, hashes):
+        return self.embeddings[[self.rows[image_hash] for image_hash in hashes]]
+
+    def add(self, hashes, embeddings):
+        start = len(self.rows)
+        for i, image_hash in enumerate(hashes):
+            self.rows.setdefault(image_hash, start + i)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if self.embeddings is None:
+            self.embeddings = embeddings
+        else:
+            self.embeddings = np.concatenate([self.embeddings, embeddings])
+        self.new.extend(hashes)
+
+    def save(self):
+        if not self.new:
+            return
+        os.makedirs(self.folder, exist_ok=True)
+        hashes = sorted(self.rows, key=self.rows.get)
+        np.save(os.path.join(self.folder, f"tmp_{EMBEDDINGS_FILE}"), self.embeddings)
+        with open(os.path.join(self.folder, f"tmp_{HASHES_FILE}"), "w") as f:
+            json.dump(hashes, f)
+        # The hashes are replaced last, so they never point past the embeddings
+        os.replace(
+            os.path.join(self.folder, f"tmp_{EMBEDDINGS_FILE}"),
+            os.path.join(self.folder, EMBEDDINGS_FILE),
+        )
+        os.replace(
+            os.path.join(self.folder, f"tmp_{HASHES_FILE}"),
+            os.path.join(self.folder, HASHES_FILE),
+        )
+        self.new = []
+
+
+def compute_embeddings(
+    backbone,
+    paths,
+    cache,
+    batch_size=TRAIN_BATCH_SIZE,
+    workers=PREPROCESS_WORKERS,
+):
+    """
+    Get the embeddings of some images, running the backbone only on the images missing in the cache.
+
+    Returns:
+        np.ndarray: The embedding of each image (N, embedding size).
+    """
+    if not paths:
+        return np.zeros((0, backbone.output.shape[-1]), dtype=np.float32)
+    # PIL releases the GIL while decoding, so the threads decode in parallel
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        hashes = list(executor.map(file_hash, paths))
+        missing = sorted(
+            {image_hash: path for image_hash, path in zip(hashes, paths)}.items()
+        )
+        missing = [(h, path) for h, path in missing if h not in cache]
+        batch_size = int(batch_size)
+        for start in range(0, len(missing), batch_size):
+            batch = missing[start : start + batch_size]
+            images = np.stack(list(executor.map(decode_resized, [p for _, p in batch])))
+            embeddings = backbone.predict_on_batch(images.astype(np.float32) / 255.0)
+            cache.add([h for h, _ in batch], embeddings)
+    if missing:
+        print(f"Computed the embeddings of {len(missing)} images.")
+    cache.save()
+    return cache.get(hashes)
+
+
+def split_set(split_path):
+    """
+    Get the paths and multi-hot labels of the images of a set (a folder per class).
+    """
+    images = list_split_images(split_path)
+    names = sorted(images)
+    labels = np.zeros((len(names), len(CLASS_NAMES)), dtype=np.float32)
+    for i, name in enumerate(names):
+        labels[i] = label_vector(divide_image_labels(name)[1])
+    return [images[name] for name in names], labels
+
+
+def train_head(
+    model, split_path, epochs, cache_path=EMBEDDING_CACHE_PATH, verbose=1, sets=None
+):
+    """
+    Train only the head of the model on the cached embeddings of the train and valid sets of a split.
+    The layers of the head are shared with the model, so the model is updated in place.
+
+    Args:
+        sets (list): The paths and labels of the train and valid images, instead of the sets of the split
+            (e.g., of a replay sample).
+
+    Returns:
+        tf.keras.callbacks.History: The history of the training of the head.
+    """
+    backbone, head = split_model(model)
+    cache = EmbeddingCache(backbone_fingerprint(backbone), cache_path)
+    if sets is None:
+        sets = [split_set(f"{split_path}/train"), split_set(f"{split_path}/valid")]
+    (train_paths, y_train), (valid_paths, y_valid) = sets
+    x_train = compute_embeddings(backbone, list(train_paths), cache)
+    x_valid = compute_embeddings(backbone, list(valid_paths), cache)
+    print(f"Training the head on {len(x_train)} cached embeddings")
+    head.compile(
+        optimizer=tf.keras.optimizers.Adam(learning_rate=0.001),
+        loss=model.loss,
+        metrics=["accuracy", "auc"],
+    )
+    early_stopping = tf.keras.callbacks.EarlyStopping(
+        monitor="val_loss", patience=18, restore_best_weights=True
+    )
+    return head.fit(
+        x_train,
+        y_train,
+        batch_size=int(TRAIN_BATCH_SIZE),
+        epochs=epochs,
+        validation_data=(x_valid, y_valid) if len(x_valid) else None,
+        callbacks=[early_stopping] if len(x_valid) else [],
+        verbose=verbose,
+    )
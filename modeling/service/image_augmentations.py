@@ -1,4 +1,5 @@
 import random
+from functools import lru_cache
 
 import numpy as np
 from PIL import Image, ImageEnhance, ImageFilter
@@ -94,3 +95,227 @@ def random_noise(image):
     noise_functions = [gaussian_filter, poisson_noise, salt_and_pepper_noise]
     noise_function = random.choice(noise_functions)
     return noise_function(image)
+
+
+# Weights of the RGB channels for the grayscale conversion (same as PIL "L" mode).
+LUMA_WEIGHTS = np.array([[0.299], [0.587], [0.114]], dtype=np.float32)
+# Number of quantiles stored for each pixel value in the poisson noise table.
+POISSON_QUANTILES = 4096
+
+
+@lru_cache(maxsize=4)
+def poisson_table(scale=0.99, quantiles=POISSON_QUANTILES):
+    """
+    Build the inverse CDF table used for sampling poisson noise of every pixel value at once.
+
+    Returns:
+        np.ndarray: A flat uint8 array where the value at [pixel * quantiles + q] is the
+        noisy pixel for the q-th quantile of a poisson distribution with mean pixel * scale.
+    """
+    # Imported here, as only the batch augmentation needs scipy and it slows the start of the flows
+    from scipy import stats
+
+    means = np.arange(256) * scale
+    samples = np.arange(int(255 * scale + 12 * np.sqrt(255 * scale)) + 2)
+    cdf = np.cumsum(stats.poisson.pmf(samples, means[:, None]), axis=1)
+    targets = (np.arange(quantiles) + 0.5) / quantiles
+    table = np.stack([np.searchsorted(row, targets) for row in cdf])
+    return np.clip(table / scale, 0, 255).astype(np.uint8).ravel()
+
+
+class BatchAugmenter:
+    """
+    Vectorized version of the augmentation chain (rotation, flip, color jitter and noise).
+
+    The copies of the images are stacked as a single (N, H, W, 3) uint8 array and every
+    augmentation is applied to the whole stack at once. All the buffers are allocated once
+    for the given capacity and reused between batches.
+    """
+
+    def __init__(self, capacity, height, width, seed=None):
+        """
+        Args:
+            capacity (int): The maximum number of images augmented together.
+            height (int): The height of the images.
+            width (int): The width of the images.
+            seed (int): The seed of the random generator (None = not reproducible).
+        """
+        self.rng = np.random.default_rng(seed)
+        self.batch = np.empty((capacity, height, width, 3), dtype=np.uint8)
+        self.output = np.empty_like(self.batch)
+        self.work = np.empty(self.batch.shape, dtype=np.float32)
+        self.gray = np.empty((capacity, height, width, 1), dtype=np.float32)
+        self.source_x = np.empty((capacity, height, width), dtype=np.float32)
+        self.source_y = np.empty_like(self.source_x)
+        self.index = np.empty((capacity, height, width), dtype=np.intp)
+        self.outside = np.empty((capacity, height, width), dtype=bool)
+        # Distance of each pixel to the center of the image, used for rotating.
+        ys, xs = np.mgrid[0:height, 0:width].astype(np.float32)
+        self.offset_x = xs - (width - 1) / 2
+        self.offset_y = ys - (height - 1) / 2
+
+    def load(self, images, copies=1):
+        """
+        Stack the copies of each image into the input buffer.
+
+        Args:
+            images (list): Arrays of shape (H, W, 3) and type uint8.
+            copies (int): The number of copies of each image.
+
+        Returns:
+            int: The number of images stacked.
+        """
+        for i, image in enumerate(images):
+            self.batch[i * copies : (i + 1) * copies] = image
+        return len(images) * copies
+
+    def augment(self, images, copies=1):
+        """
+        Apply the whole augmentation chain to the copies of the images.
+
+        Args:
+            images (list): Arrays of shape (H, W, 3) and type uint8.
+            copies (int): The number of augmented versions generated from each image.
+
+        Returns:
+            np.ndarray: A view of the output buffer with the augmented images, ordered as
+            all the copies of the first image, then the ones of the second, and so on.
+            It is overwritten by the next call.
+        """
+        total = self.load(images, copies)
+        output = self.output[:total]
+        self.rotation(self.batch[:total], output)
+        self.flip(output)
+        self.color_jitter(output)
+        self.noise(output)
+        return output
+
+    def rotation(self, batch, output, range=12):
+        """
+        Apply a random arbitrary rotation to each image of the batch into the output.
+        """
+        total, height, width, _ = batch.shape
+        angles = np.deg2rad(self.rng.uniform(-range, range, total)).astype(np.float32)
+        cos = np.cos(angles)[:, None, None]
+        sin = np.sin(angles)[:, None, None]
+        source_x = self.source_x[:total]
+        source_y = self.source_y[:total]
+        temp = self.gray[:total, ..., 0]
+        # Inverse mapping of a counter-clockwise rotation, as PIL does.
+        np.multiply(cos, self.offset_x, out=source_x)
+        np.multiply(sin, self.offset_y, out=temp)
+        source_x -= temp
+        source_x += (width - 1) / 2
+        np.multiply(sin, self.offset_x, out=source_y)
+        np.multiply(cos, self.offset_y, out=temp)
+        source_y += temp
+        source_y += (height - 1) / 2
+        np.rint(source_x, out=source_x)
+        np.rint(source_y, out=source_y)
+        # Pixels coming from outside the image are left black.
+        outside = self.outside[:total]
+        np.less(source_x, 0, out=outside)
+        outside |= source_x > width - 1
+        outside |= source_y < 0
+        outside |= source_y > height - 1
+        np.clip(source_x, 0, width - 1, out=source_x)
+        np.clip(source_y, 0, height - 1, out=source_y)
+        index = self.index[:total]
+        np.copyto(index, source_y, casting="unsafe")
+        index *= width
+        np.add(index, source_x, out=index, casting="unsafe")
+        index += (np.arange(total) * height * width)[:, None, None]
+        np.take(batch.reshape(-1, 3), index, axis=0, out=output, mode="clip")
+        output[outside] = 0
+        return output
+
+    def flip(self, batch, chance=0.5):
+        """
+        Apply randomly horizontal and vertical flips to the images of the batch.
+        """
+        horizontal = np.flatnonzero(self.rng.random(len(batch)) < chance)
+        batch[horizontal] = batch[horizontal, :, ::-1]
+        vertical = np.flatnonzero(self.rng.random(len(batch)) < chance)
+        batch[vertical] = batch[vertical, ::-1]
+        return batch
+
+    def color_jitter(self, batch, range=0.001):
+        """
+        Apply random color jitter to the images of the batch (brightness, saturation, contrast).
+        """
+        total = len(batch)
+        factors = 1 + self.rng.uniform(-range, range, (3, total, 1, 1, 1))
+        brightness, color, contrast = factors.astype(np.float32)
+        work = self.work[:total]
+        gray = self.gray[:total]
+        np.multiply(batch, brightness, out=work)
+        # Blend with the grayscale image, as ImageEnhance.Color.
+        np.matmul(work, LUMA_WEIGHTS, out=gray)
+        work -= gray
+        work *= color
+        work += gray
+        # Blend with the mean gray level, as ImageEnhance.Contrast.
+        np.matmul(work, LUMA_WEIGHTS, out=gray)
+        mean = gray.mean(axis=(1, 2, 3), keepdims=True)
+        work -= mean
+        work *= contrast
+        work += mean
+        np.clip(work, 0, 255, out=work)
+        np.copyto(batch, work, casting="unsafe")
+        return batch
+
+    def noise(self, batch):
+        """
+        Apply randomly to each image a noise from the available (gaussian, poisson, or s&p).
+        """
+        choices = self.rng.integers(0, 3, len(batch))
+        self.gaussian_filter(batch, np.flatnonzero(choices == 0))
+        self.poisson_noise(batch, np.flatnonzero(choices == 1))
+        self.salt_and_pepper_noise(batch, np.flatnonzero(choices == 2))
+        return batch
+
+    def gaussian_filter(self, batch, indices, radius=1):
+        """
+        Apply a gaussian smooth to the selected images of the batch.
+        """
+        if len(indices) == 0:
+            return batch
+        # Imported here, as only the batch augmentation needs scipy and it slows the start of the flows
+        from scipy import ndimage
+
+        work = self.work[: len(indices)]
+        np.copyto(work, batch[indices])
+        ndimage.gaussian_filter(
+            work, sigma=(0, radius, radius, 0), mode="nearest", output=work
+        )
+        np.rint(work, out=work)
+        batch[indices] = work
+        return batch
+
+    def poisson_noise(self, batch, indices, scale=0.99):
+        """
+        Apply poisson noise to the selected images of the batch.
+        """
+        if len(indices) == 0:
+            return batch
+        # Each pixel takes a random quantile from the distribution of its value.
+        selected = batch[indices]
+        index = self.rng.integers(0, POISSON_QUANTILES, selected.shape)
+        index += POISSON_QUANTILES * selected.astype(np.intp)
+        batch[indices] = poisson_table(scale)[index]
+        return batch
+
+    def salt_and_pepper_noise(self, batch, indices, amount=0.001):
+        """
+        Apply salt and pepper noise to the selected images of the batch.
+        """
+        if len(indices) == 0:
+            return batch
+        _, height, width, channels = batch.shape
+        points = int(np.ceil(amount * height * width * channels * 0.5))
+        images = indices[:, None]
+        for value in (255, 0):  # Salt, then pepper
+            rows = self.rng.integers(0, height - 1, (len(indices), points))
+            cols = self.rng.integers(0, width - 1, (len(indices), points))
+            batch[images, rows, cols] = value
+        return batch
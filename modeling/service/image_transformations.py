@@ -1,22 +1,44 @@
+import hashlib
+import io
 import os
+import queue
+import random
 import shutil
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+import numpy as np
 from PIL import Image
-from sklearn.model_selection import train_test_split
 
 from options import (
+    AUGMENTATION_BATCH_SIZE,
+    AUGMENTATION_ENGINE,
     AUGMENTATION_INCREASE,
+    AUGMENTATION_SEED,
     AUGMENTED_PATH,
     CLASS_NAMES,
     CLASS_THRESHOLD,
+    GAUSSIAN_FILTER_RADIUS,
+    MEDIAN_FILTER_SIZE,
+    PREPROCESS_CACHE_PATH,
+    PREPROCESS_CACHE_SIZE,
+    PREPROCESS_CHUNK_SIZE,
+    PREPROCESS_WORKERS,
     PROCESSED_PATH,
     RAW_PATH,
+    SPLIT_FORMAT,
+    SPLIT_MODE,
     SPLIT_NAMES,
     SPLIT_TEST,
+    SPLIT_TRAIN,
     SPLIT_VALID,
+    STREAM_QUEUE_SIZE,
     TARGET_SIZE,
+    TEMP_PATH,
 )
 from service.image_augmentations import (
+    BatchAugmenter,
     gaussian_filter,
     median_filter,
     random_color_jitter,
@@ -24,6 +46,9 @@ from service.image_augmentations import (
     random_noise,
     random_rotation,
 )
+from service.dataset_index import list_images
+from service.instrumentation import instrumented
+from service.preprocess_cache import PreprocessCache
 
 
 def divide_image_labels(image_path):
@@ -53,6 +78,13 @@ def divide_class_names(labels):
     return [CLASS_NAMES[int(label)] for label in accepted]
 
 
+def label_class_names(labels):
+    """
+    Gets the class names from the labels, ignoring the confidences (<label>-<confidence>) if present.
+    """
+    return divide_class_names([l.split("-")[0] if "-" in l else l for l in labels])
+
+
 def load_image(path):
     """
     Read an image from the specified path.
@@ -81,91 +113,352 @@ def normalize_image(image):
     return image / 255.0
 
 
-def preprocess_images():
+def preprocess_image(image):
     """
-    Runs the preprocessing step of the dataset.
-    Files are read from the RAW_PATH, processed, and saved to the PROCESSED_PATH.
+    Resize the image to the model size and remove its noise.
+    """
+    image = resize_image(image, TARGET_SIZE)
+    image = median_filter(image, MEDIAN_FILTER_SIZE)
+    image = gaussian_filter(image, GAUSSIAN_FILTER_RADIUS)
+    return image
+
+
+def processed_name(path):
+    """
+    Gets the name of the processed image of a raw image.
+    """
+    name, labels = divide_image_labels(path)
+    return f"{name}_{'_'.join(labels)}.jpg"
+
+
+def index_split(index, split_dir, images):
+    """
+    Add the split images to the dataset index.
+
+    Args:
+        index (DatasetIndex): The dataset index.
+        split_dir (str): The folder with the train, valid, and test sets.
+        images (list): With the split, file name and path of each image.
+    """
+    for split_type in SPLIT_NAMES:
+        rows = [(name, path) for split, name, path in images if split == split_type]
+        if rows:
+            names, paths = zip(*rows)
+            index.add(
+                os.path.join(split_dir, split_type),
+                names,
+                "split",
+                split=split_type,
+                paths=paths,
+            )
+
+
+def preprocess_cached(content, cache):
+    """
+    Preprocess an image, reusing the result stored in the cache for the same raw image if any.
+
+    Args:
+        content (bytes): The raw image file.
+        cache (PreprocessCache): The cache of preprocessed images.
+
+    Returns:
+        bytes: The processed image encoded as JPEG.
+        Image: The processed image before encoding, or None if it was found in the cache.
+    """
+    key = cache.key(content)
+    processed = cache.get(key)
+    if processed is not None:
+        return processed, None
+    image = preprocess_image(load_image(io.BytesIO(content)))
+    buffer = io.BytesIO()
+    image.save(buffer, format="JPEG")
+    processed = buffer.getvalue()
+    cache.put(key, processed)
+    return processed, image
+
+
+def preprocess_chunk(paths, source=RAW_PATH, destination=PROCESSED_PATH, cache=None):
+    """
+    Preprocess a group of images, collecting the failures instead of stopping.
+
+    Args:
+        paths (list): The names of the images inside the source folder.
+        source (str): The folder to read the images from.
+        destination (str): The folder to save the processed images to.
+        cache (PreprocessCache): The cache of preprocessed images (None = not cached).
 
     Returns:
         int: The number of images processed.
+        list: With (name, error) pairs for the images that failed.
+        int: The number of images found in the cache.
     """
-    paths = os.listdir(RAW_PATH)
     count = 0
-    total = len(paths)
+    failures = []
+    hits = cache.hits if cache is not None else 0
     for path in paths:
-        # print(f"Preprocessing image {1+count}/{total}")
-        name, labels = divide_image_labels(path)
-        image = load_image(os.path.join(RAW_PATH, path))
-        image = resize_image(image, TARGET_SIZE)
-        image = median_filter(image)
-        image = gaussian_filter(image)
-        save_image(
-            image, os.path.join(PROCESSED_PATH, f"{name}_{'_'.join(labels)}.jpg")
+        try:
+            output = os.path.join(destination, processed_name(path))
+            if cache is None:
+                image = load_image(os.path.join(source, path))
+                image = preprocess_image(image)
+                save_image(image, output)
+            else:
+                with open(os.path.join(source, path), "rb") as f:
+                    processed, _ = preprocess_cached(f.read(), cache)
+                with open(output, "wb") as f:
+                    f.write(processed)
+            count += 1
+        except Exception as e:
+            failures.append((path, str(e)))
+    if cache is not None:
+        hits = cache.hits - hits
+    return count, failures, hits
+
+
+@instrumented()
+def preprocess_images(
+    source=RAW_PATH,
+    destination=PROCESSED_PATH,
+    workers=PREPROCESS_WORKERS,
+    chunk_size=PREPROCESS_CHUNK_SIZE,
+    cache_path=PREPROCESS_CACHE_PATH,
+    cache_size=PREPROCESS_CACHE_SIZE,
+    index=None,
+    files=None,
+):
+    """
+    Runs the preprocessing step of the dataset.
+    Files are read from the RAW_PATH, processed, and saved to the PROCESSED_PATH.
+    With more than one worker, the images are split in chunks and processed by a pool of processes.
+    Images already preprocessed with the same parameters are copied from the cache.
+    If any image fails (or a worker dies), the error is raised after processing the others, so the
+    raw images are kept and the step can be retried.
+
+    Args:
+        source (str): The folder to read the images from.
+        destination (str): The folder to save the processed images to.
+        workers (int): Number of processes to use (1 = sequential, 0 = one per CPU core).
+        chunk_size (int): Number of images sent to a worker at once.
+        cache_path (str): The folder of the cache of preprocessed images.
+        cache_size (int): Maximum size in bytes of the cache (0 = disabled).
+        index (DatasetIndex): The dataset index to list the source and add the processed images to.
+        files (list): The names of the images to preprocess (a shard), instead of the whole source.
+
+    Returns:
+        int: The number of images processed.
+    """
+    paths = list_images(source, index, "raw") if files is None else files
+    cache = None
+    if cache_size > 0:
+        cache = PreprocessCache(cache_path, cache_size)
+        if cache.validate():
+            print("Preprocess cache emptied after its parameters changed.")
+    if workers == 0:
+        workers = os.cpu_count()
+    if workers <= 1 or len(paths) <= chunk_size:
+        count, failures, hits = preprocess_chunk(paths, source, destination, cache)
+    else:
+        count = 0
+        hits = 0
+        failures = []
+        chunks = [paths[i : i + chunk_size] for i in range(0, len(paths), chunk_size)]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    preprocess_chunk, chunk, source, destination, cache
+                ): chunk
+                for chunk in chunks
+            }
+            for future in as_completed(futures):
+                try:
+                    processed, failed, cached = future.result()
+                except Exception as e:  # The worker died (e.g., out of memory)
+                    processed, cached = 0, 0
+                    failed = [(p, str(e)) for p in futures[future]]
+                count += processed
+                hits += cached
+                failures.extend(failed)
+    for path, error in failures:
+        print(f"Failed to preprocess {path}: {error}")
+    if index is not None:
+        failed = {path for path, _ in failures}
+        names = [processed_name(path) for path in paths if path not in failed]
+        index.add(destination, names, "processed")
+    if cache is not None:
+        evicted = cache.evict()
+        print(
+            f"Preprocess cache: {hits} hits, {count - hits} misses, {evicted} evicted."
+        )
+    if failures:
+        raise RuntimeError(
+            f"Failed to preprocess {len(failures)} of {len(paths)} images."
         )
-        count += 1
     return count
 
 
-def augment_images(augments=AUGMENTATION_INCREASE):
+def load_image_array(path, size=TARGET_SIZE):
+    """
+    Read an image as an RGB uint8 array of the specified size.
+    """
+    image = load_image(path).convert("RGB")
+    if image.size != tuple(size):
+        image = resize_image(image, size)
+    return np.asarray(image)
+
+
+@instrumented()
+def augment_images(
+    augments=AUGMENTATION_INCREASE,
+    source=PROCESSED_PATH,
+    destination=AUGMENTED_PATH,
+    engine=AUGMENTATION_ENGINE,
+    index=None,
+    files=None,
+    start=0,
+):
     """
     Runs the augmentation steps of the dataset.
+
+    Args:
+        augments (int): The number of augmented images generated from each image.
+        source (str): The folder to read the images from.
+        destination (str): The folder to save the augmented images to.
+        engine (str): "batch" to augment the images stacked in arrays, or "pil" to do it one by one.
+        index (DatasetIndex): The dataset index to list the source and add the augmented images to.
+        files (list): The names of the images to augment (a shard), instead of the whole source.
+        start (int): The number of the first augmented image, so the names of the shards don't collide.
+
+    Returns:
+        int: The number of images augmented.
+        int: The number of augmented images generated.
     """
-    paths = os.listdir(PROCESSED_PATH)
+    if engine == "batch":
+        return augment_images_batch(
+            augments, source, destination, index=index, files=files, start=start
+        )
+    paths = list_images(source, index, "processed") if files is None else files
     count = 0
-    total = 0
+    total = start
     maxim = len(paths)
+    names = []
     for path in paths:
         # print(f"Augmenting image {count+1}/{maxim}")
         name, labels = divide_image_labels(path)
-        image = load_image(os.path.join(PROCESSED_PATH, path))
+        image = load_image(os.path.join(source, path))
         for _ in range(augments):
             augmented = random_rotation(image)
             augmented = random_flip(augmented)
             augmented = random_color_jitter(augmented)
             augmented = random_noise(augmented)
-            save_image(
-                augmented,
-                os.path.join(AUGMENTED_PATH, f"{name}-{total}_{'_'.join(labels)}.jpg"),
-            )
+            names.append(f"{name}-{total}_{'_'.join(labels)}.jpg")
+            save_image(augmented, os.path.join(destination, names[-1]))
             total += 1
         count += 1
-    return count, total
-
-
-def group_images_by_class(files, tmp):
+    if index is not None:
+        index.add(destination, names, "augmented")
+    return count, total - start
+
+
+def augment_images_batch(
+    augments=AUGMENTATION_INCREASE,
+    source=PROCESSED_PATH,
+    destination=AUGMENTED_PATH,
+    batch_size=AUGMENTATION_BATCH_SIZE,
+    seed=AUGMENTATION_SEED,
+    index=None,
+    files=None,
+    start=0,
+):
+    """
+    Runs the augmentation steps with the vectorized engine.
+    The copies of batch_size images are augmented together, generating the same names as augment_images.
+    """
+    paths = list_images(source, index, "processed") if files is None else files
+    names = []
+    width, height = TARGET_SIZE
+    augmenter = BatchAugmenter(batch_size * augments, height, width, seed)
+    count = 0
+    total = start
+    for first in range(0, len(paths), batch_size):
+        chunk = paths[first : first + batch_size]
+        images = [load_image_array(os.path.join(source, path)) for path in chunk]
+        augmented = augmenter.augment(images, augments)
+        for i, path in enumerate(chunk):
+            name, labels = divide_image_labels(path)
+            for copy in augmented[i * augments : (i + 1) * augments]:
+                names.append(f"{name}-{total}_{'_'.join(labels)}.jpg")
+                save_image(Image.fromarray(copy), os.path.join(destination, names[-1]))
+                total += 1
+        count += len(chunk)
+    if index is not None:
+        index.add(destination, names, "augmented")
+    return count, total - start
+
+
+def group_images_by_class(files, tmp, source=AUGMENTED_PATH):
     """
     Group the images by their class names.
     """
     for file_name in files:
         _, labels = divide_image_labels(file_name)
-        labels = [l.split("-")[0] if "-" in l else l for l in labels]
-        classes = divide_class_names(labels)
+        classes = label_class_names(labels)
         for name in classes:
             class_dir = os.path.join(tmp, name)
             os.makedirs(class_dir, exist_ok=True)
             shutil.copy(
-                os.path.join(AUGMENTED_PATH, file_name),
+                os.path.join(source, file_name),
                 os.path.join(class_dir, file_name),
             )
 
 
-def split_images(split_dir):
+@instrumented()
+def split_images(
+    split_dir,
+    mode=SPLIT_MODE,
+    source=AUGMENTED_PATH,
+    split_format=SPLIT_FORMAT,
+    index=None,
+    files=None,
+):
     """
     Split the images into the train, valid, and test sets.
+
+    Args:
+        split_dir (str): The folder where the train, valid, and test sets are created.
+        mode (str): "hash" to assign the splits by the image ids, or "random" to split each class randomly.
+        source (str): The folder to read the images from.
+        split_format (str): "jpeg" for a folder per class, or "tfrecord" for sharded TFRecord files.
+        index (DatasetIndex): The dataset index to list the source and add the split images to.
+        files (list): The names of the images to split (a shard), instead of the whole source.
+
+    Returns:
+        int: The number of images split.
     """
-    augmented_dir = AUGMENTED_PATH
+    if split_format == "tfrecord":
+        return split_images_tfrecord(split_dir, mode, source, index, files)
+    if mode == "hash":
+        return split_images_hash(split_dir, source, index, files)
+    # Imported here, as only the random splits need scikit-learn
+    from sklearn.model_selection import train_test_split
+
+    augmented_dir = source
     os.makedirs(split_dir, exist_ok=True)
 
     for split_type in SPLIT_NAMES:
         os.makedirs(os.path.join(split_dir, split_type), exist_ok=True)
 
-    files = [f for f in os.listdir(augmented_dir) if f.endswith(".jpg")]
-    tmp = "tmp"
+    if files is None:
+        files = list_images(augmented_dir, index, "augmented")
+    files = [f for f in files if f.endswith(".jpg")]
+    # A folder of its own, as several shards may be split at the same time
+    os.makedirs(TEMP_PATH, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix="split_", dir=TEMP_PATH)
     total = len(files)
-    group_images_by_class(files, tmp)
+    group_images_by_class(files, tmp, augmented_dir)
     count = 0
     temp = os.listdir(tmp)
     maxim = len(temp)
+    split = []
     for class_name in temp:
         # print(f"Splitting {count+1}/{maxim} images.")
         class_dir = os.path.join(tmp, class_name)
@@ -200,5 +493,333 @@ def split_images(split_dir):
                 os.path.join(split_dir, "test", class_name, file_name),
             )
 
+        for split_type, split_files in zip(
+            SPLIT_NAMES, [train_files, valid_files, test_files]
+        ):
+            split.extend(
+                (split_type, f, os.path.join(split_dir, split_type, class_name, f))
+                for f in split_files
+            )
+
     shutil.rmtree(tmp)
+    if index is not None:
+        index_split(index, split_dir, split)
+    return total
+
+
+def assign_split(value):
+    """
+    Gets the split an image belongs to from a number between 0 and 1, following the split percentages.
+    """
+    if value < SPLIT_TRAIN:
+        return SPLIT_NAMES[0]
+    if value < SPLIT_TRAIN + SPLIT_VALID:
+        return SPLIT_NAMES[1]
+    return SPLIT_NAMES[2]
+
+
+def hash_split(name):
+    """
+    Gets the split of an image from a stable hash of its original id.
+    Augmented copies (named <id>-<number>) get the same split as their original image.
+    """
+    source_id = name.rsplit("-", 1)[0]
+    digest = hashlib.sha256(source_id.encode()).digest()
+    return assign_split(int.from_bytes(digest[:8], "big") / 2**64)
+
+
+def make_class_folders(split_dir, classes, known_classes):
+    """
+    Create the folders of the new classes in every split, adding them to known_classes.
+    All splits need the same class folders to get the same labels.
+    """
+    for class_name in set(classes) - known_classes:
+        for split_type in SPLIT_NAMES:
+            os.makedirs(os.path.join(split_dir, split_type, class_name), exist_ok=True)
+        known_classes.add(class_name)
+
+
+def split_images_hash(split_dir, source=AUGMENTED_PATH, index=None, files=None):
+    """
+    Split the images into the train, valid, and test sets by the hash of their ids in a single pass.
+    Each image is moved to the folder of its first class and hard linked in the rest, never copied.
+
+    Returns:
+        int: The number of images split.
+    """
+    for split_type in SPLIT_NAMES:
+        os.makedirs(os.path.join(split_dir, split_type), exist_ok=True)
+
+    known_classes = set()
+    total = 0
+    split = []
+    if files is None:
+        files = list_images(source, index, "augmented")
+    for file_name in files:
+        if not file_name.endswith(".jpg"):
+            continue
+        total += 1
+        file_path = os.path.join(source, file_name)
+        name, labels = divide_image_labels(file_name)
+        classes = label_class_names(labels)
+        make_class_folders(split_dir, classes, known_classes)
+        split_type = hash_split(name)
+        destinations = [
+            os.path.join(split_dir, split_type, class_name, file_name)
+            for class_name in classes
+        ]
+        if destinations and not os.path.exists(file_path):
+            if os.path.exists(destinations[0]):
+                # Moved by a previous attempt of the shard
+                split.append((split_type, file_name, destinations[0]))
+            continue
+        for destination in destinations[1:]:
+            if os.path.exists(destination):
+                os.remove(destination)
+            os.link(file_path, destination)
+        if destinations:
+            os.replace(file_path, destinations[0])
+            split.append((split_type, file_name, destinations[0]))
+    if index is not None:
+        index.remove(source, [file_name for _, file_name, _ in split])
+        index_split(index, split_dir, split)
+    return total
+
+
+def image_split(name, mode=SPLIT_MODE):
+    """
+    Gets the split of a single image, by the hash of its id or randomly.
+    """
+    if mode == "hash":
+        return hash_split(name)
+    return assign_split(random.random())
+
+
+def split_images_tfrecord(
+    split_dir, mode=SPLIT_MODE, source=AUGMENTED_PATH, index=None, files=None
+):
+    """
+    Split the images into sharded TFRecord files of the train, valid, and test sets.
+    Each image is stored once with its id and the multi-hot vector of its classes.
+
+    Returns:
+        int: The number of images split.
+    """
+    # Imported here so the collection flows only load TensorFlow when they need it
+    from service.tfrecord_dataset import TFRecordSplitWriter
+
+    total = 0
+    split = []
+    if files is None:
+        files = list_images(source, index, "augmented")
+    with TFRecordSplitWriter(split_dir) as writer:
+        for file_name in files:
+            if not file_name.endswith(".jpg"):
+                continue
+            total += 1
+            name, labels = divide_image_labels(file_name)
+            if not label_class_names(labels):
+                continue
+            split_type = image_split(name, mode)
+            with open(os.path.join(source, file_name), "rb") as f:
+                writer.write(split_type, name, f.read(), labels)
+            split.append((split_type, file_name, writer.shard_path(split_type)))
+    if index is not None:
+        index_split(index, split_dir, split)
+    return total
+
+
+def queued(iterator, maxsize=STREAM_QUEUE_SIZE):
+    """
+    Runs the iterator in a background thread, keeping at most maxsize items waiting in memory.
+    Exceptions raised by the iterator are raised again in the consumer. If the consumer stops early
+    (e.g., it raised), the thread stops too instead of waiting forever to put its next item.
+    """
+    items = queue.Queue(maxsize=maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put(item):
+                    return
+        except Exception as e:
+            put(e)
+            return
+        put(done)
+
+    threading.Thread(target=produce, name="queued", daemon=True).start()
+    try:
+        while (item := items.get()) is not done:
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+def preprocessed_stream(paths, source=RAW_PATH, cache=None):
+    """
+    Preprocess the images in memory.
+    With a cache, the processed images are stored (and reused) encoded as in the staged mode, and only
+    the ones found in the cache are decoded.
+    As in preprocess_images, failed images are raised after the others, so the raw images are kept.
+
+    Yields:
+        tuple: The id, the labels and the preprocessed image as an RGB array.
+    """
+    failures = 0
+    for path in paths:
+        try:
+            name, labels = divide_image_labels(path)
+            if cache is None:
+                image = preprocess_image(load_image(os.path.join(source, path)))
+            else:
+                with open(os.path.join(source, path), "rb") as f:
+                    processed, image = preprocess_cached(f.read(), cache)
+                if image is None:
+                    image = load_image(io.BytesIO(processed))
+            yield name, labels, np.asarray(image.convert("RGB"))
+        except Exception as e:
+            print(f"Failed to preprocess {path}: {e}")
+            failures += 1
+    if failures:
+        raise RuntimeError(f"Failed to preprocess {failures} of {len(paths)} images.")
+
+
+def augmented_stream(
+    images,
+    augments=AUGMENTATION_INCREASE,
+    batch_size=AUGMENTATION_BATCH_SIZE,
+    seed=AUGMENTATION_SEED,
+    start=0,
+):
+    """
+    Augment in memory the images given by preprocessed_stream, batch_size images at a time.
+    The augmented images are numbered from start.
+
+    Yields:
+        tuple: The id (<id>-<number>), the labels and the augmented image as an RGB array.
+    """
+    width, height = TARGET_SIZE
+    augmenter = BatchAugmenter(batch_size * augments, height, width, seed)
+    total = start
+    chunk = []
+    for image in images:
+        chunk.append(image)
+        if len(chunk) < batch_size:
+            continue
+        for item in _augment_chunk(augmenter, chunk, augments, total):
+            yield item
+            total += 1
+        chunk = []
+    for item in _augment_chunk(augmenter, chunk, augments, total):
+        yield item
+
+
+def _augment_chunk(augmenter, chunk, augments, total):
+    if not chunk:
+        return
+    arrays = [array for _, _, array in chunk]
+    augmented = augmenter.augment(arrays, augments)
+    for i, (name, labels, _) in enumerate(chunk):
+        for copy in augmented[i * augments : (i + 1) * augments]:
+            yield f"{name}-{total}", labels, copy
+            total += 1
+
+
+@instrumented()
+def stream_images(
+    split_dir,
+    augments=AUGMENTATION_INCREASE,
+    source=RAW_PATH,
+    cache_path=PREPROCESS_CACHE_PATH,
+    cache_size=PREPROCESS_CACHE_SIZE,
+    index=None,
+    files=None,
+    start=0,
+):
+    """
+    Runs preprocessing, augmentation and splitting of the dataset in memory.
+    Files are read from the RAW_PATH and only the final images are encoded, inside the split_dir.
+
+    Args:
+        split_dir (str): The folder where the train, valid, and test sets are created.
+        augments (int): The number of augmented images generated from each image.
+        source (str): The folder to read the images from.
+        cache_path (str): The folder of the cache of preprocessed images.
+        cache_size (int): Maximum size in bytes of the cache (0 = disabled).
+        index (DatasetIndex): The dataset index to list the source and add the split images to.
+        files (list): The names of the images to stream (a shard), instead of the whole source.
+        start (int): The number of the first augmented image, so the names of the shards don't collide.
+
+    Returns:
+        int: The number of augmented images generated.
+    """
+    for split_type in SPLIT_NAMES:
+        os.makedirs(os.path.join(split_dir, split_type), exist_ok=True)
+
+    cache = None
+    if cache_size > 0:
+        cache = PreprocessCache(cache_path, cache_size)
+        if cache.validate():
+            print("Preprocess cache emptied after its parameters changed.")
+    paths = list_images(source, index, "raw") if files is None else files
+    images = queued(preprocessed_stream(paths, source, cache))
+    writer = None
+    if SPLIT_FORMAT == "tfrecord":
+        from service.tfrecord_dataset import TFRecordSplitWriter
+
+        writer = TFRecordSplitWriter(split_dir)
+    known_classes = set()
+    total = 0
+    split = []
+    try:
+        for name, labels, image in augmented_stream(images, augments, start=start):
+            total += 1
+            classes = label_class_names(labels)
+            if not classes:
+                continue
+            file_name = f"{name}_{'_'.join(labels)}.jpg"
+            split_type = image_split(name)
+            buffer = io.BytesIO()
+            Image.fromarray(image).save(buffer, format="JPEG")
+            if writer is not None:
+                writer.write(split_type, name, buffer.getvalue(), labels)
+                split.append((split_type, file_name, writer.shard_path(split_type)))
+                continue
+            make_class_folders(split_dir, classes, known_classes)
+            destinations = [
+                os.path.join(split_dir, split_type, class_name, file_name)
+                for class_name in classes
+            ]
+            # Written once, and hard linked in the folders of the other classes
+            with open(destinations[0], "wb") as f:
+                f.write(buffer.getbuffer())
+            for destination in destinations[1:]:
+                if os.path.exists(destination):  # Written by a previous attempt
+                    os.remove(destination)
+                os.link(destinations[0], destination)
+            split.append((split_type, file_name, destinations[0]))
+    finally:
+        images.close()  # Stops the preprocessing thread if the split failed
+    if writer is not None:
+        writer.close()
+    if index is not None:
+        index_split(index, split_dir, split)
+    if cache is not None:
+        evicted = cache.evict()
+        print(
+            f"Preprocess cache: {cache.hits} hits, {cache.misses} misses, {evicted} evicted."
+        )
     return total
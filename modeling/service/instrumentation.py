@@ -0,0 +1,321 @@
+"""
+Module for measuring the performance of the stages of the pipelines.
+
+Each instrumented stage (a flow stage, a task or a service function) records its wall and CPU time,
+the images it handled and the images/sec, the bytes read and written by the process and its peak RSS.
+When a flow ends, its records are summarized per stage and published as a Prefect table artifact,
+as a JSON line appended to <METRICS_PATH>/<flow>.jsonl and as a Prometheus textfile <METRICS_PATH>/<flow>.prom
+(for the textfile collector of node_exporter).
+With INSTRUMENTATION disabled, the functions are not wrapped at all, so they run as if not instrumented.
+
+The counters are of the whole process: stages running at the same time (e.g., the shards of the
+collection flows) share them, and the peak RSS is the highest since the process started.
+"""
+
+import functools
+import json
+import os
+import resource
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from options import INSTRUMENTATION, INSTRUMENTATION_MAX_RECORDS, METRICS_PATH
+
+PROMETHEUS_PREFIX = "weldspot_stage"
+# Fields of the summary of each stage exported to Prometheus, with their help text
+PROMETHEUS_METRICS = {
+    "runs": "Number of runs of the stage in the last flow run",
+    "failures": "Number of runs of the stage that raised an exception",
+    "seconds": "Wall time of the stage in seconds",
+    "cpu_seconds": "CPU time of the process (and its finished children) during the stage",
+    "images": "Images handled by the stage",
+    "images_per_second": "Images handled per second of wall time",
+    "read_bytes": "Bytes read by the process during the stage",
+    "write_bytes": "Bytes written by the process during the stage",
+    "peak_rss_mb": "Peak resident memory of the process in MB",
+}
+
+
+def io_counters():
+    """
+    Gets the bytes read and written by the process so far, from /proc/self/io (Linux only, otherwise {}).
+    The rchar/wchar counters are used, so reads served from the page cache are counted too.
+    """
+    try:
+        with open("/proc/self/io", "r") as f:
+            counters = dict(line.split(":") for line in f if ":" in line)
+        return {
+            "read_bytes": int(counters["rchar"]),
+            "write_bytes": int(counters["wchar"]),
+        }
+    except (OSError, KeyError, ValueError):
+        return {}
+
+
+def cpu_seconds():
+    """
+    Gets the CPU time of the process and its finished children (e.g., the preprocessing workers).
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def peak_rss_mb():
+    """
+    Gets the peak resident memory of the process and its finished children in MB (Linux reports KB).
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) / 1024
+
+
+def count_images(result):
+    """
+    Gets the number of images from the result of a stage: an int, or the first int of a tuple.
+    """
+    if isinstance(result, tuple) and result:
+        result = result[0]
+    if isinstance(result, int) and not isinstance(result, bool):
+        return result
+    return None
+
+
+class Stage:
+    """
+    Context manager measuring a run of a stage. The stage can set the images it handled.
+    """
+
+    def __init__(self, recorder, name, images=None):
+        self.recorder = recorder
+        self.name = name
+        self.images = images
+
+    def __enter__(self):
+        self.started = datetime.now().isoformat(timespec="seconds")
+        self.io = io_counters()
+        self.cpu = cpu_seconds()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, error_type, *args):
+        seconds = time.perf_counter() - self.start
+        record = {
+            "stage": self.name,
+            "started": self.started,
+            "failed": error_type is not None,
+            "seconds": round(seconds, 4),
+            "cpu_seconds": round(cpu_seconds() - self.cpu, 4),
+            "images": self.images,
+            "images_per_second": (
+                round(self.images / seconds, 2)
+                if self.images is not None and seconds > 0
+                else None
+            ),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+        }
+        for name, value in io_counters().items():
+            record[name] = value - self.io[name]
+        self.recorder.add(record)
+        return False
+
+
+class Recorder:
+    """
+    Keeps the records of the stages run in the process until a flow publishes them.
+    """
+
+    def __init__(
+        self, enabled=INSTRUMENTATION, max_records=INSTRUMENTATION_MAX_RECORDS
+    ):
+        self.enabled = enabled
+        self.records = deque(maxlen=max_records)
+        self.lock = threading.Lock()  # The shards record from several threads
+
+    def stage(self, name, images=None):
+        return Stage(self, name, images)
+
+    def add(self, record):
+        with self.lock:
+            self.records.append(record)
+
+    def take(self):
+        """
+        Gets the records and forgets them.
+        """
+        with self.lock:
+            records = list(self.records)
+            self.records.clear()
+        return records
+
+
+recorder = Recorder()
+
+
+def instrumented(name=None, images=count_images):
+    """
+    Decorator recording each run of a function as a stage (named as the function by default).
+    Place it below @task or @flow, so the retries of Prefect are recorded one by one.
+
+    Args:
+        name (str): The name of the stage.
+        images (function): Gets the images handled from the result of the function (None = unknown).
+    """
+
+    def decorator(function):
+        if not recorder.enabled:
+            return function
+        stage_name = name or function.__name__
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with recorder.stage(stage_name) as stage:
+                result = function(*args, **kwargs)
+                stage.images = images(result)
+            return result
+
+        return wrapper
+
+    return decorator
+
+
+def summarize(records):
+    """
+    Sum the records of each stage, in the order the stages were first run.
+
+    Returns:
+        list: A dict per stage with its runs, failures, totals and peak RSS.
+    """
+    stages = {}
+    for record in records:
+        summary = stages.setdefault(
+            record["stage"],
+            {
+                "stage": record["stage"],
+                "runs": 0,
+                "failures": 0,
+                "seconds": 0.0,
+                "cpu_seconds": 0.0,
+                "images": None,
+                "images_per_second": None,
+                "read_bytes": None,
+                "write_bytes": None,
+                "peak_rss_mb": 0.0,
+            },
+        )
+        summary["runs"] += 1
+        summary["failures"] += int(record["failed"])
+        summary["seconds"] = round(summary["seconds"] + record["seconds"], 4)
+        summary["cpu_seconds"] = round(
+            summary["cpu_seconds"] + record["cpu_seconds"], 4
+        )
+        for name in ["images", "read_bytes", "write_bytes"]:
+            if record.get(name) is not None:
+                summary[name] = (summary[name] or 0) + record[name]
+        summary["peak_rss_mb"] = max(summary["peak_rss_mb"], record["peak_rss_mb"])
+    for summary in stages.values():
+        if summary["images"] is not None and summary["seconds"] > 0:
+            summary["images_per_second"] = round(
+                summary["images"] / summary["seconds"], 2
+            )
+    return list(stages.values())
+
+
+def prometheus_label(value):
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def write_prometheus(path, flow_name, summary):
+    """
+    Write the summary of the stages as a Prometheus textfile (replaced atomically, as the collector may read it).
+    """
+    lines = []
+    for field, description in PROMETHEUS_METRICS.items():
+        metric = f"{PROMETHEUS_PREFIX}_{field}"
+        lines.append(f"# HELP {metric} {description}")
+        lines.append(f"# TYPE {metric} gauge")
+        for stage in summary:
+            if stage[field] is None:
+                continue
+            labels = f'flow="{prometheus_label(flow_name)}",stage="{prometheus_label(stage["stage"])}"'
+            lines.append(f"{metric}{{{labels}}} {stage[field]}")
+    metric = f"{PROMETHEUS_PREFIX}_last_run_timestamp_seconds"
+    lines.append(f"# HELP {metric} When the flow published its stages")
+    lines.append(f"# TYPE {metric} gauge")
+    lines.append(f'{metric}{{flow="{prometheus_label(flow_name)}"}} {time.time():.0f}')
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    os.replace(temp_path, path)
+
+
+def publish_artifact(flow_name, summary):
+    """
+    Publish the summary of the stages as a table artifact of the current flow run (if any).
+    """
+    # Imported here so the services don't need Prefect
+    from prefect.artifacts import create_table_artifact
+    from prefect.context import FlowRunContext
+
+    if FlowRunContext.get() is None:
+        return
+    key = "".join(c if c.isalnum() else "-" for c in flow_name.lower())
+    create_table_artifact(
+        key=f"{key}-stages",
+        table=summary,
+        description=f"Performance of the stages of {flow_name}",
+    )
+
+
+def publish(flow_name, path=METRICS_PATH):
+    """
+    Publish the stages recorded since the last publish as a Prefect artifact, a JSON line and a Prometheus textfile.
+
+    Returns:
+        list: The summary of each stage.
+    """
+    records = recorder.take()
+    if not records:
+        return []
+    summary = summarize(records)
+    os.makedirs(path, exist_ok=True)
+    with open(os.path.join(path, f"{flow_name}.jsonl"), "a") as f:
+        run = {
+            "flow": flow_name,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "stages": summary,
+            "records": records,
+        }
+        f.write(json.dumps(run) + "\n")
+    write_prometheus(os.path.join(path, f"{flow_name}.prom"), flow_name, summary)
+    publish_artifact(flow_name, summary)
+    for stage in summary:
+        print(
+            f"Stage {stage['stage']}: {stage['seconds']}s, {stage['images_per_second']} images/sec, "
+            f"{stage['peak_rss_mb']} MB peak RSS"
+        )
+    return summary
+
+
+def published(flow_name):
+    """
+    Decorator recording a flow as a stage and publishing its stages when it ends, even if it fails.
+    Place it below @flow, so the artifact is created in the flow run.
+    """
+
+    def decorator(function):
+        if not recorder.enabled:
+            return function
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            try:
+                with recorder.stage(flow_name):
+                    return function(*args, **kwargs)
+            finally:
+                publish(flow_name)
+
+        return wrapper
+
+    return decorator
@@ -1,89 +1,220 @@
 import os
-import re
 
-from sklearn.metrics import roc_auc_score
+import numpy as np
 
-from options import CLASS_NAMES, CLASS_THRESHOLD, RAW_PATH
+from options import CLASS_NAMES, CLASS_THRESHOLD, DRIFT_SCORING, RAW_PATH
+from service.dataset_index import list_images, parse_image_name
+from service.instrumentation import instrumented
 
 
-def analyze_classes(files):
-    class_metrics = {
-        class_name: {
-            "actuals": [],
-            "predictions": [],
-            "TP": 0,
-            "FP": 0,
-            "TN": 0,
-            "FN": 0,
-        }
-        for class_name in CLASS_NAMES
-    }
+def parse_feedback(files):
+    """
+    Parse the names of the feedback images formatted as <id>_<actual>-<confidence>_..._<actual>-<confidence>.jpg.
+    Names without the 7 pairs of actual class and confidence are skipped.
 
-    renames = []
+    Args:
+        files (list): The file names.
 
+    Returns:
+        list: The parsed file names.
+        list: The id of each file.
+        np.ndarray: Array of shape (N, 7) with the actual classes (0 or 1).
+        np.ndarray: Array of shape (N, 7) with the confidence of each class.
+    """
+    parsed = []
+    identifiers = []
+    pairs = []
     for file in files:
-        match = re.match(r"^(.*?)(_.*?\.jpg)$", file)
-        if not match:
+        identifier, _, rest = file.partition("_")
+        rest = rest[:-4]
+        if (
+            not file.endswith(".jpg")
+            or rest.count("_") != len(CLASS_NAMES) - 1
+            or rest.count("-") != len(CLASS_NAMES)
+        ):
+            continue
+        parsed.append(file)
+        identifiers.append(identifier)
+        pairs.append(rest)
+    # Parse all the numbers at once, as actual, confidence, actual, confidence...
+    text = " ".join(pairs).replace("_", " ").replace("-", " ")
+    values = np.fromstring(text, dtype=np.float64, sep=" ")
+    values = values.reshape(-1, len(CLASS_NAMES), 2)
+    return parsed, identifiers, values[:, :, 0].astype(np.int64), values[:, :, 1]
+
+
+def parse_labels(files):
+    """
+    Parse the actual classes of images named as <id>_<class1>_..._<class7>.jpg, with or without
+    the confidences of the client. Names without the 7 classes are skipped.
+
+    Returns:
+        list: The parsed file names.
+        list: The id of each file.
+        np.ndarray: Array of shape (N, 7) with the actual classes (0 or 1).
+        list: The position of each parsed file in files.
+    """
+    parsed = []
+    identifiers = []
+    actuals = []
+    positions = []
+    for position, file in enumerate(files):
+        try:
+            identifier, labels, _, _ = parse_image_name(file)
+            row = [int(float(label)) for label in labels.split("_")]
+        except ValueError:
+            continue
+        if not file.endswith(".jpg") or len(row) != len(CLASS_NAMES):
+            continue
+        parsed.append(file)
+        identifiers.append(identifier)
+        actuals.append(row)
+        positions.append(position)
+    actuals = np.array(actuals, dtype=np.int64).reshape(-1, len(CLASS_NAMES))
+    return parsed, identifiers, actuals, positions
+
+
+def roc_auc_scores(actuals, confidences):
+    """
+    Compute the ROC AUC of every class with a single sort of all the columns.
+    The curve of each class is built as in sklearn's roc_auc_score (distinct thresholds, dropping
+    the collinear points and the trapezoidal rule), so the results are exactly the same.
+
+    Args:
+        actuals (np.ndarray): Array of shape (N, C) with the actual classes (0 or 1).
+        confidences (np.ndarray): Array of shape (N, C) with the predicted scores.
+
+    Returns:
+        list: The AUC of each class (None if it has a single class in actuals).
+    """
+    if len(actuals) == 0:
+        return [None] * confidences.shape[1]
+    order = np.argsort(confidences, axis=0, kind="mergesort")[::-1]
+    scores = np.take_along_axis(confidences, order, axis=0)
+    true_positives = np.cumsum(
+        np.take_along_axis(actuals == 1, order, axis=0), axis=0, dtype=np.float64
+    )
+    aucs = []
+    for i in range(confidences.shape[1]):
+        thresholds = np.r_[np.flatnonzero(np.diff(scores[:, i])), len(scores) - 1]
+        tps = true_positives[thresholds, i]
+        fps = 1 + thresholds - tps
+        if len(tps) == 0 or tps[-1] == 0 or fps[-1] == 0:
+            aucs.append(None)
             continue
+        if len(fps) > 2:
+            corners = np.logical_or(np.diff(fps, 2), np.diff(tps, 2))
+            keep = np.flatnonzero(np.r_[True, corners, True])
+            fps = fps[keep]
+            tps = tps[keep]
+        fpr = np.r_[0, fps] / fps[-1]
+        tpr = np.r_[0, tps] / tps[-1]
+        aucs.append(float((np.diff(fpr) * (tpr[1:] + tpr[:-1]) / 2.0).sum()))
+    return aucs
+
+
+def analyze_classes(files, confidences=None):
+    """
+    Compute the confusion counts and the AUC of each class of the feedback images.
+
+    Args:
+        files (list): The file names.
+        confidences (np.ndarray): Array of shape (len(files), 7) with the scores of each image
+            (e.g., from the server). By default, the confidences of the client are read from the names.
+
+    Returns:
+        dict: The actuals, predictions and confusion counts of each class.
+        dict: The AUC of each class.
+        list: The (old, new) names of the parsed files, without the confidences.
+    """
+    if confidences is None:
+        parsed_files, identifiers, actuals, confidences = parse_feedback(files)
+    else:
+        parsed_files, identifiers, actuals, positions = parse_labels(files)
+        confidences = np.asarray(confidences, dtype=np.float64)[positions]
+    predicted = confidences >= CLASS_THRESHOLD
+    positive = actuals == 1
+    counts = {
+        "TP": (positive & predicted).sum(axis=0),
+        "FP": (~positive & predicted).sum(axis=0),
+        "TN": (~positive & ~predicted).sum(axis=0),
+        "FN": (positive & ~predicted).sum(axis=0),
+    }
+    aucs = roc_auc_scores(actuals, confidences)
 
-        identifier, class_conf_pairs = match.groups()
-        class_conf_pairs = class_conf_pairs[1:-4].split(
-            "_"
-        )  # Remove leading underscore and .jpg
-
-        new_filename_parts = [identifier]
-        for i, pair in enumerate(class_conf_pairs):
-            actual, confidence = pair.split("-")
-            actual = int(actual)
-            confidence = float(confidence)
-            class_name = CLASS_NAMES[i]
-
-            # Update confusion matrix
-            if actual == 1:
-                if confidence >= CLASS_THRESHOLD:
-                    class_metrics[class_name]["TP"] += 1
-                else:
-                    class_metrics[class_name]["FN"] += 1
-            else:
-                if confidence >= CLASS_THRESHOLD:
-                    class_metrics[class_name]["FP"] += 1
-                else:
-                    class_metrics[class_name]["TN"] += 1
-
-            # Store predictions and actual values for AUC calculation
-            class_metrics[class_name]["predictions"].append(confidence)
-            class_metrics[class_name]["actuals"].append(actual)
-
-            new_filename_parts.append(str(actual))
-
-        new_filename = "_".join(new_filename_parts) + ".jpg"
-        renames.append((file, new_filename))
-
-    # Calculate AUC for each class
+    class_metrics = {}
     class_aucs = {}
-    for class_name, metrics in class_metrics.items():
-        if (
-            len(set(metrics["actuals"])) > 1
-        ):  # AUC is undefined if there is only one class in actuals
-            class_aucs[class_name] = roc_auc_score(
-                metrics["actuals"], metrics["predictions"]
-            )
-        else:
-            class_aucs[class_name] = None
+    for i, class_name in enumerate(CLASS_NAMES):
+        class_metrics[class_name] = {
+            "actuals": actuals[:, i].tolist(),
+            "predictions": confidences[:, i].tolist(),
+            **{name: int(count[i]) for name, count in counts.items()},
+        }
+        class_aucs[class_name] = aucs[i]  # Undefined (None) if there is only one class
 
+    renames = [
+        (file, "_".join([identifier, *map(str, row)]) + ".jpg")
+        for file, identifier, row in zip(parsed_files, identifiers, actuals.tolist())
+    ]
     return class_metrics, class_aucs, renames
 
 
-def drift_detection():
-    files = os.listdir(RAW_PATH)
+def rename_files(path, renames):
+    """
+    Rename the files of a folder, resolving the folder only once.
+    """
+    directory = os.open(path, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        for old_name, new_name in renames:
+            os.rename(old_name, new_name, src_dir_fd=directory, dst_dir_fd=directory)
+    finally:
+        os.close(directory)
+
+
+def score_raw_images(files, model_path=None):
+    """
+    Score the raw images with a deployed TFLite model (the latest one by default).
+
+    Returns:
+        np.ndarray: The scores of each image (N, 7), or None if there is no deployed model.
+    """
+    # TensorFlow is only loaded when the images are scored on the server
+    from service.bulk_scoring import latest_model, score_files
+
+    model_path = model_path or latest_model()
+    if model_path is None:
+        return None
+    print(f"Scoring {len(files)} raw images with {model_path}")
+    return score_files([os.path.join(RAW_PATH, file) for file in files], model_path)
+
+
+@instrumented()
+def drift_detection(index=None, scoring=DRIFT_SCORING):
+    """
+    Check the AUC of each class of the feedback images in RAW_PATH.
+    The confidences are the ones of the client ("client" scoring) or they are computed again with the
+    latest deployed model ("server" scoring, or the client ones if there is no deployed model).
+    """
+    files = list_images(RAW_PATH, index, "raw")
     if not files:
         return None, None
-    class_metrics, class_aucs, renames = analyze_classes(files)
+    confidences = None
+    if scoring == "server":
+        labeled = parse_labels(files)[0]  # Only the labeled images are scored
+        confidences = score_raw_images(labeled)
+        if confidences is None:
+            print("No deployed model to score the raw images, using the client scores.")
+        else:
+            scored = ~np.isnan(confidences).any(axis=1)  # Not the images that failed
+            files = [file for file, ok in zip(labeled, scored) if ok]
+            confidences = confidences[scored]
+    class_metrics, class_aucs, renames = analyze_classes(files, confidences)
     # Check if there is drift in any class
     for class_name, auc in class_aucs.items():
         if auc is not None and auc < CLASS_THRESHOLD:
             return class_metrics, class_name
     # Rename files
-    for old_name, new_name in renames:
-        os.rename(os.path.join(RAW_PATH, old_name), os.path.join(RAW_PATH, new_name))
+    rename_files(RAW_PATH, renames)
+    if index is not None:
+        index.rename(RAW_PATH, renames)
     return class_metrics, None
@@ -12,6 +12,7 @@ from tensorflow.keras.optimizers import Adam
 from tensorflow.keras.regularizers import l2
 
 from options import CLASS_NAMES, TARGET_SIZE
+from service.instrumentation import instrumented
 
 
 def sequential_model():
@@ -32,7 +33,8 @@ def sequential_model():
             GlobalAveragePooling2D(),
             Dense(512, activation="relu", kernel_regularizer=l2(0.001)),
             Dropout(0.5),
-            Dense(len(CLASS_NAMES), activation="softmax"),
+            # The output stays in float32 with mixed precision, for stable probabilities
+            Dense(len(CLASS_NAMES), activation="softmax", dtype="float32"),
         ]
     )
 
@@ -43,12 +45,19 @@ def sequential_model():
     return model
 
 
-def mobilenet_model():
+def mobilenet_model(weights="imagenet"):
+    """
+    Build the MobileNet model with a new head for the classes.
+
+    Args:
+        weights (str): The pretrained weights of the base model ("imagenet"), or None for random
+            weights (e.g., for benchmarks without downloading them).
+    """
     FROZEN_START = 5  # Start freezing by the layer
     FROZEN_STOP = 38  # Stop freezing at the layers
 
     model = MobileNet(
-        weights="imagenet", include_top=False, input_shape=(*TARGET_SIZE, 3), alpha=0.25
+        weights=weights, include_top=False, input_shape=(*TARGET_SIZE, 3), alpha=0.25
     )
     for layer in model.layers[FROZEN_START:FROZEN_STOP]:
         layer.trainable = True
@@ -59,7 +68,10 @@ def mobilenet_model():
     x = Dense(512, activation="relu", kernel_regularizer=l2(0.001))(x)
     x = Dropout(0.5)(x)  # Dropout for regularization
     predictions = Dense(
-        len(CLASS_NAMES), activation="sigmoid", kernel_regularizer=l2(0.001)
+        len(CLASS_NAMES),
+        activation="sigmoid",
+        kernel_regularizer=l2(0.001),
+        dtype="float32",  # The output stays in float32 with mixed precision
     )(x)
 
     # This is the model we will train
@@ -89,12 +101,74 @@ def model_load(path):
     return model
 
 
+def model_copy(model):
+    """
+    Copy a model with its weights, compiled as the loaded models (e.g., to retrain it without
+    changing the original).
+    """
+    copy = tf.keras.models.clone_model(model)
+    copy.set_weights(model.get_weights())
+    copy.compile(
+        optimizer=Adam(learning_rate=0.001),
+        loss="binary_crossentropy",
+        metrics=["accuracy", "auc"],
+    )
+    return copy
+
+
 def model_store(model, path):
     model.save(path)
 
 
-def model_convert(model, path):
-    converter = tf.lite.TFLiteConverter.from_keras_model(model)
+def float32_model(model):
+    """
+    Get a float32 copy of a model built with mixed precision (e.g., mixed_bfloat16 in the CPU mode),
+    as TFLite can't convert bfloat16 layers. Float32 models are returned as they are.
+    """
+    if all(layer.compute_dtype == "float32" for layer in model.layers):
+        return model
+
+    def float32_layer(layer):
+        config = layer.get_config()
+        if "dtype" in config:
+            config["dtype"] = "float32"
+        return layer.__class__.from_config(config)
+
+    policy = tf.keras.mixed_precision.global_policy()
+    tf.keras.mixed_precision.set_global_policy("float32")
+    try:
+        clone = tf.keras.models.clone_model(model, clone_function=float32_layer)
+    finally:
+        tf.keras.mixed_precision.set_global_policy(policy)
+    clone.set_weights(model.get_weights())
+    return clone
+
+
+@instrumented()
+def model_convert(model, path, mode="float32", representative_dataset=None):
+    """
+    Convert the model to TFLite, optionally quantized after training.
+
+    Args:
+        model: The Keras model.
+        path (str): The .tflite file written.
+        mode (str): "float32" (no quantization), "dynamic" (int8 weights), "float16" (half precision
+            weights) or "int8" (int8 weights and activations, keeping float input and output).
+        representative_dataset: A function yielding [image batch] lists to calibrate the int8 ranges
+            (required by "int8").
+    """
+    converter = tf.lite.TFLiteConverter.from_keras_model(float32_model(model))
+    if mode != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif mode == "int8":
+        if representative_dataset is None:
+            raise ValueError("The int8 quantization needs a representative dataset.")
+        converter.representative_dataset = representative_dataset
+        converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    elif mode not in ["float32", "dynamic"]:
+        raise ValueError(f"Unknown quantization mode {mode}")
     tflite_model = converter.convert()
     with open(path, "wb") as f:
         f.write(tflite_model)
@@ -1,19 +1,58 @@
 import io
 import os
+import time
 from datetime import datetime
 
 import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
 
-from options import CLASS_NAMES, TRAIN_EPOCHS, TRAINING_VERBOSITY
+from options import (
+    CLASS_NAMES,
+    QUANTIZATION_MODES,
+    QUANTIZATION_TOLERANCE,
+    REPRESENTATIVE_SAMPLES,
+    TRAIN_EPOCHS,
+    TRAINING_MODE,
+    TRAINING_VERBOSITY,
+    XLA_JIT,
+)
+from service.metric_monitoring import roc_auc_scores
+from service.instrumentation import instrumented
+from service.model_creation import model_convert
+from service.tflite_inference import TFLiteModel, measure_latency
 from service.training_configuration import get_device
 
 
-def model_training(model, train_data, validation_data, epochs=TRAIN_EPOCHS):
-    # strategy = tf.distribute.OneDeviceStrategy(device='/gpu:0')
-    # with strategy.scope():
+class StepsPerSecond(tf.keras.callbacks.Callback):
+    """
+    Measure the training steps (batches) per second of each epoch, added to the logs as
+    steps_per_second (and so to TensorBoard and the history).
+    """
 
+    def on_epoch_begin(self, epoch, logs=None):
+        self.steps = 0
+        self.start = self.end = time.perf_counter()
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.steps += 1
+        self.end = time.perf_counter()  # The validation of the epoch is not counted
+
+    def on_epoch_end(self, epoch, logs=None):
+        steps_per_second = self.steps / max(self.end - self.start, 1e-9)
+        if logs is not None:
+            logs["steps_per_second"] = steps_per_second
+        print(f"Epoch {epoch + 1}: {steps_per_second:.2f} steps/sec")
+
+
+@instrumented()
+def model_training(
+    model, train_data, validation_data, epochs=TRAIN_EPOCHS, mode=TRAINING_MODE
+):
+    """
+    Train the model, on the GPU if there is one ("default" mode) or on the CPU with the XLA setting of
+    the options ("cpu" mode, see configure_cpu_training for the threads and precision).
+    """
     log_dir = os.path.join("logs", "fit", datetime.now().strftime("%Y%m%d-%H%M%S"))
     tensorboard_tracking = tf.keras.callbacks.TensorBoard(
         log_dir=log_dir, histogram_freq=1
@@ -25,64 +64,239 @@ def model_training(model, train_data, validation_data, epochs=TRAIN_EPOCHS):
         patience=18,  # Number of epochs with no improvement after which training will be stopped
         restore_best_weights=True,  # Restore model weights from the epoch with the best AUC
     )
-    device = get_device()
+    if mode == "cpu":
+        device = "/device:CPU:0"
+        if model.jit_compile != XLA_JIT:
+            model.jit_compile = XLA_JIT
+            model.make_train_function(force=True)
+    else:
+        device = get_device()
     print(f"Training on {device}")
     with tf.device(device):
         training = model.fit(
             train_data,
             epochs=epochs,
             validation_data=validation_data,
-            callbacks=[early_stopping, tensorboard_tracking],
+            # The steps are measured before the other callbacks read the logs
+            callbacks=[StepsPerSecond(), early_stopping, tensorboard_tracking],
             verbose=TRAINING_VERBOSITY,
         )
         return training
 
 
+def iterate_batches(data):
+    """
+    Iterate once over the (images, labels) batches of a tf.data pipeline, a Keras generator or
+    sequence, or a list of batches. Keras generators loop forever, so they are read by index.
+    """
+    if isinstance(data, tf.data.Dataset) or not hasattr(data, "__getitem__"):
+        yield from data
+    else:
+        for i in range(len(data)):
+            yield data[i]
+
+
+def evaluate_batches(model, test_data):
+    """
+    Evaluate a model streaming the test data once.
+    The loss, accuracy and confusion matrix are accumulated batch by batch, and only the labels and
+    confidences (7 values per image) are kept to compute the exact ROC AUC of each class at the end.
+
+    Args:
+        model: The compiled model.
+        test_data: The test batches (see iterate_batches), with one-hot or multi-hot labels.
+
+    Returns:
+        dict: The loss and accuracy (as model.evaluate), the AUC of each class (None if the test data
+        has only one label for it), the confusion matrix of the top class and the number of images.
+    """
+    loss_function = tf.keras.losses.get(model.loss)
+    loss_sum = 0.0
+    correct = 0.0
+    images = 0
+    actuals = []
+    confidences = []
+    confusion = None
+    for x, y in iterate_batches(test_data):
+        y = np.asarray(y, dtype=np.float32)
+        predictions = np.asarray(model.predict_on_batch(x), dtype=np.float32)
+        classes = predictions.shape[1]
+        if confusion is None:
+            confusion = np.zeros((classes, classes), dtype=np.int64)
+        loss_sum += float(tf.reduce_sum(loss_function(y, predictions)))
+        # Keras' "accuracy" of several outputs compares the top classes (categorical accuracy)
+        top_actual = y.argmax(axis=1)
+        top_predicted = predictions.argmax(axis=1)
+        correct += (top_actual == top_predicted).sum()
+        pairs = top_actual * classes + top_predicted
+        confusion += np.bincount(pairs, minlength=classes * classes).reshape(
+            classes, classes
+        )
+        actuals.append(y > 0.5)
+        confidences.append(predictions)
+        images += len(y)
+    if not images:
+        return {"loss": None, "accuracy": None, "auc": [], "confusion": confusion}
+    regularization = sum(float(loss) for loss in model.losses)
+    return {
+        "loss": loss_sum / images + regularization,
+        "accuracy": float(correct / images),
+        "auc": roc_auc_scores(np.concatenate(actuals), np.concatenate(confidences)),
+        "confusion": confusion,
+        "images": images,
+    }
+
+
+@instrumented()
 def measure_performance(model, test_data, type="test"):
+    """
+    Evaluate the model on the test data in a single pass and log the confusion matrix to TensorBoard
+    (logs/predict, as an image named after the type).
+
+    Returns:
+        float: The average ROC AUC of the classes with both labels in the test data (0 if none).
+    """
     log_dir = os.path.join("logs", "predict")
     os.makedirs(log_dir, exist_ok=True)
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
-    filename = f"{type}_{timestamp}.png"
-    file_path = os.path.join(log_dir, filename)
 
-    file_writer = tf.summary.create_file_writer(log_dir)
-    test_loss, test_acc, test_auc = model.evaluate(test_data)
-    print(f"Test accuracy: {test_acc}, Test AUC: {test_auc}, Test loss: {test_loss}")
-
-    predictions = model.predict(test_data)
-    y_pred = [CLASS_NAMES[prediction.argmax()] for prediction in predictions]
-    y_pred_indices = [CLASS_NAMES.index(pred) for pred in y_pred]
-    y_true = test_data.classes
-    conf_matrix = tf.math.confusion_matrix(y_true, y_pred_indices).numpy()
+    results = evaluate_batches(model, test_data)
+    auc_per_class = [auc for auc in results["auc"] if auc is not None]
+    average_auc = sum(auc_per_class) / len(auc_per_class) if auc_per_class else 0
+    print(
+        f"Test accuracy: {results['accuracy']}, Test AUC: {average_auc}, "
+        f"Test loss: {results['loss']}"
+    )
+    if results["confusion"] is None:
+        return average_auc
+
     # Log confusion matrix as an image
-    figure = plot_confusion_matrix(conf_matrix, class_names=CLASS_NAMES)
-    plot_to_image(figure, file_path)
-    cm_image = tf.image.decode_png(tf.io.read_file(file_path), channels=4)
-    cm_image = tf.expand_dims(cm_image, 0)
+    file_writer = tf.summary.create_file_writer(log_dir)
+    figure = plot_confusion_matrix(results["confusion"], class_names=CLASS_NAMES)
     with file_writer.as_default():
-        tf.summary.image("Confusion Matrix", cm_image, step=0)
-
-    # Calculate average AUC
-    auc_per_class = []
-    for i in range(len(CLASS_NAMES)):
-        true_positives = conf_matrix[i, i]
-        false_positives = conf_matrix[:, i].sum() - true_positives
-        false_negatives = conf_matrix[i, :].sum() - true_positives
-        true_negatives = conf_matrix.sum() - (
-            true_positives + false_positives + false_negatives
+        tf.summary.image(f"Confusion Matrix ({type})", plot_to_image(figure), step=0)
+    return average_auc
+
+
+def representative_dataset(data, samples=REPRESENTATIVE_SAMPLES):
+    """
+    Get a function yielding single images of the data, used to calibrate the int8 quantization.
+    """
+
+    def generator():
+        count = 0
+        for x, _ in iterate_batches(data):
+            for image in np.asarray(x, dtype=np.float32):
+                if count >= samples:
+                    return
+                count += 1
+                yield [image[np.newaxis]]
+
+    return generator
+
+
+@instrumented()
+def quantize_model(
+    model, path, test_data, train_data=None, modes=QUANTIZATION_MODES, runs=50
+):
+    """
+    Convert the model to each quantization mode and compare the variants with the float model.
+    The test data is read once, running every variant on each batch.
+
+    Args:
+        model: The trained Keras model.
+        path (str): The path of the variants without extension (saved as <path>_<mode>.tflite).
+        test_data: The test batches (see iterate_batches).
+        train_data: The train batches sampled to calibrate the int8 variant (skipped without them).
+        modes (list): The quantization modes (see model_convert).
+        runs (int): The number of single image runs used to measure the CPU latency.
+
+    Returns:
+        list: A report per variant with its mode, path, size in bytes, latency (p50/p95/p99 ms with the
+        TFLite interpreter), AUC of each class and its delta against the float model, and the
+        largest AUC drop of any class (None if the test data has no AUC).
+    """
+    variants = {}
+    for mode in modes:
+        if mode == "int8" and train_data is None:
+            print("Skipping the int8 variant without data to calibrate it.")
+            continue
+        variant_path = f"{path}_{mode}.tflite"
+        calibration = representative_dataset(train_data) if mode == "int8" else None
+        model_convert(model, variant_path, mode, calibration)
+        variants[mode] = TFLiteModel(variant_path)
+
+    actuals = []
+    confidences = {mode: [] for mode in ["keras", *variants]}
+    sample = None
+    for x, y in iterate_batches(test_data):
+        x = np.asarray(x, dtype=np.float32)
+        if sample is None:
+            sample = x[:1]
+        actuals.append(np.asarray(y) > 0.5)
+        confidences["keras"].append(np.asarray(model.predict_on_batch(x)))
+        for mode, variant in variants.items():
+            confidences[mode].append(variant.predict(x))
+
+    def class_aucs(name):
+        if not actuals:
+            return [None] * len(CLASS_NAMES)
+        return roc_auc_scores(
+            np.concatenate(actuals), np.concatenate(confidences[name])
         )
 
-        if (
-            true_positives + false_negatives > 0
-            and true_negatives + false_positives > 0
-        ):
-            sensitivity = true_positives / (true_positives + false_negatives)
-            specificity = true_negatives / (true_negatives + false_positives)
-            auc = (sensitivity + specificity) / 2
-            auc_per_class.append(auc)
+    float_aucs = class_aucs("keras")
+    reports = []
+    for mode, variant in variants.items():
+        aucs = class_aucs(mode)
+        deltas = [
+            None if auc is None or base is None else auc - base
+            for auc, base in zip(aucs, float_aucs)
+        ]
+        drops = [-delta for delta in deltas if delta is not None]
+        reports.append(
+            {
+                "mode": mode,
+                "path": variant.path,
+                "size_bytes": os.path.getsize(variant.path),
+                "latency": (
+                    measure_latency(variant, sample, runs)
+                    if sample is not None
+                    else None
+                ),
+                "auc": aucs,
+                "auc_delta": deltas,
+                "max_auc_drop": max(0.0, *drops) if drops else None,
+            }
+        )
+        print(
+            f"TFLite {mode}: {reports[-1]['size_bytes'] / 1024 / 1024:.2f} MB, "
+            f"latency {reports[-1]['latency']}, max AUC drop {reports[-1]['max_auc_drop']}"
+        )
+    return reports
 
-    average_auc = sum(auc_per_class) / len(auc_per_class) if auc_per_class else 0
-    return average_auc
+
+def choose_variant(reports, tolerance=QUANTIZATION_TOLERANCE):
+    """
+    Choose the fastest variant whose AUC drop of every class is within the tolerance.
+    The float32 variant is always accepted; variants that couldn't be evaluated are not.
+
+    Returns:
+        dict: The report of the chosen variant (None if there are no reports).
+    """
+    accepted = [
+        report
+        for report in reports
+        if report["mode"] == "float32"
+        or (report["max_auc_drop"] is not None and report["max_auc_drop"] <= tolerance)
+    ]
+    if not accepted:
+        return None
+    return min(
+        accepted,
+        key=lambda report: (
+            report["latency"]["p50_ms"] if report["latency"] else float("inf")
+        ),
+    )
 
 
 def plot_confusion_matrix(cm, class_names):
@@ -109,8 +323,13 @@ def plot_confusion_matrix(cm, class_names):
     return figure
 
 
-def plot_to_image(figure, file_path):
-    # Save the plot to a PNG file.
-    plt.savefig(file_path, format="png")
+def plot_to_image(figure):
+    """
+    Render a figure as a PNG in memory and decode it as a batch of one image for TensorBoard.
+    """
+    buffer = io.BytesIO()
+    plt.savefig(buffer, format="png")
     # Closing the figure prevents it from being displayed directly inside the notebook.
     plt.close(figure)
+    image = tf.image.decode_png(buffer.getvalue(), channels=4)
+    return tf.expand_dims(image, 0)
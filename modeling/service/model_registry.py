@@ -0,0 +1,202 @@
+"""
+Module for keeping track of the trained models in a registry file.
+
+Each version has its .keras file, the hash of the file, its metrics and tags, and the version it was
+retrained from. The champion is the version deployed to the clients and retrained next.
+Loaded models are kept in an in-process LRU cache by file and hash, so loading the champion again is instant.
+"""
+
+import hashlib
+import json
+import os
+import re
+from collections import OrderedDict
+from datetime import datetime
+
+from options import BEST_MODELS_PATH, MODEL_CACHE_SIZE, MODEL_REGISTRY_PATH
+
+MODEL_PATTERN = re.compile(r"weld_(\d+)\.keras")
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def file_hash(path):
+    """
+    Gets the SHA-256 of a file, read in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ModelCache:
+    """
+    LRU cache of loaded models by (file, hash), shared by the registries of the process.
+    """
+
+    def __init__(self, size=MODEL_CACHE_SIZE):
+        self.size = size
+        self.models = OrderedDict()
+
+    def get(self, key):
+        model = self.models.get(key)
+        if model is not None:
+            self.models.move_to_end(key)
+        return model
+
+    def put(self, key, model):
+        # A model trained in place and saved as a new version is no longer the old one
+        for old_key in [k for k, m in self.models.items() if m is model]:
+            del self.models[old_key]
+        if self.size <= 0:
+            return
+        self.models[key] = model
+        self.models.move_to_end(key)
+        while len(self.models) > self.size:
+            self.models.popitem(last=False)
+
+    def clear(self):
+        self.models.clear()
+
+
+loaded_models = ModelCache()
+
+
+class ModelRegistry:
+    """
+    File-backed registry of the model versions.
+
+    The state is {"champion": <version>, "versions": {<version>: {"version", "path", "hash", "created",
+    "parent", "metrics": {}, "tags": []}}}. Models already in the models folder when the registry is
+    created are registered, and the latest one becomes the champion.
+    """
+
+    def __init__(
+        self, path=MODEL_REGISTRY_PATH, models_path=BEST_MODELS_PATH, cache=None
+    ):
+        self.path = str(path)
+        self.models_path = str(models_path)
+        self.cache = loaded_models if cache is None else cache
+        try:
+            with open(self.path, "r") as f:
+                state = json.load(f)
+            self.champion = state["champion"]
+            self.versions = {int(v): record for v, record in state["versions"].items()}
+        except FileNotFoundError:
+            self.champion = None
+            self.versions = {}
+            self.register_existing()
+
+    def register_existing(self):
+        if not os.path.isdir(self.models_path):
+            return
+        for name in sorted(os.listdir(self.models_path)):
+            match = MODEL_PATTERN.fullmatch(name)
+            if match:
+                path = os.path.join(self.models_path, name)
+                self.add_version(int(match.group(1)), path, file_hash(path))
+        if self.versions:
+            self.champion = self.latest_version()
+            self.save()
+
+    def save(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(
+                {"champion": self.champion, "versions": self.versions}, f, indent=2
+            )
+        os.replace(temp_path, self.path)  # Never leave a partial registry
+
+    def latest_version(self):
+        """
+        Gets the highest registered version (0 if there is none).
+        """
+        return max(self.versions, default=0)
+
+    def model_path(self, version):
+        return os.path.join(self.models_path, f"weld_{version}.keras")
+
+    def add_version(
+        self, version, path, content_hash, parent=None, metrics=None, tags=None
+    ):
+        self.versions[version] = {
+            "version": version,
+            "path": path,
+            "hash": content_hash,
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "parent": parent,
+            "metrics": metrics or {},
+            "tags": tags or [],
+        }
+
+    def register(self, model, metrics=None, tags=None, parent=None):
+        """
+        Save a model as the next version and keep it in the cache.
+
+        Args:
+            model: The Keras model.
+            metrics (dict): The metrics of the model, if already measured.
+            tags (list): Tags of the model (e.g., initial, weld, mobilenet).
+            parent (int): The version it was retrained from.
+
+        Returns:
+            int: The new version.
+        """
+        from service.model_creation import model_store  # Loads TensorFlow
+
+        version = self.latest_version() + 1
+        path = self.model_path(version)
+        os.makedirs(self.models_path, exist_ok=True)
+        print(f"Saving model to {path}")
+        model_store(model, path)
+        content_hash = file_hash(path)
+        self.add_version(version, path, content_hash, parent, metrics, tags)
+        self.save()
+        self.cache.put((os.path.abspath(path), content_hash), model)
+        return version
+
+    def update(self, version, metrics=None, tags=None):
+        """
+        Add metrics and tags to a version.
+        """
+        record = self.versions[version]
+        record["metrics"].update(metrics or {})
+        record["tags"].extend(tag for tag in tags or [] if tag not in record["tags"])
+        self.save()
+
+    def set_champion(self, version):
+        if version not in self.versions:
+            raise KeyError(f"Model version {version} is not registered")
+        self.champion = version
+        self.save()
+
+    def load(self, version=None, copy=False):
+        """
+        Load a version (the champion by default), from the cache if it was already loaded.
+        The same model instance is returned while it is cached, unless a copy is requested
+        (e.g., to retrain it, so a failed retraining doesn't leave the cached version changed).
+
+        Returns:
+            The Keras model, or None if there is no such version.
+        """
+        version = self.champion if version is None else version
+        record = self.versions.get(version)
+        if record is None:
+            return None
+        key = (os.path.abspath(record["path"]), record["hash"])
+        model = self.cache.get(key)
+        if model is None:
+            from service.model_creation import model_load  # Loads TensorFlow
+
+            if file_hash(record["path"]) != record["hash"]:
+                print(f"WARNING: The file of model version {version} has changed.")
+            model = model_load(record["path"])
+            self.cache.put(key, model)
+        if copy:
+            from service.model_creation import model_copy
+
+            return model_copy(model)
+        return model
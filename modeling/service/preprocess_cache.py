@@ -0,0 +1,159 @@
+"""
+Module for caching preprocessed images by the content of the raw image and the preprocessing parameters.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import shutil
+import threading
+
+from options import (
+    GAUSSIAN_FILTER_RADIUS,
+    MEDIAN_FILTER_SIZE,
+    PREPROCESS_CACHE_PATH,
+    PREPROCESS_CACHE_SIZE,
+    TARGET_SIZE,
+)
+
+CACHE_VERSION = 1  # Increase when the preprocessing code changes its output
+PARAMETERS_FILE = "parameters.json"
+
+
+def preprocess_parameters():
+    """
+    Gets the settings that change the output of the preprocessing.
+    """
+    return {
+        "version": CACHE_VERSION,
+        "target_size": list(TARGET_SIZE),
+        "median_filter_size": MEDIAN_FILTER_SIZE,
+        "gaussian_filter_radius": GAUSSIAN_FILTER_RADIUS,
+    }
+
+
+class PreprocessCache:
+    """
+    Content-addressed cache of preprocessed images stored as <path>/<key[:2]>/<key>.jpg.
+
+    The key is the hash of the raw image bytes and the preprocessing parameters. Entries are
+    evicted by least recent use when the cache grows over max_size bytes.
+    """
+
+    def __init__(
+        self,
+        path=PREPROCESS_CACHE_PATH,
+        max_size=PREPROCESS_CACHE_SIZE,
+        parameters=None,
+    ):
+        self.path = path
+        self.max_size = max_size
+        self.parameters = parameters or preprocess_parameters()
+        self.fingerprint = json.dumps(self.parameters, sort_keys=True).encode()
+        self.hits = 0
+        self.misses = 0
+
+    def validate(self):
+        """
+        Empties the cache if it was created with different preprocessing parameters.
+
+        Returns:
+            bool: True if the cache was invalidated.
+        """
+        parameters_path = os.path.join(self.path, PARAMETERS_FILE)
+        try:
+            with open(parameters_path, "r") as f:
+                if json.load(f) == self.parameters:
+                    return False
+        except (FileNotFoundError, ValueError):
+            pass
+        # Move the stale cache away atomically before removing it, so concurrent shards
+        # writing to the cache never see it half-removed
+        stale_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.stale"
+        try:
+            os.replace(self.path, stale_path)
+        except FileNotFoundError:  # No cache yet, or moved away by another shard
+            pass
+        # Also remove the leftovers of shards that wrote into a stale cache while it was removed
+        for path in glob.glob(f"{glob.escape(self.path)}.*.stale"):
+            shutil.rmtree(path, ignore_errors=True)
+        temp_path = f"{parameters_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(temp_path, "w") as f:
+                json.dump(self.parameters, f)
+            os.replace(temp_path, parameters_path)
+        except (FileNotFoundError, FileExistsError):
+            pass  # Moved away by another shard, which writes its own
+        return True
+
+    def key(self, content):
+        """
+        Gets the key of a raw image from its bytes.
+        """
+        return hashlib.sha256(self.fingerprint + content).hexdigest()
+
+    def entry_path(self, key):
+        return os.path.join(self.path, key[:2], f"{key}.jpg")
+
+    def get(self, key):
+        """
+        Gets the preprocessed image bytes of a key, or None if they are not cached.
+        """
+        path = self.entry_path(key)
+        try:
+            with open(path, "rb") as f:
+                content = f.read()
+            os.utime(path)  # Mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return content
+
+    def put(self, key, content):
+        """
+        Stores the preprocessed image bytes of a key.
+        """
+        path = self.entry_path(key)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temp_path, "wb") as f:
+                f.write(content)
+            # Atomic, so other workers never read partial files
+            os.replace(temp_path, path)
+        except (FileNotFoundError, FileExistsError):
+            pass  # Moved away by a shard invalidating the cache, skip the entry
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size.
+
+        Returns:
+            int: The number of entries removed.
+        """
+        entries = []
+        size = 0
+        for root, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(".jpg"):
+                    continue
+                try:
+                    stat = os.stat(os.path.join(root, name))
+                except FileNotFoundError:  # Evicted by another shard
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+                size += stat.st_size
+        removed = 0
+        for _, entry_size, path in sorted(entries):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= entry_size
+            removed += 1
+        return removed
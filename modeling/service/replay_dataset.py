@@ -0,0 +1,187 @@
+"""
+Module for training on a replay sample of every collected split instead of only the newest one.
+
+The split images of the initial split and of the daily splits are listed from the dataset index, so
+nothing is copied (the sets that changed since they were indexed are scanned first). The daily images
+of the last REPLAY_WINDOW_DAYS days (by the date of their splits/YYYYMMDD folder) are the recent ones,
+and the initial images and the older daily images are the history. Each set (train, valid, test) is
+sampled with a REPLAY_RATIO fraction of history images and at most REPLAY_MAX_IMAGES images, so the cost
+of a retraining doesn't grow with the days collected. The sample is read by path with tf.data and has
+the multi-hot labels of the image names, as the TFRecord splits.
+"""
+
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+import tensorflow as tf
+
+from options import (
+    CLASS_NAMES,
+    INITIAL_PATH,
+    REPLAY_MAX_IMAGES,
+    REPLAY_RATIO,
+    REPLAY_WINDOW_DAYS,
+    SPLIT_NAMES,
+    SPLIT_PATH,
+    TRAIN_BATCH_SIZE,
+)
+from service.dataset_index import normalize_folder
+from service.tfrecord_dataset import is_tfrecord_split, label_vector
+from service.training_configuration import (
+    IMAGE_EXTENSIONS,
+    decode_image,
+    rescale_images,
+)
+
+
+def in_folder(row, folder):
+    return row["folder"].startswith(normalize_folder(folder) + os.sep)
+
+
+def split_date(row, split_path=SPLIT_PATH):
+    """
+    Gets the date of a daily split image from its folder (<split_path>/YYYYMMDD/<set>), or the date
+    it was indexed if the folder isn't named by date.
+    """
+    day = os.path.relpath(row["folder"], normalize_folder(split_path)).split(os.sep)[0]
+    return day if len(day) == 8 and day.isdigit() else row["date"]
+
+
+def sync_splits(index, initial_path=INITIAL_PATH, split_path=SPLIT_PATH):
+    """
+    Add to the index the images of the initial and daily splits written without it (or changed since).
+    TFRecord splits are skipped, as their images are only indexed by the writers.
+    """
+    roots = [initial_path]
+    if os.path.isdir(split_path):
+        roots += [
+            os.path.join(split_path, day) for day in sorted(os.listdir(split_path))
+        ]
+    for root in roots:
+        if not os.path.isdir(root) or is_tfrecord_split(root):
+            continue
+        for split in SPLIT_NAMES:
+            if os.path.isdir(os.path.join(root, split)):
+                index.sync_split(os.path.join(root, split), split)
+
+
+def replay_rows(
+    index,
+    split,
+    initial_path=INITIAL_PATH,
+    split_path=SPLIT_PATH,
+    window_days=REPLAY_WINDOW_DAYS,
+    today=None,
+):
+    """
+    List the images of a set from the index, separated in recent and history images.
+    Images stored in TFRecord shards are not listed, as they have no file of their own.
+
+    Returns:
+        list: The rows of the daily images of the last window_days days.
+        list: The rows of the initial images and the older daily images.
+    """
+    today = today or datetime.now()
+    since = (today - timedelta(days=window_days)).strftime("%Y%m%d")
+    recent = []
+    history = []
+    for row in index.query(stage="split", split=split):
+        if not row["path"].lower().endswith(IMAGE_EXTENSIONS):
+            continue
+        if in_folder(row, split_path):
+            (recent if split_date(row, split_path) >= since else history).append(row)
+        elif in_folder(row, initial_path):
+            history.append(row)
+    return recent, history
+
+
+def sample_rows(
+    recent, history, ratio=REPLAY_RATIO, max_images=REPLAY_MAX_IMAGES, rng=None
+):
+    """
+    Sample the recent and history images, with a ratio fraction of history images and at most max_images.
+    With few recent images, fewer history images are taken to keep the ratio.
+
+    Returns:
+        list: The sampled rows, in the order of the index.
+    """
+    rng = rng or np.random.default_rng()
+    recent_count = min(len(recent), round(max_images * (1 - ratio)))
+    if recent_count == 0 or ratio >= 1:
+        history_count = round(max_images * ratio)
+    else:
+        history_count = round(recent_count * ratio / (1 - ratio))
+    history_count = min(len(history), history_count)
+    sample = []
+    for rows, count in [(recent, recent_count), (history, history_count)]:
+        chosen = np.sort(rng.choice(len(rows), count, replace=False)) if count else []
+        sample.extend(rows[i] for i in chosen)
+    return sample
+
+
+def replay_dataset(rows, shuffle=False, batch_size=TRAIN_BATCH_SIZE):
+    """
+    Build a tf.data pipeline that decodes the sampled images by path in parallel.
+    The dataset has the paths and labels attributes, e.g., to cache the embeddings of the images.
+    """
+    paths = [row["path"] for row in rows]
+    labels = np.array(
+        [label_vector(row["labels"].split("_")) for row in rows], dtype=np.float32
+    ).reshape(-1, len(CLASS_NAMES))
+    dataset = tf.data.Dataset.from_tensor_slices((paths, labels))
+    if shuffle:  # The paths are shuffled before decoding, so it takes little memory
+        dataset = dataset.shuffle(max(len(paths), 1), reshuffle_each_iteration=True)
+    dataset = dataset.map(decode_image, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(int(batch_size))
+    dataset = dataset.map(rescale_images, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    dataset.paths = paths
+    dataset.labels = labels
+    return dataset
+
+
+def get_replay_splits(
+    index,
+    initial_path=INITIAL_PATH,
+    split_path=SPLIT_PATH,
+    ratio=REPLAY_RATIO,
+    window_days=REPLAY_WINDOW_DAYS,
+    max_images=REPLAY_MAX_IMAGES,
+    seed=None,
+    today=None,
+):
+    """
+    Get the train, validation and test datasets of a replay sample of the initial and daily splits.
+
+    Args:
+        index (DatasetIndex): The dataset index with the split images.
+        initial_path (str): The folder of the initial split.
+        split_path (str): The folder of the daily splits.
+        ratio (float): The fraction of history images (initial and older daily images) of each set.
+        window_days (int): The days of daily splits considered recent.
+        max_images (int): The maximum number of images of each set.
+        seed (int): The seed of the sample (None = a different sample on each retraining).
+        today (datetime): The end of the recency window (default now).
+
+    Returns:
+        tuple: The train, validation and test datasets, with multi-hot labels.
+    """
+    rng = np.random.default_rng(seed)
+    sync_splits(index, initial_path, split_path)
+    datasets = []
+    for split in SPLIT_NAMES:
+        recent, history = replay_rows(
+            index, split, initial_path, split_path, window_days, today
+        )
+        rows = [
+            row
+            for row in sample_rows(recent, history, ratio, max_images, rng)
+            if os.path.exists(row["path"])  # Only the sample is checked
+        ]
+        print(
+            f"Replay {split} set: {len(rows)} images from {len(recent)} recent "
+            f"and {len(history)} history images."
+        )
+        datasets.append(replay_dataset(rows, shuffle=split == SPLIT_NAMES[0]))
+    return tuple(datasets)
@@ -0,0 +1,225 @@
+"""
+Module for exporting the dataset splits as memory-mapped uint8 arrays and loading them for training.
+
+Each split is saved once in <split_folder>/tensors/<split>/ as:
+- images.npy: uint8 array of shape (N, height, width, 3) with the decoded and resized images.
+- labels.npy: float32 array of shape (N, 7) with the multi-hot classes from the file names.
+- ids.json: the file name of each image, the size of the images and the fingerprint of the set files.
+
+The arrays are opened with np.load(mmap_mode="r"), so the images are never decoded again, batches
+are contiguous slices of the file and the pages are shared by every process through the OS page cache.
+"""
+
+import hashlib
+import json
+import os
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from options import (
+    CLASS_NAMES,
+    PREPROCESS_WORKERS,
+    SPLIT_NAMES,
+    TARGET_SIZE,
+    TRAIN_BATCH_SIZE,
+)
+from service.image_transformations import divide_image_labels
+from service.tfrecord_dataset import label_vector
+
+TENSOR_FOLDER = "tensors"
+IMAGES_FILE = "images.npy"
+LABELS_FILE = "labels.npy"
+IDS_FILE = "ids.json"
+
+
+def tensor_store_path(root_path, split):
+    return os.path.join(root_path, TENSOR_FOLDER, split)
+
+
+def list_split_images(split_path):
+    """
+    List the images of a set stored in a folder per class, once per image.
+
+    Returns:
+        dict: The path of each image by its file name.
+    """
+    images = {}
+    for class_name in sorted(os.listdir(split_path)):
+        class_dir = os.path.join(split_path, class_name)
+        if class_name == TENSOR_FOLDER or not os.path.isdir(class_dir):
+            continue
+        for name in os.listdir(class_dir):
+            if name.endswith(".jpg"):
+                images.setdefault(name, os.path.join(class_dir, name))
+    return images
+
+
+def split_fingerprint(images):
+    """
+    Hash the names, sizes and modification times of the images of a set, to detect when it changes.
+    """
+    digest = hashlib.md5()
+    for name in sorted(images):
+        stat = os.stat(images[name])
+        digest.update(f"{name}:{stat.st_size}:{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def decode_resized(path):
+    with Image.open(path) as img:
+        img = img.convert("RGB")
+        if img.size != TARGET_SIZE:
+            img = img.resize(TARGET_SIZE, Image.NEAREST)
+        return np.asarray(img, dtype=np.uint8)
+
+
+def export_split(split_path, destination, seed=0, workers=PREPROCESS_WORKERS):
+    """
+    Decode the images of a set once into a memory-mapped uint8 array.
+    The images are stored in a shuffled order, so the contiguous batches mix the classes.
+
+    Args:
+        split_path (str): The folder of the set, with a folder per class.
+        destination (str): The folder where the arrays are saved.
+        seed (int): The seed of the order of the images.
+        workers (int): The number of threads decoding images (0 = one per CPU core).
+
+    Returns:
+        int: The number of images exported.
+    """
+    images = list_split_images(split_path)
+    fingerprint = split_fingerprint(images)
+    names = sorted(images)
+    random.Random(seed).shuffle(names)
+
+    temp_path = f"{destination}.tmp"
+    shutil.rmtree(temp_path, ignore_errors=True)
+    os.makedirs(temp_path)
+    shape = (len(names), TARGET_SIZE[1], TARGET_SIZE[0], 3)
+    if names:
+        array = np.lib.format.open_memmap(
+            os.path.join(temp_path, IMAGES_FILE), mode="w+", dtype=np.uint8, shape=shape
+        )
+
+        def decode_into(index):
+            array[index] = decode_resized(images[names[index]])
+
+        # Each thread writes its own rows, and PIL releases the GIL while decoding
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+            list(executor.map(decode_into, range(len(names))))
+        array.flush()
+        del array
+    else:
+        np.save(os.path.join(temp_path, IMAGES_FILE), np.zeros(shape, dtype=np.uint8))
+
+    labels = np.zeros((len(names), len(CLASS_NAMES)), dtype=np.float32)
+    for i, name in enumerate(names):
+        labels[i] = label_vector(divide_image_labels(name)[1])
+    np.save(os.path.join(temp_path, LABELS_FILE), labels)
+    with open(os.path.join(temp_path, IDS_FILE), "w") as f:
+        stored = {"target_size": list(TARGET_SIZE), "fingerprint": fingerprint}
+        json.dump({**stored, "ids": names}, f)
+
+    shutil.rmtree(destination, ignore_errors=True)
+    os.replace(temp_path, destination)  # Only complete stores are ever loaded
+    return len(names)
+
+
+def is_tensor_store(root_path):
+    """
+    Check if the splits of a folder are exported with the current image size and the current files
+    (e.g., not if the periodic flow added images to the same daily split afterwards).
+    """
+    for split in SPLIT_NAMES:
+        try:
+            with open(os.path.join(tensor_store_path(root_path, split), IDS_FILE)) as f:
+                stored = json.load(f)
+            if stored["target_size"] != list(TARGET_SIZE):
+                return False
+            images = list_split_images(os.path.join(root_path, split))
+            if stored["fingerprint"] != split_fingerprint(images):
+                return False
+        except (FileNotFoundError, ValueError, KeyError):
+            return False
+    return True
+
+
+def export_tensor_store(root_path):
+    """
+    Export the train, valid and test sets of a split folder as memory-mapped arrays.
+
+    Returns:
+        int: The number of images exported.
+    """
+    total = 0
+    for split in SPLIT_NAMES:
+        total += export_split(
+            os.path.join(root_path, split), tensor_store_path(root_path, split)
+        )
+    print(f"Exported {total} images of {root_path} to memory-mapped arrays.")
+    return total
+
+
+def load_array(path):
+    """
+    Open an array of the store as read-only memory-mapped file.
+    """
+    try:
+        return np.load(path, mmap_mode="r")
+    except ValueError:  # Empty arrays can't be memory-mapped
+        return np.load(path)
+
+
+class TensorStoreSequence(tf.keras.utils.Sequence):
+    """
+    Batches of a memory-mapped set for model.fit, model.evaluate and model.predict.
+
+    Each batch is a contiguous slice of the array (a view of the mapped pages, without copies)
+    that is only converted to float32 for the model. Shuffling changes the order of the batches.
+    As the Keras generators, it has the classes and class_indices attributes.
+    """
+
+    def __init__(self, path, batch_size=TRAIN_BATCH_SIZE, shuffle=False, **kwargs):
+        super().__init__(**kwargs)
+        self.images = load_array(os.path.join(path, IMAGES_FILE))
+        self.labels = np.load(os.path.join(path, LABELS_FILE))
+        self.batch_size = int(batch_size)
+        self.shuffle = shuffle
+        self.order = np.arange(len(self))
+        self.classes = self.labels.argmax(axis=1)
+        self.class_indices = {name: i for i, name in enumerate(CLASS_NAMES)}
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.images) // self.batch_size)
+
+    def __getitem__(self, index):
+        start = int(self.order[index]) * self.batch_size
+        stop = start + self.batch_size
+        images = self.images[start:stop].astype(np.float32)
+        images *= 1.0 / 255
+        return images, self.labels[start:stop]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+
+def get_tensor_splits(root_path, batch_size=TRAIN_BATCH_SIZE):
+    """
+    Get the train, validation and test sets of a split folder from its memory-mapped arrays.
+    The splits are exported the first time, so later epochs and retrains skip decoding the images.
+    """
+    if not is_tensor_store(root_path):
+        export_tensor_store(root_path)
+    train = TensorStoreSequence(
+        tensor_store_path(root_path, "train"), batch_size, shuffle=True
+    )
+    validation = TensorStoreSequence(tensor_store_path(root_path, "valid"), batch_size)
+    test = TensorStoreSequence(tensor_store_path(root_path, "test"), batch_size)
+    return train, validation, test
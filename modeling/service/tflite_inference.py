@@ -0,0 +1,61 @@
+"""
+Module for running the converted TFLite models on the CPU, as the clients do.
+"""
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+class TFLiteModel:
+    """
+    TFLite interpreter of a model with a single input and output.
+    The input is resized when the batch size changes, so batches are run with a single invoke.
+    """
+
+    def __init__(self, path, num_threads=None):
+        self.path = str(path)
+        self.interpreter = tf.lite.Interpreter(
+            model_path=self.path, num_threads=num_threads
+        )
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+
+    def resize(self, batch_size):
+        if batch_size != self.batch_size:
+            shape = [batch_size, *self.input["shape"][1:]]
+            self.interpreter.resize_tensor_input(self.input["index"], shape)
+            self.interpreter.allocate_tensors()
+            self.batch_size = batch_size
+
+    def predict(self, images):
+        """
+        Run a batch of images (N, height, width, 3) scaled to [0, 1].
+
+        Returns:
+            np.ndarray: The confidences of each class (N, 7).
+        """
+        images = np.asarray(images, dtype=self.input["dtype"])
+        self.resize(len(images))
+        self.interpreter.set_tensor(self.input["index"], images)
+        self.interpreter.invoke()
+        return self.interpreter.get_tensor(self.output["index"]).copy()
+
+
+def measure_latency(model, images, runs=50, warmup=5):
+    """
+    Measure the latency of running a batch of images with a TFLite model.
+
+    Returns:
+        dict: The p50, p95 and p99 latencies in milliseconds.
+    """
+    latencies = []
+    for run in range(warmup + runs):
+        start = time.perf_counter()
+        model.predict(images)
+        if run >= warmup:
+            latencies.append(time.perf_counter() - start)
+    p50, p95, p99 = np.percentile(np.array(latencies) * 1000, [50, 95, 99])
+    return {"p50_ms": float(p50), "p95_ms": float(p95), "p99_ms": float(p99)}
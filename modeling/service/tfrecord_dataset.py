@@ -0,0 +1,192 @@
+"""
+Module for storing the dataset splits as sharded TFRecord files and reading them for training.
+
+Each split folder (train, valid, test) holds <split>-<number>.tfrecord shards of about
+TFRECORD_SHARD_SIZE bytes and an index.json with the images and bytes of every shard.
+"""
+
+import json
+import os
+
+import tensorflow as tf
+
+from options import (
+    CLASS_NAMES,
+    CLASS_THRESHOLD,
+    SPLIT_NAMES,
+    TARGET_SIZE,
+    TFRECORD_SHARD_SIZE,
+    TRAIN_BATCH_SIZE,
+)
+
+INDEX_FILE = "index.json"
+FEATURES = {
+    "image": tf.io.FixedLenFeature([], tf.string),
+    "id": tf.io.FixedLenFeature([], tf.string),
+    "label": tf.io.FixedLenFeature([len(CLASS_NAMES)], tf.float32),
+}
+
+
+def label_vector(labels):
+    """
+    Gets the multi-hot vector of the classes from the labels, ignoring confidences (<label>-<confidence>).
+    """
+    return [
+        1.0 if float(label.split("-")[0]) >= CLASS_THRESHOLD else 0.0
+        for label in labels
+    ]
+
+
+def serialize_example(encoded, image_id, labels):
+    """
+    Serialize an encoded image with its id and multi-hot labels as a tf.train.Example.
+    """
+    feature = {
+        "image": tf.train.Feature(bytes_list=tf.train.BytesList(value=[encoded])),
+        "id": tf.train.Feature(
+            bytes_list=tf.train.BytesList(value=[image_id.encode()])
+        ),
+        "label": tf.train.Feature(float_list=tf.train.FloatList(value=labels)),
+    }
+    example = tf.train.Example(features=tf.train.Features(feature=feature))
+    return example.SerializeToString()
+
+
+def load_index(split_path):
+    """
+    Read the index of the shards of a split (empty if it has none yet).
+    """
+    try:
+        with open(os.path.join(split_path, INDEX_FILE), "r") as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {"count": 0, "shards": []}
+
+
+class TFRecordSplitWriter:
+    """
+    Writes images to the shards of their split, starting a new shard when the current one is full.
+    New shards are added after the ones already in the split folders.
+    """
+
+    def __init__(self, split_dir, shard_size=TFRECORD_SHARD_SIZE):
+        self.split_dir = split_dir
+        self.shard_size = shard_size
+        self.indexes = {
+            split: load_index(os.path.join(split_dir, split)) for split in SPLIT_NAMES
+        }
+        self.writers = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def write(self, split, image_id, encoded, labels):
+        """
+        Add an image to a split.
+
+        Args:
+            split (str): The split name.
+            image_id (str): The id of the image.
+            encoded (bytes): The image file (e.g., JPEG).
+            labels (list): The labels of each class from the file name.
+        """
+        index = self.indexes[split]
+        if split not in self.writers or index["shards"][-1]["bytes"] >= self.shard_size:
+            self.next_shard(split)
+        record = serialize_example(encoded, image_id, label_vector(labels))
+        self.writers[split].write(record)
+        index["shards"][-1]["count"] += 1
+        index["shards"][-1]["bytes"] += len(record)
+        index["count"] += 1
+
+    def shard_path(self, split):
+        """
+        Gets the path of the shard where the last image of a split was written.
+        """
+        shard = self.indexes[split]["shards"][-1]["file"]
+        return os.path.join(self.split_dir, split, shard)
+
+    def next_shard(self, split):
+        if split in self.writers:
+            self.writers[split].close()
+        split_path = os.path.join(self.split_dir, split)
+        os.makedirs(split_path, exist_ok=True)
+        index = self.indexes[split]
+        file_name = f"{split}-{len(index['shards']):05d}.tfrecord"
+        self.writers[split] = tf.io.TFRecordWriter(os.path.join(split_path, file_name))
+        index["shards"].append({"file": file_name, "count": 0, "bytes": 0})
+
+    def close(self):
+        """
+        Close the open shards and save the index of every split.
+        """
+        for writer in self.writers.values():
+            writer.close()
+        self.writers = {}
+        for split, index in self.indexes.items():
+            split_path = os.path.join(self.split_dir, split)
+            os.makedirs(split_path, exist_ok=True)
+            with open(os.path.join(split_path, INDEX_FILE), "w") as f:
+                json.dump(index, f, indent=2)
+
+
+def is_tfrecord_split(root_path):
+    """
+    Check if a split folder is stored as TFRecord shards.
+    """
+    return os.path.isfile(os.path.join(root_path, SPLIT_NAMES[0], INDEX_FILE))
+
+
+def parse_example(record):
+    example = tf.io.parse_single_example(record, FEATURES)
+    image = tf.io.decode_jpeg(example["image"], channels=3)
+    image = tf.image.resize(image, TARGET_SIZE[::-1], method="nearest")
+    return tf.cast(image, tf.float32) / 255.0, example["label"]
+
+
+def load_tfrecord_split(
+    split_path, shuffle=False, max_shards=None, batch_size=TRAIN_BATCH_SIZE
+):
+    """
+    Read the shards of a split in parallel with interleave.
+
+    Args:
+        split_path (str): The folder of the split (e.g., data/splits/<date>/train).
+        shuffle (bool): Whether to shuffle the shards and images.
+        max_shards (int): Read only the first shards of the index (None = all), e.g., for a quick evaluation.
+        batch_size (int): The number of images per batch.
+
+    Returns:
+        tf.data.Dataset: Batches of images and their multi-hot labels.
+    """
+    shards = load_index(split_path)["shards"][:max_shards]
+    files = [os.path.join(split_path, shard["file"]) for shard in shards]
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if shuffle:
+        dataset = dataset.shuffle(max(len(files), 1))
+    dataset = dataset.interleave(
+        tf.data.TFRecordDataset,
+        cycle_length=max(min(len(files), 8), 1),
+        num_parallel_calls=tf.data.AUTOTUNE,
+        deterministic=not shuffle,
+    )
+    if shuffle:  # Shuffles the encoded records, so it takes little memory
+        dataset = dataset.shuffle(1024)
+    dataset = dataset.map(parse_example, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.batch(int(batch_size))
+    return dataset.prefetch(tf.data.AUTOTUNE)
+
+
+def get_tfrecord_splits(root_path, test_shards=None):
+    """
+    Get the train, validation and test datasets of a split folder stored as TFRecord shards.
+    """
+    train_dataset = load_tfrecord_split(os.path.join(root_path, "train"), shuffle=True)
+    validation_dataset = load_tfrecord_split(os.path.join(root_path, "valid"))
+    test_dataset = load_tfrecord_split(
+        os.path.join(root_path, "test"), max_shards=test_shards
+    )
+    return train_dataset, validation_dataset, test_dataset
@@ -1,15 +1,35 @@
+import os
+
+import numpy as np
 import tensorflow as tf
 from tensorflow.keras.preprocessing.image import ImageDataGenerator
 
-from options import TARGET_SIZE, TRAIN_BATCH_SIZE
+from options import (
+    CPU_INTER_OP_THREADS,
+    CPU_INTRA_OP_THREADS,
+    DATA_BACKEND,
+    DATA_CACHE,
+    MIXED_PRECISION,
+    TARGET_SIZE,
+    TRAIN_BATCH_SIZE,
+)
+from service.tensor_store import get_tensor_splits
+from service.tfrecord_dataset import get_tfrecord_splits, is_tfrecord_split
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png")
+CACHE_SHUFFLE_BUFFER = 1024  # Decoded images shuffled after a cache
+
 
-# Set the GPU options before any other usage
-try:
-    physical_devices = tf.config.list_physical_devices("GPU")
-    for device in physical_devices:
-        tf.config.experimental.set_memory_growth(device, True)
-except Exception as e:
-    print(e)
+def configure_gpus():
+    """
+    Let TensorFlow take the GPU memory as it needs it, instead of all of it at once.
+    It must run before TensorFlow uses the GPUs (e.g., at the start of the training flows).
+    """
+    try:
+        for device in tf.config.list_physical_devices("GPU"):
+            tf.config.experimental.set_memory_growth(device, True)
+    except Exception as e:
+        print(e)
 
 
 def get_device():
@@ -24,7 +44,76 @@ def get_device():
     )
 
 
-def get_split_generators(root_path):
+def cpu_supports_bfloat16():
+    """
+    Check whether the CPU has bfloat16 instructions (AVX512_BF16 or AMX), from /proc/cpuinfo (Linux).
+    """
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    flags = line.split()
+                    return "avx512_bf16" in flags or "amx_bf16" in flags
+    except OSError:
+        pass
+    return False
+
+
+def configure_cpu_training(
+    intra_threads=CPU_INTRA_OP_THREADS,
+    inter_threads=CPU_INTER_OP_THREADS,
+    precision=MIXED_PRECISION,
+):
+    """
+    Set the thread pools and the precision for training on the CPU.
+    The thread pools can only be set before TensorFlow runs its first operation, and the precision
+    applies to the models built afterwards.
+
+    Args:
+        intra_threads (int): Threads used inside each operation (0 = one per core).
+        inter_threads (int): Operations run at the same time (0 = chosen by TensorFlow).
+        precision (str): "auto" (mixed bfloat16 if the CPU supports it), "bfloat16" or "float32".
+
+    Returns:
+        dict: The settings in use.
+    """
+    try:
+        tf.config.threading.set_intra_op_parallelism_threads(intra_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(inter_threads)
+    except RuntimeError as e:
+        print(f"Keeping the thread pools, TensorFlow is already running: {e}")
+    bfloat16 = precision == "bfloat16" or (
+        precision == "auto" and cpu_supports_bfloat16()
+    )
+    policy = "mixed_bfloat16" if bfloat16 else "float32"
+    tf.keras.mixed_precision.set_global_policy(policy)
+    return {
+        "intra_op_threads": tf.config.threading.get_intra_op_parallelism_threads(),
+        "inter_op_threads": tf.config.threading.get_inter_op_parallelism_threads(),
+        "precision": policy,
+        "onednn": os.environ.get("TF_ENABLE_ONEDNN_OPTS") == "1",
+    }
+
+
+def get_split_generators(root_path, backend=DATA_BACKEND):
+    """
+    Get the train, validation and test data of a split folder.
+
+    Args:
+        root_path (str): The folder with the train, valid and test sets, each with a folder per class.
+        backend (str): "tfdata" for tf.data pipelines, "tensorstore" for memory-mapped uint8 arrays
+            (multi-hot labels) or "generator" for Keras ImageDataGenerators.
+
+    Returns:
+        tuple: The train, validation and test data, with one-hot labels by class folder
+        (or multi-hot labels if the split is stored as TFRecord shards).
+    """
+    if is_tfrecord_split(root_path):
+        return get_tfrecord_splits(root_path)
+    if backend == "tfdata":
+        return get_split_datasets(root_path)
+    if backend == "tensorstore":
+        return get_tensor_splits(root_path)
     train_path = f"{root_path}/train"
     validation_path = f"{root_path}/valid"
     test_path = f"{root_path}/test"
@@ -55,3 +144,93 @@ def get_split_generators(root_path):
     )
 
     return train_generator, validation_generator, test_generator
+
+
+def list_class_files(path):
+    """
+    List the images of a set with their class index, in the same order as flow_from_directory.
+
+    Returns:
+        list: The paths of the images.
+        np.ndarray: The index of the class of each image.
+        list: The class names, sorted alphabetically.
+    """
+    class_names = sorted(
+        d for d in os.listdir(path) if os.path.isdir(os.path.join(path, d))
+    )
+    files = []
+    classes = []
+    for index, class_name in enumerate(class_names):
+        class_dir = os.path.join(path, class_name)
+        for name in sorted(os.listdir(class_dir)):
+            if name.lower().endswith(IMAGE_EXTENSIONS):
+                files.append(os.path.join(class_dir, name))
+                classes.append(index)
+    return files, np.array(classes, dtype=np.int32), class_names
+
+
+def decode_image(path, label):
+    image = tf.io.read_file(path)
+    image = tf.io.decode_image(image, channels=3, expand_animations=False)
+    image = tf.image.resize(image, TARGET_SIZE[::-1], method="nearest")
+    return tf.cast(image, tf.uint8), label
+
+
+def rescale_images(images, labels):
+    return tf.cast(images, tf.float32) / 255.0, labels
+
+
+def get_dataset(path, shuffle=False, batch_size=TRAIN_BATCH_SIZE, cache=None):
+    """
+    Build a tf.data pipeline that decodes the images of a set in parallel.
+    Decoded images can be cached (as uint8 to use 4 times less memory) and batches are prefetched.
+    The dataset has the classes and class_indices attributes, as the Keras generators.
+
+    Args:
+        cache (str): The file prefix of a disk cache, "" to cache in memory, or None to not cache.
+    """
+    files, classes, class_names = list_class_files(path)
+    labels = np.eye(len(class_names), dtype=np.float32)[classes]
+    dataset = tf.data.Dataset.from_tensor_slices((files, labels))
+    if shuffle:  # The paths are shuffled before decoding, so it takes little memory
+        dataset = dataset.shuffle(max(len(files), 1), reshuffle_each_iteration=True)
+    dataset = dataset.map(decode_image, num_parallel_calls=tf.data.AUTOTUNE)
+    if cache is not None:
+        dataset = dataset.cache(cache)
+        if shuffle:  # The cache repeats the order of the first epoch
+            dataset = dataset.shuffle(CACHE_SHUFFLE_BUFFER)
+    dataset = dataset.batch(int(batch_size))
+    dataset = dataset.map(rescale_images, num_parallel_calls=tf.data.AUTOTUNE)
+    dataset = dataset.prefetch(tf.data.AUTOTUNE)
+    dataset.classes = classes
+    dataset.class_indices = {name: i for i, name in enumerate(class_names)}
+    return dataset
+
+
+def dataset_cache_path(root_path, split):
+    """
+    Get the file of the disk cache of a set ("" to cache in memory, or None to not cache).
+    """
+    if DATA_CACHE == "none":
+        return None
+    if DATA_CACHE == "memory":
+        return ""
+    os.makedirs(DATA_CACHE, exist_ok=True)
+    name = os.path.normpath(root_path).strip(os.sep).replace(os.sep, "_")
+    return os.path.join(DATA_CACHE, f"{name}_{split}")
+
+
+def get_split_datasets(root_path):
+    """
+    Get the train, validation and test tf.data pipelines of a split folder.
+    """
+    train_dataset = get_dataset(
+        f"{root_path}/train", True, cache=dataset_cache_path(root_path, "train")
+    )
+    validation_dataset = get_dataset(
+        f"{root_path}/valid", cache=dataset_cache_path(root_path, "valid")
+    )
+    test_dataset = get_dataset(
+        f"{root_path}/test", cache=dataset_cache_path(root_path, "test")
+    )
+    return train_dataset, validation_dataset, test_dataset
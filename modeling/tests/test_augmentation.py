@@ -3,6 +3,7 @@ import pytest
 from PIL import Image
 
 from service.image_augmentations import (
+    BatchAugmenter,
     clip_image,
     gaussian_filter,
     median_filter,
@@ -62,3 +63,35 @@ def test_random_flip(sample_image):
 def test_random_color_jitter(sample_image):
     jittered_image = random_color_jitter(sample_image)
     assert isinstance(jittered_image, Image.Image)
+
+
+@pytest.fixture
+def sample_batch():
+    return [np.random.randint(0, 256, (64, 48, 3), dtype=np.uint8) for _ in range(3)]
+
+
+def test_batch_augmenter_shape(sample_batch):
+    augmenter = BatchAugmenter(capacity=12, height=64, width=48, seed=0)
+    augmented = augmenter.augment(sample_batch, copies=4)
+    assert augmented.shape == (12, 64, 48, 3)
+    assert augmented.dtype == np.uint8
+
+
+def test_batch_augmenter_seed(sample_batch):
+    first = BatchAugmenter(12, 64, 48, seed=7).augment(sample_batch, 4).copy()
+    second = BatchAugmenter(12, 64, 48, seed=7).augment(sample_batch, 4)
+    assert np.array_equal(first, second)
+
+
+def test_batch_flip(sample_batch):
+    augmenter = BatchAugmenter(3, 64, 48)
+    augmenter.load(sample_batch)
+    flipped = augmenter.flip(augmenter.batch.copy(), chance=1)
+    assert np.array_equal(flipped[0], sample_batch[0][::-1, ::-1])
+
+
+def test_batch_rotation_center(sample_batch):
+    augmenter = BatchAugmenter(3, 64, 48)
+    augmenter.load(sample_batch)
+    rotated = augmenter.rotation(augmenter.batch[:3], augmenter.output[:3], range=0)
+    assert np.array_equal(rotated, np.stack(sample_batch))
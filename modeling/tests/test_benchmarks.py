@@ -0,0 +1,65 @@
+import json
+
+import pytest
+
+from benchmarks.collection_benchmark import benchmark
+from benchmarks.harness import compare_results, latency_percentiles
+from benchmarks.model_benchmark import build_model, training_throughput
+from benchmarks.startup_benchmark import benchmark as startup_benchmark
+
+
+def test_compare_results(tmp_path):
+    baseline = tmp_path / "baseline.json"
+    previous = [
+        {"stage": "augment", "scale": 10, "images_per_second": 100.0},
+        {"stage": "split", "scale": 10, "images_per_second": 100.0},
+    ]
+    baseline.write_text(json.dumps({"results": previous}))
+    results = [
+        {"stage": "augment", "scale": 10, "images_per_second": 95.0},
+        {"stage": "split", "scale": 10, "images_per_second": 80.0},
+        {"stage": "stream", "scale": 10, "images_per_second": 1.0},
+    ]
+
+    regressions = compare_results(
+        results, baseline, ["stage", "scale"], "images_per_second", 0.1
+    )
+
+    assert len(regressions) == 1
+    assert regressions[0].startswith("stage=split, scale=10")
+
+
+def test_collection_benchmark(tmp_path):
+    results = benchmark(
+        [6], [(96, 64)], ["preprocess", "augment", "split"], 2, data_path=tmp_path
+    )
+
+    assert [r["stage"] for r in results] == ["preprocess", "augment", "split"]
+    assert [r["images"] for r in results] == [6, 6, 12]
+    assert all(r["images_per_second"] > 0 and r["peak_rss_mb"] > 0 for r in results)
+    assert all(r["bytes_written"] > 0 for r in results)
+    assert len(list(tmp_path.glob("6_96x64_0/*.jpg"))) == 6
+
+
+def test_latency_percentiles():
+    latencies = latency_percentiles([0.001] * 98 + [0.1, 0.2])
+
+    assert latencies["p50_ms"] == 1.0
+    assert latencies["p50_ms"] <= latencies["p95_ms"] <= latencies["p99_ms"] < 200
+
+
+def test_training_throughput():
+    result = training_throughput(build_model("sequential"), 2, steps=2, warmup=1)
+
+    assert result["steps_per_second"] > 0
+    assert result["images_per_second"] == pytest.approx(
+        2 * result["steps_per_second"], rel=0.01
+    )
+
+
+def test_collection_flow_starts_without_heavy_modules():
+    (result,) = startup_benchmark(["initial_dataset_flow"], repeats=1)
+
+    # Only the code paths that need them load TensorFlow, scikit-learn, Firebase and Roboflow
+    assert result["heavy_modules"] == []
+    assert result["import_seconds"] > 0 and result["peak_rss_mb"] > 0
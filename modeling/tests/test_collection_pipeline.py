@@ -0,0 +1,112 @@
+import os
+
+import numpy as np
+import pytest
+from PIL import Image
+from prefect import flow
+from prefect.task_runners import ConcurrentTaskRunner
+from prefect.testing.utilities import prefect_test_harness
+
+from flows import collection_pipeline
+from options import AUGMENTED_PATH, INITIAL_PATH, PROCESSED_PATH, RAW_PATH
+
+
+@pytest.fixture
+def data_folder(tmp_path, monkeypatch):
+    # The stages use the relative data folders, and shards of 8 images
+    monkeypatch.chdir(tmp_path)
+    for path in [RAW_PATH, PROCESSED_PATH, AUGMENTED_PATH, INITIAL_PATH]:
+        os.makedirs(path)
+    for i in range(20):
+        data = np.random.randint(0, 256, (120, 160, 3), dtype=np.uint8)
+        Image.fromarray(data).save(f"{RAW_PATH}/{i}_0_1_0_0_1_0_0.jpg")
+    list_shards = collection_pipeline.list_shards
+    monkeypatch.setattr(
+        collection_pipeline,
+        "list_shards",
+        lambda folder, stage, shards=3: list_shards(folder, stage, shards, 1),
+    )
+    return tmp_path
+
+
+def split_names(split_dir):
+    names = []
+    for split in ["train", "valid", "test"]:
+        names.extend(os.listdir(os.path.join(split_dir, split, "Bad Welding")))
+    return names
+
+
+def test_staged_shards_are_aggregated(data_folder, capsys):
+    assert collection_pipeline.preprocess_files() == 20
+    assert collection_pipeline.augment_files(2) == 40
+    assert collection_pipeline.split_files() == 40
+
+    assert "in 3 shards" in capsys.readouterr().out
+    names = split_names(INITIAL_PATH)
+    # The shards number their augmented images after the previous shards, as a single run would
+    assert {int(name.split("_")[0].split("-")[1]) for name in names} == set(range(40))
+    for path in [RAW_PATH, PROCESSED_PATH, AUGMENTED_PATH]:
+        assert os.listdir(path) == []
+
+
+def test_failed_shard_is_retried_alone(data_folder, monkeypatch):
+    calls = []
+    preprocess_images = collection_pipeline.preprocess_images
+
+    def flaky_preprocess(index=None, files=None):
+        calls.append(files[0])
+        if files[0] == "16_0_1_0_0_1_0_0.jpg" and calls.count(files[0]) == 1:
+            raise OSError("Worker lost")
+        return preprocess_images(index=index, files=files)
+
+    monkeypatch.setattr(collection_pipeline, "preprocess_images", flaky_preprocess)
+    monkeypatch.setattr(
+        collection_pipeline,
+        "preprocess_shard",
+        collection_pipeline.preprocess_shard.with_options(retry_delay_seconds=0),
+    )
+
+    @flow(task_runner=ConcurrentTaskRunner())
+    def sharded_flow():
+        processed = collection_pipeline.preprocess_files()
+        return processed, collection_pipeline.augment_files(1)
+
+    with prefect_test_harness():
+        processed, augmented = sharded_flow()
+
+    assert processed == augmented == 20
+    assert sorted(calls) == sorted(
+        ["0_0_1_0_0_1_0_0.jpg", *["16_0_1_0_0_1_0_0.jpg"] * 2, "4_0_1_0_0_1_0_0.jpg"]
+    )
+
+
+def test_failed_preprocessing_keeps_raw_images(data_folder):
+    with open(f"{RAW_PATH}/broken_0_1_0_0_1_0_0.jpg", "wb") as f:
+        f.write(b"not an image")
+
+    with pytest.raises(RuntimeError):
+        collection_pipeline.preprocess_files()
+
+    assert len(os.listdir(RAW_PATH)) == 21
+
+
+def test_monitoring_closes_index_on_failure(tmp_path, monkeypatch):
+    # The flow metrics are written to the relative logs folder
+    monkeypatch.chdir(tmp_path)
+    closed = []
+
+    class Index:
+        def close(self):
+            closed.append(True)
+
+    def failing_detection(index):
+        raise OSError("Scoring server down")
+
+    monkeypatch.setattr(collection_pipeline, "download_files", lambda: 1)
+    monkeypatch.setattr(collection_pipeline, "monitor_drift", lambda: None)
+    monkeypatch.setattr(collection_pipeline, "open_index", Index)
+    monkeypatch.setattr(collection_pipeline, "drift_detection", failing_detection)
+
+    with pytest.raises(OSError):
+        collection_pipeline.periodic_monitoring_flow.fn()
+    assert closed == [True]
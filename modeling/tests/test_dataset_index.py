@@ -0,0 +1,119 @@
+import os
+
+import numpy as np
+from PIL import Image
+
+from service.dataset_index import DatasetIndex, list_images, parse_image_name
+from service.image_transformations import (
+    augment_images,
+    preprocess_images,
+    split_images,
+    stream_images,
+)
+from service.metric_monitoring import drift_detection
+
+
+def test_parse_image_name():
+    assert parse_image_name("A0Z_1-0.9_0-0.1_0-0.2_0-0.3_1-0.4_0-0.5_0-0.6.jpg") == (
+        "A0Z",
+        "1_0_0_0_1_0_0",
+        "0.9_0.1_0.2_0.3_0.4_0.5_0.6",
+        ["Background", "Good Welding"],
+    )
+    assert parse_image_name("3-10_0_0_1_0_0_0_0.jpg")[1:] == (
+        "0_0_1_0_0_0_0",
+        None,
+        ["Crack"],
+    )
+
+
+def test_index_queries(tmp_path):
+    index = DatasetIndex(tmp_path / "index.sqlite")
+    index.add("data/raw", ["1_0_1_0_0_1_0_0.jpg", "2_0_0_1_0_0_0_0.jpg"], "raw")
+    index.add(
+        "data/splits/1/train/",
+        ["1-0_0_1_0_0_1_0_0.jpg"],
+        "split",
+        split="train",
+        paths=["data/splits/1/train/Bad Welding/1-0_0_1_0_0_1_0_0.jpg"],
+    )
+
+    assert [r["name"] for r in index.query(class_name="Bad Welding")] == [
+        "1_0_1_0_0_1_0_0.jpg",
+        "1-0_0_1_0_0_1_0_0.jpg",
+    ]
+    train = index.query(split="train", class_name="Good Welding")
+    assert [r["path"] for r in train] == [
+        "data/splits/1/train/Bad Welding/1-0_0_1_0_0_1_0_0.jpg"
+    ]
+    assert len(index.query(stage="raw", class_name="Crack")) == 1
+    assert len(index.query(date=train[0]["date"])) == 3
+
+    index.rename("data/raw", [("2_0_0_1_0_0_0_0.jpg", "2_0_0_1_0_0_0_1.jpg")])
+    assert index.query(class_name="Crack")[0]["name"] == "2_0_0_1_0_0_0_1.jpg"
+    index.remove("data/raw")
+    assert index.query(class_name="Crack") == []
+    # The classes of removed images are removed too
+    assert len(index.query(class_name="Bad Welding")) == 1
+
+
+def test_list_images_syncs_changed_folders(tmp_path, monkeypatch):
+    index = DatasetIndex(tmp_path / "index.sqlite")
+    folder = tmp_path / "raw"
+    folder.mkdir()
+    (folder / "1_0_1_0_0_0_0_0.jpg").write_bytes(b"jpg")
+
+    assert list_images(folder, index) == ["1_0_1_0_0_0_0_0.jpg"]
+    scans = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, "listdir", lambda path: scans.append(path) or listdir(path))
+    assert list_images(folder, index) == ["1_0_1_0_0_0_0_0.jpg"]
+    assert scans == []  # Unchanged folders are listed from the index
+
+    # Files written or deleted without the index are found when the folder changes
+    (folder / "2_0_1_0_0_0_0_0.jpg").write_bytes(b"jpg")
+    (folder / "1_0_1_0_0_0_0_0.jpg").unlink()
+    assert list_images(folder, index) == ["2_0_1_0_0_0_0_0.jpg"]
+    assert len(scans) == 1
+    assert sorted(list_images(folder)) == sorted(list_images(folder, index))
+
+
+def test_stages_maintain_index(tmp_path, monkeypatch):
+    index = DatasetIndex(tmp_path / "index.sqlite")
+    raw, processed, augmented = (tmp_path / name for name in ["r", "p", "a"])
+    for folder in [raw, processed, augmented]:
+        folder.mkdir()
+    for i in range(5):
+        data = np.random.randint(0, 256, (60, 80, 3), dtype=np.uint8)
+        Image.fromarray(data).save(raw / f"{i}_0_1_0_0_1_0_0.jpg")
+
+    assert preprocess_images(raw, processed, cache_size=0, index=index) == 5
+    assert len(index.query(stage="processed", class_name="Good Welding")) == 5
+    assert augment_images(2, processed, augmented, index=index) == (5, 10)
+    assert len(index.query(stage="augmented", folder=augmented)) == 10
+    assert split_images(tmp_path / "s", "hash", augmented, index=index) == 10
+    assert index.query(folder=augmented) == []
+    split = index.query(stage="split", class_name="Bad Welding")
+    assert len(split) == 10
+    assert all(os.path.isfile(row["path"]) for row in split)
+    assert {row["split"] for row in split} <= {"train", "valid", "test"}
+
+    assert stream_images(tmp_path / "t", 2, raw, cache_size=0, index=index) == 10
+    assert len(index.query(stage="split", class_name="Good Welding")) == 20
+
+
+def test_drift_detection_updates_index(tmp_path, monkeypatch):
+    from service import metric_monitoring
+
+    monkeypatch.setattr(metric_monitoring, "RAW_PATH", str(tmp_path))
+    index = DatasetIndex(tmp_path / "index.sqlite")
+    name = "A0Z_1-0.9_0-0.1_0-0.2_0-0.3_0-0.4_0-0.5_0-0.6.jpg"
+    (tmp_path / name).write_bytes(b"jpg")
+    index.add(tmp_path, [name], "raw", source="firebase")
+
+    drift_detection(index)
+
+    row = index.query(folder=tmp_path)[0]
+    assert row["name"] == "A0Z_1_0_0_0_0_0_0.jpg"
+    assert row["confidences"] == "0.9_0.1_0.2_0.3_0.4_0.5_0.6"
+    assert row["source"] == "firebase"
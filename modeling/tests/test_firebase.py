@@ -1,8 +1,173 @@
+import base64
+import contextlib
+import hashlib
+import json
+import os
+import shutil
+
 import pytest
 
-from service.cloud_storage import init_firebase_storage
+from service.cloud_storage import download_firebase, init_firebase_storage
 
 
 def test_init_firebase_storage():
     storage = init_firebase_storage()
     assert storage is not None
+
+
+class FakeBlob:
+    """
+    Blob of a bucket stored as a local file.
+    """
+
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        path = os.path.join(bucket.root, name)
+        with open(path, "rb") as f:
+            self.md5_hash = base64.b64encode(hashlib.md5(f.read()).digest()).decode()
+        self.size = os.path.getsize(path)
+
+    def download_to_filename(self, filename):
+        self.bucket.downloads.append(self.name)
+        shutil.copy(os.path.join(self.bucket.root, self.name), filename)
+
+    def delete(self):
+        os.remove(os.path.join(self.bucket.root, self.name))
+
+
+class FakePages:
+    def __init__(self, blobs, page_size):
+        self.pages = [blobs[i : i + page_size] for i in range(0, len(blobs), page_size)]
+
+
+class FakeClient:
+    def batch(self):
+        return contextlib.nullcontext()
+
+
+class FakeBucket:
+    """
+    Storage bucket backed by a local folder.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.client = FakeClient()
+        self.downloads = []
+
+    def list_blobs(self, page_size=1000):
+        names = sorted(os.listdir(self.root))
+        return FakePages([FakeBlob(self, name) for name in names], page_size)
+
+
+@pytest.fixture
+def bucket(tmp_path):
+    root = tmp_path / "bucket"
+    root.mkdir()
+    for i in range(25):
+        (root / f"{i}_1-0.9_0-0.1_0-0.2_0-0.3_0-0.4_0-0.5_0-0.6.jpg").write_bytes(
+            os.urandom(100)
+        )
+    (root / "notes.txt").write_text("not an image")
+    return FakeBucket(str(root))
+
+
+def test_download_firebase(bucket, tmp_path):
+    raw = tmp_path / "raw"
+    manifest = tmp_path / "manifest.jsonl"
+
+    count = download_firebase(raw, bucket, workers=4, manifest_path=manifest)
+
+    assert count == 25
+    assert len(os.listdir(raw)) == 25
+    assert os.listdir(bucket.root) == ["notes.txt"]
+    assert not manifest.exists()
+
+
+def test_download_firebase_resumes(bucket, tmp_path):
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    manifest = tmp_path / "manifest.jsonl"
+    # A previous run downloaded the first image but stopped before deleting it
+    name = sorted(os.listdir(bucket.root))[0]
+    shutil.copy(os.path.join(bucket.root, name), raw / name)
+    blob = FakeBlob(bucket, name)
+    manifest.write_text(
+        json.dumps({"name": name, "md5": blob.md5_hash, "state": "downloaded"}) + "\n"
+    )
+
+    count = download_firebase(raw, bucket, workers=4, manifest_path=manifest)
+
+    assert count == 25
+    assert name not in bucket.downloads
+    assert len(bucket.downloads) == 24
+    assert os.listdir(bucket.root) == ["notes.txt"]
+
+
+def test_download_firebase_keeps_unverified(bucket, tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    manifest = tmp_path / "manifest.jsonl"
+    name = sorted(os.listdir(bucket.root))[0]
+    original = FakeBlob.download_to_filename
+
+    def corrupted(self, filename):
+        original(self, filename)
+        if self.name == name:
+            with open(filename, "ab") as f:
+                f.write(b"corrupted")
+
+    monkeypatch.setattr(FakeBlob, "download_to_filename", corrupted)
+
+    count = download_firebase(raw, bucket, workers=4, manifest_path=manifest)
+
+    assert count == 24
+    assert sorted(os.listdir(bucket.root)) == sorted([name, "notes.txt"])
+    assert manifest.exists()
+
+
+def test_download_firebase_keeps_failed_downloads(bucket, tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    manifest = tmp_path / "manifest.jsonl"
+    name = sorted(os.listdir(bucket.root))[3]
+    original = FakeBlob.download_to_filename
+
+    def unreachable(self, filename):
+        if self.name == name:
+            with open(filename, "wb") as f:
+                f.write(b"partial")
+            raise ConnectionError("Connection reset")
+        original(self, filename)
+
+    monkeypatch.setattr(FakeBlob, "download_to_filename", unreachable)
+
+    count = download_firebase(raw, bucket, workers=4, manifest_path=manifest)
+
+    assert count == 24
+    assert name not in os.listdir(raw)
+    assert sorted(os.listdir(bucket.root)) == sorted([name, "notes.txt"])
+    # Only the record of the failed image is kept
+    records = [json.loads(line) for line in manifest.read_text().splitlines()]
+    assert [(r["name"], r["state"]) for r in records] == [(name, "failed")]
+
+
+def test_download_firebase_manifest_does_not_grow(bucket, tmp_path, monkeypatch):
+    raw = tmp_path / "raw"
+    manifest = tmp_path / "manifest.jsonl"
+    name = sorted(os.listdir(bucket.root))[0]
+    original = FakeBlob.download_to_filename
+
+    def unreachable(self, filename):
+        if self.name == name:
+            raise ConnectionError("Connection reset")
+        original(self, filename)
+
+    monkeypatch.setattr(FakeBlob, "download_to_filename", unreachable)
+
+    sizes = []
+    for _ in range(3):
+        download_firebase(raw, bucket, workers=4, manifest_path=manifest)
+        sizes.append(len(manifest.read_text().splitlines()))
+
+    assert sizes == [1, 1, 1]
+    assert not os.path.exists(f"{manifest}.tmp")
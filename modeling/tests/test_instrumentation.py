@@ -0,0 +1,79 @@
+import json
+
+import pytest
+
+from service import instrumentation
+from service.instrumentation import Recorder, instrumented, publish, summarize
+
+
+@pytest.fixture
+def recorder(monkeypatch):
+    recorder = Recorder(enabled=True)
+    monkeypatch.setattr(instrumentation, "recorder", recorder)
+    return recorder
+
+
+def test_instrumented_stages_are_published(recorder, tmp_path):
+    @instrumented()
+    def write_images(count):
+        (tmp_path / "images.bin").write_bytes(b"0" * 100000)
+        return count, 2 * count
+
+    @instrumented("failing")
+    def failing():
+        raise OSError("Disk full")
+
+    assert write_images(10) == (10, 20)
+    write_images(30)
+    with pytest.raises(OSError):
+        failing()
+
+    metrics = tmp_path / "metrics"
+    summary = {s["stage"]: s for s in publish("test_flow", metrics)}
+
+    stage = summary["write_images"]
+    assert (stage["runs"], stage["failures"], stage["images"]) == (2, 0, 40)
+    assert stage["images_per_second"] == round(40 / stage["seconds"], 2)
+    if stage["write_bytes"] is not None:  # Without /proc/self/io the bytes are unknown
+        assert stage["write_bytes"] >= 200000
+    assert stage["peak_rss_mb"] > 0
+    assert summary["failing"]["failures"] == 1
+    assert summary["failing"]["images"] is None
+
+    run = json.loads((metrics / "test_flow.jsonl").read_text())
+    assert run["flow"] == "test_flow"
+    assert len(run["records"]) == 3
+    prometheus = (metrics / "test_flow.prom").read_text()
+    assert (
+        'weldspot_stage_images{flow="test_flow",stage="write_images"} 40' in prometheus
+    )
+    assert "# TYPE weldspot_stage_seconds gauge" in prometheus
+    assert publish("test_flow", metrics) == []  # The records were taken
+
+
+def test_disabled_instrumentation_is_a_noop(monkeypatch, tmp_path):
+    monkeypatch.setattr(instrumentation, "recorder", Recorder(enabled=False))
+
+    def stage():
+        return 1
+
+    assert instrumented()(stage) is stage
+    assert instrumentation.published("flow")(stage) is stage
+    assert publish("flow", tmp_path) == []
+
+
+def test_summarize_without_images():
+    records = [
+        {"stage": "a", "failed": False, "seconds": 1, "cpu_seconds": 0.5}
+        | {"images": None, "peak_rss_mb": 10},
+        {"stage": "a", "failed": True, "seconds": 2, "cpu_seconds": 1}
+        | {"images": None, "peak_rss_mb": 20, "read_bytes": 5, "write_bytes": 0},
+    ]
+
+    (summary,) = summarize(records)
+
+    assert summary["runs"] == 2 and summary["failures"] == 1
+    assert (summary["seconds"], summary["cpu_seconds"]) == (3, 1.5)
+    assert summary["images_per_second"] is None
+    assert (summary["read_bytes"], summary["write_bytes"]) == (5, 0)
+    assert summary["peak_rss_mb"] == 20
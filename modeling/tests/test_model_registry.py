@@ -0,0 +1,90 @@
+import json
+
+import numpy as np
+import tensorflow as tf
+
+from service import model_creation, model_registry
+from service.model_registry import ModelCache, ModelRegistry
+
+
+def small_model():
+    model = tf.keras.Sequential(
+        [tf.keras.Input((4,)), tf.keras.layers.Dense(7, activation="sigmoid")]
+    )
+    model.compile(optimizer="adam", loss="binary_crossentropy")
+    return model
+
+
+def test_registry_versions_persist(tmp_path):
+    registry = ModelRegistry(tmp_path / "registry.json", tmp_path / "best")
+    assert registry.latest_version() == 0
+    assert registry.load() is None
+
+    first = registry.register(small_model(), tags=["initial"])
+    second = registry.register(small_model(), metrics={"auc": 0.8}, parent=first)
+    registry.set_champion(first)
+    registry.update(second, {"auc_test": 0.7}, ["weld", "weld"])
+
+    # A new process reads the versions, so they don't restart from 0
+    loaded = ModelRegistry(tmp_path / "registry.json", tmp_path / "best")
+    assert (first, second, loaded.champion) == (1, 2, 1)
+    record = loaded.versions[second]
+    assert record["path"].endswith("weld_2.keras")
+    assert record["hash"] == model_registry.file_hash(record["path"])
+    assert record["metrics"] == {"auc": 0.8, "auc_test": 0.7}
+    assert record["tags"] == ["weld"]
+    assert record["parent"] == 1
+    assert registry.register(small_model()) == 3
+    state = json.loads((tmp_path / "registry.json").read_text())
+    assert sorted(state["versions"]) == ["1", "2", "3"]
+
+
+def test_registry_registers_existing_models(tmp_path):
+    best = tmp_path / "best"
+    best.mkdir()
+    small_model().save(best / "weld_3.keras")
+    small_model().save(best / "weld_12.keras")
+
+    registry = ModelRegistry(tmp_path / "registry.json", best)
+
+    assert sorted(registry.versions) == [3, 12]
+    assert registry.champion == 12
+    assert registry.latest_version() == 12
+
+
+def test_registry_cache(tmp_path, monkeypatch):
+    loads = []
+    load = model_creation.model_load
+    monkeypatch.setattr(
+        model_creation, "model_load", lambda path: loads.append(path) or load(path)
+    )
+    registry = ModelRegistry(
+        tmp_path / "registry.json", tmp_path / "best", ModelCache(1)
+    )
+    trained = small_model()
+    version = registry.register(trained)
+
+    # The registered model is cached, then loaded once from disk after it is released
+    assert registry.load(version) is trained
+    other = ModelRegistry(tmp_path / "registry.json", tmp_path / "best", registry.cache)
+    assert other.load(version) is trained
+    registry.cache.clear()
+    model = registry.load(version)
+    assert registry.load(version) is model
+    assert len(loads) == 1
+    x = np.ones((1, 4), dtype=np.float32)
+    assert np.allclose(model.predict(x, verbose=0), trained.predict(x, verbose=0))
+
+    # A copy is trained without changing the cached version
+    copy = registry.load(version, copy=True)
+    assert copy is not model
+    copy.fit(x, np.zeros((1, 7)), epochs=3, verbose=0)
+    assert registry.load(version) is model
+    assert not np.allclose(copy.predict(x, verbose=0), model.predict(x, verbose=0))
+    assert np.allclose(model.predict(x, verbose=0), trained.predict(x, verbose=0))
+
+    # Retrained in place and registered again, the instance is the new version only
+    new_version = registry.register(model, parent=version)
+    assert registry.load(new_version) is model
+    assert registry.load(version) is not model
+    assert len(loads) == 2
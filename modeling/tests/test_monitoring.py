@@ -2,11 +2,13 @@ import os
 import re
 from unittest.mock import mock_open, patch
 
+import numpy as np
 import pytest
 from sklearn.metrics import roc_auc_score
 
 from options import CLASS_NAMES
-from service.metric_monitoring import analyze_classes
+from service import metric_monitoring
+from service.metric_monitoring import analyze_classes, roc_auc_scores
 
 # Test data
 test_input_files = [
@@ -101,3 +103,125 @@ def test_analyze_classes():
 
     expected_pairs = list(zip(test_input_files, expected_renamed_files))
     assert renames == expected_pairs
+
+
+def test_analyze_classes_skips_other_files():
+    files = ["notes.txt", "A0Z_1_0_0_0_0_0_0.jpg", test_input_files[0]]
+
+    class_metrics, class_aucs, renames = analyze_classes(files)
+
+    assert renames == [(test_input_files[0], expected_renamed_files[0])]
+    assert class_metrics["Background"]["actuals"] == [1]
+    assert all(auc is None for auc in class_aucs.values())
+
+
+def test_analyze_classes_without_feedback():
+    class_metrics, class_aucs, renames = analyze_classes(["notes.txt"])
+
+    assert renames == []
+    assert class_metrics["Background"]["actuals"] == []
+    assert all(auc is None for auc in class_aucs.values())
+    assert analyze_classes(["notes.txt"], np.zeros((1, 7)))[1] == class_aucs
+
+
+def test_analyze_classes_with_server_scores():
+    _, _, _, client = metric_monitoring.parse_feedback(test_input_files)
+    files = ["notes.txt", "D1Z_1_0_0_0_0_0_1.jpg", *test_input_files]
+    scores = np.vstack([np.zeros((2, 7)), client])
+    scores[1] = [0.9, 0, 0, 0, 0, 0, 0.9]
+
+    class_metrics, class_aucs, renames = analyze_classes(files, scores)
+
+    assert renames[0] == ("D1Z_1_0_0_0_0_0_1.jpg", "D1Z_1_0_0_0_0_0_1.jpg")
+    assert renames[1:] == list(zip(test_input_files, expected_renamed_files))
+    assert class_metrics["Background"]["actuals"] == [1, 1, 0, 1, 0, 1, 0]
+    assert class_metrics["Background"]["TP"] == 4
+    assert class_aucs["Splatters"] == roc_auc_score(
+        class_metrics["Splatters"]["actuals"], scores[1:, 6]
+    )
+
+
+def test_roc_auc_scores_match_sklearn():
+    rng = np.random.default_rng(0)
+    actuals = rng.integers(0, 2, (200, 7))
+    confidences = np.round(rng.random((200, 7)), 1)  # With many ties
+    actuals[:, 6] = 1
+
+    aucs = roc_auc_scores(actuals, confidences)
+
+    for i in range(6):
+        assert aucs[i] == roc_auc_score(actuals[:, i], confidences[:, i])
+    assert aucs[6] is None
+
+
+def test_drift_detection_renames(tmp_path, monkeypatch):
+    monkeypatch.setattr(metric_monitoring, "RAW_PATH", str(tmp_path))
+    files = [test_input_files[0], test_input_files[2]]
+    for file in files:
+        (tmp_path / file).write_bytes(b"jpg")
+
+    class_metrics, drift_class = metric_monitoring.drift_detection()
+
+    assert drift_class is None
+    assert class_metrics["Background"]["TP"] == 2
+    assert sorted(os.listdir(tmp_path)) == [
+        expected_renamed_files[0],
+        expected_renamed_files[2],
+    ]
+
+
+def test_server_drift_detection_without_model(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)  # No deployed models
+    monkeypatch.setattr(metric_monitoring, "RAW_PATH", str(tmp_path))
+    for file in ["notes.txt", test_input_files[0], test_input_files[2]]:
+        (tmp_path / file).write_bytes(b"jpg")
+
+    class_metrics, drift_class = metric_monitoring.drift_detection(scoring="server")
+
+    # The client scores are used, as in the client scoring
+    assert drift_class is None
+    assert class_metrics["Background"]["TP"] == 2
+    assert expected_renamed_files[0] in os.listdir(tmp_path)
+
+
+def test_drift_monitor_windows_and_persistence(tmp_path):
+    from service.drift_monitor import DriftMonitor
+
+    path = tmp_path / "monitor.json"
+    monitor = DriftMonitor(path, bins=10, windows=[7, 30])
+    assert monitor.update_files(test_input_files, day="20240110") == 6
+    assert monitor.update_files(list(reversed(test_input_files)), day="20240110") == 0
+    assert monitor.update_files(test_input_files[:2], day="20231225") == 2
+    monitor.save(today="20240110")
+
+    loaded = DriftMonitor(path, bins=10, windows=[7, 30])
+    week = loaded.summary(7, today="20240110")
+    month = loaded.summary(30, today="20240110")
+    for class_name, metrics in expected_class_metrics.items():
+        for name in ["TP", "FP", "TN", "FN"]:
+            assert week[class_name][name] == metrics[name]
+    assert month["Background"]["positives"] + month["Background"]["negatives"] == 8
+    # Background is perfectly ranked, and the bins of 0.1 keep its order
+    assert week["Background"]["auc"] == 1.0
+
+    loaded.save(today="20240201")
+    assert list(DriftMonitor(path, bins=10).days) == ["20240110"]
+
+
+def test_drift_monitor_approximate_auc():
+    from service.drift_monitor import DriftMonitor
+
+    rng = np.random.default_rng(0)
+    actuals = rng.integers(0, 2, (5000, 7))
+    confidences = np.clip(actuals * 0.3 + rng.random((5000, 7)) * 0.7, 0, 1)
+    confidences[:, 0] = rng.random(5000)  # A class with drift
+    monitor = DriftMonitor("unused.json", bins=50)
+
+    monitor.update(actuals, confidences, day="20240110")
+
+    summary = monitor.summary(7, today="20240110")
+    for i, class_name in enumerate(CLASS_NAMES):
+        exact = roc_auc_score(actuals[:, i], confidences[:, i])
+        assert abs(summary[class_name]["auc"] - exact) < 0.01
+    assert monitor.drift(today="20240110") == (7, "Background")
+    assert monitor.drift(today="20240301") == (None, None)
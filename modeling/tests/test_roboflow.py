@@ -4,6 +4,7 @@ import shutil
 import pytest
 
 from service.cloud_storage import download_roboflow
+from service.dataset_index import DatasetIndex
 
 
 def test_download_roboflow():
@@ -16,3 +17,52 @@ def test_download_roboflow():
 
     # Verify that files were downloaded
     assert total > 0, "No files were downloaded"
+
+
+def fake_roboflow(downloads):
+    """
+    Stands in for the Roboflow API, writing a split folder with its images and _classes.csv.
+    """
+
+    def download(location):
+        downloads.append(location)
+        for split, count in [("train", 3), ("valid", 2), ("test", 1)]:
+            os.makedirs(os.path.join(location, split))
+            with open(os.path.join(location, split, "_classes.csv"), "w") as f:
+                f.write(
+                    "filename, Bad Welding, Crack, Excess, Good, Porosity, Splatters\n"
+                )
+                for i in range(count):
+                    f.write(f"{split}{i}.jpg, 0, 1, 0, 0, 0, {i % 2}\n")
+                    with open(
+                        os.path.join(location, split, f"{split}{i}.jpg"), "wb"
+                    ) as image:
+                        image.write(f"{split}{i}".encode())
+
+    return download
+
+
+def test_download_roboflow_cached(tmp_path):
+    downloads = []
+    cache = tmp_path / "cache"
+    raw = tmp_path / "raw"
+    raw.mkdir()
+
+    with DatasetIndex(tmp_path / "index.sqlite") as index:
+        total = download_roboflow(raw, index, fake_roboflow(downloads), cache)
+        assert index.list_folder(raw) == sorted(os.listdir(raw))
+
+    assert total == 6
+    # Numbered in the order of the splits, as when they were copied one by one
+    assert (raw / "1_0_0_1_0_0_0_0.jpg").read_bytes() == b"train0"
+    assert (raw / "4_0_0_1_0_0_0_0.jpg").read_bytes() == b"valid0"
+    assert (raw / "6_0_0_1_0_0_0_0.jpg").read_bytes() == b"test0"
+    version = cache / "welding-2bplp" / "weld-quality-inspection-rei9l" / "9"
+    linked = os.stat(raw / "2_0_0_1_0_0_0_1.jpg")
+    assert linked.st_ino == os.stat(version / "train" / "train1.jpg").st_ino
+
+    shutil.rmtree(raw)  # Emptied by the preprocessing
+    raw.mkdir()
+    assert download_roboflow(raw, None, fake_roboflow(downloads), cache) == 6
+    assert len(downloads) == 1
+    assert len(os.listdir(raw)) == 6
@@ -1,5 +1,8 @@
+import os
+import time
 import warnings
 
+import numpy as np
 import pytest
 import tensorflow as tf
 
@@ -30,3 +33,449 @@ def check_gpu_availability():
 def test_tensorflow_gpu_support():
     physical_devices = check_gpu_availability()
     assert physical_devices is not None, "Failed to check GPU availability"
+
+
+@pytest.fixture
+def split_folder(tmp_path):
+    # Create a small split with 2 classes in each set
+    from PIL import Image
+
+    for split, count in [("train", 48), ("valid", 8), ("test", 8)]:
+        for class_name in ["Crack", "Porosity"]:
+            class_dir = tmp_path / split / class_name
+            class_dir.mkdir(parents=True)
+            for i in range(count):
+                data = np.random.randint(0, 256, (300, 280, 3), dtype=np.uint8)
+                Image.fromarray(data).save(class_dir / f"{i}_0_0_1_0_0_1_0.jpg")
+    return tmp_path
+
+
+def images_per_second(data, epochs=2):
+    start = time.perf_counter()
+    images = 0
+    for _ in range(epochs):
+        if hasattr(data, "__len__") and not isinstance(data, tf.data.Dataset):
+            batches = (data[i] for i in range(len(data)))
+        else:
+            batches = data
+        for x, _ in batches:
+            images += len(x)
+    return images / (time.perf_counter() - start)
+
+
+def test_split_backends_throughput(split_folder):
+    from service.training_configuration import get_dataset, get_split_generators
+
+    generators = get_split_generators(split_folder, backend="generator")
+    datasets = get_split_generators(split_folder, backend="tfdata")
+
+    for generator, dataset in zip(generators, datasets):
+        assert generator.class_indices == dataset.class_indices
+        x, y = next(iter(dataset))
+        assert x.shape[1:] == (256, 256, 3)
+        assert y.shape[1] == 2
+        assert 0 <= float(tf.reduce_min(x)) <= float(tf.reduce_max(x)) <= 1
+
+    for generator, dataset in zip(generators, datasets):
+        # The same images are read with the same labels, in any order
+        generator_labels = [generator[i][1] for i in range(len(generator))]
+        dataset_labels = [y for _, y in dataset]
+        assert sorted(map(tuple, np.concatenate(generator_labels).tolist())) == sorted(
+            map(tuple, np.concatenate(dataset_labels).tolist())
+        )
+
+    cached = get_dataset(str(split_folder / "train"), shuffle=True, cache="")
+    assert [sum(len(x) for x, _ in cached) for _ in range(2)] == [96, 96]
+
+    generator_speed = images_per_second(generators[0])
+    dataset_speed = images_per_second(datasets[0])
+    print(f"ImageDataGenerator: {generator_speed:.1f} images/s")
+    print(f"tf.data: {dataset_speed:.1f} images/s")
+    assert generator_speed > 0 and dataset_speed > 0
+
+
+def test_tfrecord_split_shards(tmp_path):
+    import io
+
+    from PIL import Image
+
+    from service.tfrecord_dataset import (
+        TFRecordSplitWriter,
+        get_tfrecord_splits,
+        is_tfrecord_split,
+        load_index,
+        load_tfrecord_split,
+    )
+    from service.training_configuration import get_split_generators
+
+    with TFRecordSplitWriter(tmp_path, shard_size=20000) as writer:
+        for i in range(12):
+            buffer = io.BytesIO()
+            data = np.random.randint(0, 256, (64, 64, 3), dtype=np.uint8)
+            Image.fromarray(data).save(buffer, format="JPEG")
+            split = "train" if i < 8 else "valid" if i < 10 else "test"
+            labels = ["0", "1-0.9", "0", "0", "1", "0", "0"]
+            writer.write(split, f"{i}", buffer.getvalue(), labels)
+
+    assert is_tfrecord_split(tmp_path)
+    index = load_index(tmp_path / "train")
+    assert index["count"] == 8
+    assert len(index["shards"]) > 1
+    assert sum(shard["count"] for shard in index["shards"]) == 8
+
+    train, valid, test = get_split_generators(tmp_path)
+    images = 0
+    for x, y in train:
+        assert x.shape[1:] == (256, 256, 3)
+        assert np.array_equal(y[0], [0, 1, 0, 0, 1, 0, 0])
+        images += len(x)
+    assert images == 8
+    assert sum(len(x) for x, _ in test) == 2
+
+    first = load_tfrecord_split(tmp_path / "train", max_shards=1)
+    assert sum(len(x) for x, _ in first) == index["shards"][0]["count"]
+    assert len(get_tfrecord_splits(tmp_path)) == 3
+
+
+def test_tensor_store(split_folder):
+    from service.tensor_store import TensorStoreSequence, is_tensor_store
+    from service.training_configuration import get_split_generators
+
+    assert not is_tensor_store(split_folder)
+    train, valid, test = get_split_generators(split_folder, backend="tensorstore")
+    assert is_tensor_store(split_folder)
+
+    # Images in several class folders are stored once
+    assert train.images.shape == (48, 256, 256, 3)
+    assert train.images.dtype == np.uint8
+    assert isinstance(train.images, np.memmap)
+    assert len(train) == 3 and len(test) == 1
+    x, y = train[0]
+    assert x.shape == (16, 256, 256, 3) and x.dtype == np.float32
+    assert 0 <= x.min() <= x.max() <= 1
+    assert np.array_equal(y[0], [0, 0, 1, 0, 0, 1, 0])
+    assert np.shares_memory(y, train.labels)
+
+    # Loading again reuses the exported arrays
+    stored = os.stat(split_folder / "tensors" / "train" / "images.npy").st_mtime_ns
+    again = get_split_generators(split_folder, backend="tensorstore")[0]
+    assert (
+        os.stat(split_folder / "tensors" / "train" / "images.npy").st_mtime_ns == stored
+    )
+    assert np.array_equal(np.asarray(again.images), np.asarray(train.images))
+    assert sum(len(x) for x, _ in (train[i] for i in range(len(train)))) == 48
+
+    # New images in the split (e.g., the same daily split collected again) are exported again
+    from PIL import Image
+
+    data = np.random.randint(0, 256, (300, 280, 3), dtype=np.uint8)
+    Image.fromarray(data).save(
+        split_folder / "train" / "Crack" / "new_0_0_1_0_0_0_0.jpg"
+    )
+    assert not is_tensor_store(split_folder)
+    train = get_split_generators(split_folder, backend="tensorstore")[0]
+    assert train.images.shape[0] == 49
+
+    empty = split_folder / "tensors" / "empty"
+    from service.tensor_store import export_split
+
+    (split_folder / "none").mkdir()
+    assert export_split(split_folder / "none", str(empty)) == 0
+    assert len(TensorStoreSequence(empty)) == 0
+
+
+def test_single_pass_evaluation(tmp_path, monkeypatch):
+    from sklearn.metrics import roc_auc_score
+
+    from service.model_optimization import evaluate_batches, measure_performance
+
+    rng = np.random.default_rng(0)
+    x = rng.random((20, 8, 8, 3), dtype=np.float32)
+    y = (rng.random((20, 7)) < 0.4).astype(np.float32)
+    y[:, 6] = 0  # A class without positives has no AUC
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input((8, 8, 3)),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(
+                7,
+                activation="sigmoid",
+                kernel_regularizer=tf.keras.regularizers.l2(0.01),
+            ),
+        ]
+    )
+    model.compile(optimizer="adam", loss="binary_crossentropy", metrics=["accuracy"])
+    dataset = tf.data.Dataset.from_tensor_slices((x, y)).batch(6)
+    loss, accuracy = model.evaluate(dataset, verbose=0)
+    predictions = model.predict(x, verbose=0)
+
+    results = evaluate_batches(model, dataset)
+
+    assert results["images"] == 20
+    assert results["loss"] == pytest.approx(loss, rel=1e-4)
+    assert results["accuracy"] == pytest.approx(accuracy, rel=1e-4)
+    for i in range(6):
+        assert results["auc"][i] == pytest.approx(
+            roc_auc_score(y[:, i], predictions[:, i])
+        )
+    assert results["auc"][6] is None
+    assert results["confusion"].sum() == 20
+    # Batches read by index (as the Keras generators) give the same results
+    batches = [(x[i : i + 6], y[i : i + 6]) for i in range(0, 20, 6)]
+    assert evaluate_batches(model, batches)["auc"] == pytest.approx(results["auc"])
+
+    monkeypatch.chdir(tmp_path)
+    assert measure_performance(model, dataset) == pytest.approx(
+        np.mean(results["auc"][:6])
+    )
+    assert os.listdir(tmp_path / "logs" / "predict")
+    assert not list((tmp_path / "logs" / "predict").glob("*.png"))
+
+
+def test_quantization_variants(tmp_path):
+    from service.model_optimization import choose_variant, quantize_model
+
+    rng = np.random.default_rng(0)
+    x = rng.random((24, 16, 16, 3), dtype=np.float32)
+    y = (rng.random((24, 7)) < 0.5).astype(np.float32)
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input((16, 16, 3)),
+            tf.keras.layers.Conv2D(8, 3, activation="relu"),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(7, activation="sigmoid"),
+        ]
+    )
+    model.compile(optimizer="adam", loss="binary_crossentropy")
+    dataset = tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+
+    reports = quantize_model(model, str(tmp_path / "weld"), dataset, dataset, runs=3)
+
+    assert [r["mode"] for r in reports] == ["float32", "dynamic", "float16", "int8"]
+    for report in reports:
+        assert os.path.getsize(report["path"]) == report["size_bytes"]
+        assert report["latency"]["p50_ms"] > 0
+        assert len(report["auc_delta"]) == 7
+    float32 = reports[0]
+    assert float32["max_auc_drop"] == pytest.approx(0, abs=1e-3)
+    assert reports[2]["size_bytes"] < float32["size_bytes"]
+
+    for report, p50, drop in zip(reports, [4, 2, 3, 1], [0, 0.005, 0, 0.05]):
+        report["latency"]["p50_ms"] = p50
+        report["max_auc_drop"] = drop
+    assert choose_variant(reports, 0.01)["mode"] == "dynamic"
+    assert choose_variant(reports, 0.1)["mode"] == "int8"
+    reports[1]["max_auc_drop"] = None  # Not evaluated
+    assert choose_variant(reports, 0.01)["mode"] == "float16"
+
+
+def test_bulk_scoring(tmp_path, monkeypatch):
+    from PIL import Image
+
+    from service import metric_monitoring
+    from service.bulk_scoring import (
+        BulkScorer,
+        latest_model,
+        load_image,
+        score_files,
+        score_to_csv,
+    )
+    from service.model_creation import model_convert
+
+    monkeypatch.chdir(tmp_path)
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    for i in range(10):
+        data = np.random.randint(0, 256, (120, 160, 3), dtype=np.uint8)
+        Image.fromarray(data).save(raw / f"{i}_1_0_0_0_0_0_{i % 2}.jpg")
+    (raw / "notes.txt").write_text("not an image")
+    model = tf.keras.Sequential(
+        [
+            tf.keras.Input((256, 256, 3)),
+            tf.keras.layers.AveragePooling2D(16),
+            tf.keras.layers.Flatten(),
+            tf.keras.layers.Dense(7, activation="sigmoid"),
+        ]
+    )
+    os.makedirs("models/deploy")
+    model_convert(model, "models/deploy/weld_2.tflite")
+    model_convert(model, "models/deploy/weld_10.tflite")
+    model_convert(model, "models/deploy/weld_10_int8.tflite", "dynamic")
+    assert latest_model() == os.path.join("models/deploy", "weld_10.tflite")
+
+    paths = sorted(str(path) for path in raw.glob("*.jpg"))
+    expected = model.predict(np.stack([load_image(path) for path in paths]), verbose=0)
+    batches = list(BulkScorer(latest_model(), workers=3, batch_size=4).score(paths))
+    assert [len(batch) for batch, _ in batches] == [4, 4, 2]
+    assert np.allclose(np.concatenate([s for _, s in batches]), expected, atol=1e-5)
+    assert np.allclose(score_files(paths), expected, atol=1e-5)
+
+    (tmp_path / "manifest.txt").write_text(
+        "\n".join(os.path.relpath(path, tmp_path) for path in paths[:3])
+    )
+    assert score_to_csv("manifest.txt", "scores.csv", workers=2) == 3
+    rows = (tmp_path / "scores.csv").read_text().splitlines()
+    assert rows[0].startswith("path,Background,")
+    assert len(rows) == 4 and len(rows[1].split(",")) == 8
+
+    monkeypatch.setattr(metric_monitoring, "RAW_PATH", str(raw))
+    listed = [str(raw / name) for name in os.listdir(raw) if name.endswith(".jpg")]
+    class_metrics, _ = metric_monitoring.drift_detection(scoring="server")
+    assert np.allclose(
+        class_metrics["Splatters"]["predictions"],
+        expected[[paths.index(path) for path in listed], 6],
+        atol=1e-5,
+    )
+    assert class_metrics["Background"]["actuals"] == [1] * 10
+
+    # A truncated image gets NaN scores, and the others are still scored
+    broken = raw / "99_1_0_0_0_0_0_1.jpg"
+    broken.write_bytes((raw / "0_1_0_0_0_0_0_0.jpg").read_bytes()[:200])
+    scores = score_files([str(broken), paths[0]])
+    assert np.isnan(scores[0]).all()
+    assert np.allclose(scores[1], expected[0], atol=1e-5)
+    class_metrics, _ = metric_monitoring.drift_detection(scoring="server")
+    assert class_metrics["Background"]["actuals"] == [1] * 10
+
+
+def test_cpu_training_mode(tmp_path, monkeypatch):
+    from service import model_optimization
+    from service.model_creation import model_convert, sequential_model
+    from service.training_configuration import configure_cpu_training
+
+    settings = configure_cpu_training(0, 0, "bfloat16")
+    try:
+        assert settings["precision"] == "mixed_bfloat16"
+        model = sequential_model()
+        assert model.layers[0].compute_dtype == "bfloat16"
+        assert model.layers[-1].compute_dtype == "float32"
+        x = np.random.random((4, 256, 256, 3)).astype(np.float32)
+        y = (np.random.random((4, 7)) < 0.5).astype(np.float32)
+        model.fit(x, y, epochs=1, verbose=0)
+        # The bfloat16 model is converted as a float32 copy with the same weights
+        model_convert(model, str(tmp_path / "weld.tflite"))
+        interpreter = tf.lite.Interpreter(str(tmp_path / "weld.tflite"))
+        interpreter.allocate_tensors()
+        interpreter.set_tensor(interpreter.get_input_details()[0]["index"], x[:1])
+        interpreter.invoke()
+        output = interpreter.get_tensor(interpreter.get_output_details()[0]["index"])
+        assert np.allclose(output, model.predict(x[:1], verbose=0), atol=0.05)
+    finally:
+        tf.keras.mixed_precision.set_global_policy("float32")
+    assert configure_cpu_training(precision="float32")["precision"] == "float32"
+
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(model_optimization, "XLA_JIT", True)
+    model = tf.keras.Sequential(
+        [tf.keras.Input((4,)), tf.keras.layers.Dense(7, activation="sigmoid")]
+    )
+    model.compile(optimizer="adam", loss="binary_crossentropy")
+    x = np.random.random((32, 4)).astype(np.float32)
+    y = (np.random.random((32, 7)) < 0.5).astype(np.float32)
+    data = tf.data.Dataset.from_tensor_slices((x, y)).batch(8)
+
+    history = model_optimization.model_training(model, data, data, 2, mode="cpu")
+
+    assert model.jit_compile
+    assert len(history.history["steps_per_second"]) == 2
+    assert all(steps > 0 for steps in history.history["steps_per_second"])
+
+
+def test_head_retraining_on_cached_embeddings(split_folder, tmp_path, capsys):
+    from service.embedding_cache import EmbeddingCache, split_model, train_head
+
+    inputs = tf.keras.Input((256, 256, 3))
+    x = tf.keras.layers.AveragePooling2D(8)(inputs)
+    x = tf.keras.layers.Conv2D(16, 3, activation="relu")(x)
+    x = tf.keras.layers.GlobalAveragePooling2D()(x)
+    x = tf.keras.layers.Dense(8, activation="relu")(x)
+    x = tf.keras.layers.Dropout(0.5)(x)
+    outputs = tf.keras.layers.Dense(7, activation="sigmoid")(x)
+    model = tf.keras.Model(inputs, outputs)
+    model.compile(optimizer="adam", loss="binary_crossentropy")
+
+    backbone, head = split_model(model)
+    images = np.random.random((2, 256, 256, 3)).astype(np.float32)
+    assert backbone.output.shape[-1] == 16
+    assert np.allclose(head(backbone(images)), model(images), atol=1e-6)
+
+    backbone_weights = backbone.get_weights()
+    head_weights = head.get_weights()
+    cache_path = tmp_path / "embeddings"
+    history = train_head(model, split_folder, 2, cache_path, verbose=0)
+
+    assert len(history.history["loss"]) == 2
+    # Only the head changed, and the model uses it
+    assert all(
+        np.array_equal(a, b) for a, b in zip(backbone_weights, backbone.get_weights())
+    )
+    assert not np.array_equal(head_weights[0], model.layers[-3].get_weights()[0])
+    assert np.allclose(head(backbone(images)), model(images), atol=1e-6)
+    [folder] = list(cache_path.iterdir())
+    assert len(EmbeddingCache(folder.name, cache_path).rows) == 56  # train + valid
+    assert "Computed the embeddings of 48 images." in capsys.readouterr().out
+
+    # The backbone didn't change, so the second retraining reuses every embedding
+    train_head(model, split_folder, 1, cache_path, verbose=0)
+    assert "Computed the embeddings" not in capsys.readouterr().out
+    assert len(list(cache_path.iterdir())) == 1
+
+
+def test_replay_dataset(tmp_path):
+    from datetime import datetime
+
+    from PIL import Image
+
+    from service.dataset_index import DatasetIndex
+    from service.replay_dataset import get_replay_splits, replay_rows, sample_rows
+
+    initial = tmp_path / "initial"
+    splits = tmp_path / "splits"
+    index = DatasetIndex(tmp_path / "index.sqlite")
+    for folder, date, count in [
+        (initial, "20240101", 40),
+        (splits / "20240110", "20240110", 20),
+        (splits / "20240301", "20240301", 10),
+    ]:
+        for split in ["train", "valid", "test"]:
+            class_dir = folder / split / "Crack"
+            class_dir.mkdir(parents=True)
+            names = [f"{date}{i}-{i}_0_0_1_0_0_1_0.jpg" for i in range(count)]
+            for name in names:
+                data = np.random.randint(0, 256, (40, 30, 3), dtype=np.uint8)
+                Image.fromarray(data).save(class_dir / name)
+            if date == "20240110":  # Written without the index
+                continue
+            index.add(
+                folder / split,
+                names,
+                "split",
+                split=split,
+                paths=[str(class_dir / name) for name in names],
+            )
+    files = sum(len(f) for _, _, f in os.walk(tmp_path))
+
+    train, valid, test = get_replay_splits(
+        index, initial, splits, 0.3, 14, 20, seed=0, today=datetime(2024, 3, 5)
+    )
+
+    # All the 10 recent images, and 4 history images to keep 30% of history
+    for dataset in [train, valid, test]:
+        assert len(dataset.paths) == 14
+        recent = [p for p in dataset.paths if "20240301" in os.path.dirname(p)]
+        assert len(recent) == 10
+    assert np.array_equal(train.labels[0], [0, 0, 1, 0, 0, 1, 0])
+    images = 0
+    for x, y in train:
+        assert x.shape[1:] == (256, 256, 3) and y.shape[1:] == (7,)
+        images += len(x)
+    assert images == 14
+    # The recency is by the date of the split folders, not the date they were indexed
+    recent, history = replay_rows(
+        index, "train", initial, splits, 14, datetime(2024, 3, 5)
+    )
+    assert (len(recent), len(history)) == (10, 60)
+    assert sum(len(f) for _, _, f in os.walk(tmp_path)) == files  # Nothing copied
+    history = [{"path": str(i)} for i in range(100)]
+    assert len(sample_rows([], history, 0.3, 20)) == 6
+    index.close()
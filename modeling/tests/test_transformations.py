@@ -0,0 +1,272 @@
+import os
+import threading
+import time
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from service.image_transformations import (
+    augment_images,
+    hash_split,
+    preprocess_image,
+    preprocess_images,
+    preprocessed_stream,
+    queued,
+    split_images,
+    stream_images,
+)
+from service.preprocess_cache import PreprocessCache
+
+
+@pytest.fixture
+def raw_folder(tmp_path):
+    # Create a folder with raw images named as <id>_<class1>_..._<class7>.jpg
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    for i in range(20):
+        data = np.random.randint(0, 256, (120, 160, 3), dtype=np.uint8)
+        Image.fromarray(data).save(raw / f"{i}_0_1_0_0_1_0_0.jpg")
+    return raw
+
+
+def test_preprocess_images_parallel_matches_sequential(raw_folder, tmp_path):
+    sequential = tmp_path / "sequential"
+    parallel = tmp_path / "parallel"
+    sequential.mkdir()
+    parallel.mkdir()
+
+    count_sequential = preprocess_images(
+        raw_folder, sequential, workers=1, cache_size=0
+    )
+    count_parallel = preprocess_images(
+        raw_folder, parallel, workers=3, chunk_size=4, cache_size=0
+    )
+
+    assert count_sequential == count_parallel == 20
+    assert sorted(os.listdir(sequential)) == sorted(os.listdir(parallel))
+    for name in os.listdir(sequential):
+        with Image.open(sequential / name) as a, Image.open(parallel / name) as b:
+            assert np.array_equal(np.array(a), np.array(b))
+
+
+def test_preprocess_images_reports_failures(raw_folder, tmp_path, capsys):
+    (raw_folder / "broken_0_0_0_0_0_0_0.jpg").write_bytes(b"not an image")
+    processed = tmp_path / "processed"
+    processed.mkdir()
+
+    with pytest.raises(RuntimeError, match="1 of 21 images"):
+        preprocess_images(raw_folder, processed, workers=2, chunk_size=4, cache_size=0)
+
+    # The other images are processed before raising
+    assert len(os.listdir(processed)) == 20
+    assert "Failed to preprocess broken_0_0_0_0_0_0_0.jpg" in capsys.readouterr().out
+
+
+@pytest.mark.parametrize("engine", ["batch", "pil"])
+def test_augment_images_names(raw_folder, tmp_path, engine):
+    processed = tmp_path / "processed"
+    augmented = tmp_path / "augmented"
+    processed.mkdir()
+    augmented.mkdir()
+    preprocess_images(raw_folder, processed, cache_size=0)
+
+    count, total = augment_images(3, processed, augmented, engine=engine)
+
+    assert (count, total) == (20, 60)
+    names = os.listdir(augmented)
+    assert len(names) == 60
+    assert all(name.endswith("_0_1_0_0_1_0_0.jpg") for name in names)
+    assert {int(name.split("_")[0].split("-")[1]) for name in names} == set(range(60))
+
+
+def test_stream_images(raw_folder, tmp_path):
+    split_dir = tmp_path / "splits"
+
+    total = stream_images(split_dir, 2, raw_folder, cache_size=0)
+
+    assert total == 40
+    files = {}
+    for split in ["train", "valid", "test"]:
+        for class_name in os.listdir(split_dir / split):
+            for name in os.listdir(split_dir / split / class_name):
+                files.setdefault(class_name, []).append(name)
+    assert sorted(files) == ["Bad Welding", "Good Welding"]
+    assert sorted(files["Bad Welding"]) == sorted(files["Good Welding"])
+    assert len(set(files["Bad Welding"])) == 40
+
+
+def test_preprocess_images_cache(raw_folder, tmp_path, capsys):
+    cache = tmp_path / "cache"
+    first = tmp_path / "first"
+    second = tmp_path / "second"
+    first.mkdir()
+    second.mkdir()
+
+    preprocess_images(raw_folder, first, cache_path=cache)
+    assert "0 hits, 20 misses" in capsys.readouterr().out
+    preprocess_images(raw_folder, second, workers=2, chunk_size=4, cache_path=cache)
+    assert "20 hits, 0 misses" in capsys.readouterr().out
+
+    for name in os.listdir(first):
+        assert (first / name).read_bytes() == (second / name).read_bytes()
+
+
+def test_stream_images_creates_classes_in_every_split(tmp_path, monkeypatch):
+    from service import image_transformations
+
+    raw = tmp_path / "raw"
+    raw.mkdir()
+    for i in range(6):
+        data = np.random.randint(0, 256, (60, 80, 3), dtype=np.uint8)
+        # Only the first image is a Crack, in the train split
+        labels = "0_1_1_0_0_0_0" if i == 0 else "0_0_0_0_1_0_0"
+        Image.fromarray(data).save(raw / f"{i}_{labels}.jpg")
+    monkeypatch.setattr(
+        image_transformations,
+        "image_split",
+        lambda name: "train" if name.startswith("0-") else "valid",
+    )
+    split_dir = tmp_path / "splits"
+
+    assert stream_images(split_dir, 1, raw, cache_size=0) == 6
+
+    for split in ["train", "valid", "test"]:
+        assert sorted(os.listdir(split_dir / split)) == [
+            "Bad Welding",
+            "Crack",
+            "Good Welding",
+        ]
+    (crack,) = (split_dir / "train" / "Crack").glob("0-*.jpg")
+    bad = split_dir / "train" / "Bad Welding" / crack.name
+    assert os.path.samefile(crack, bad)  # Linked, not written twice
+
+
+def test_queued_stops_with_the_consumer():
+    produced = []
+
+    def numbers():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    stream = queued(numbers(), maxsize=2)
+    assert next(stream) == 0
+    stream.close()  # As when the consumer raises
+
+    for _ in range(50):
+        if not any(t.name == "queued" for t in threading.enumerate()):
+            break
+        time.sleep(0.1)
+    assert not any(t.name == "queued" for t in threading.enumerate())
+    assert len(produced) < 10
+
+
+def test_stream_images_keeps_failures(raw_folder, tmp_path):
+    (raw_folder / "broken_0_1_0_0_1_0_0.jpg").write_bytes(b"not an image")
+
+    with pytest.raises(RuntimeError, match="1 of 21 images"):
+        stream_images(tmp_path / "splits", 1, raw_folder, cache_size=0)
+
+
+def test_preprocessed_stream_cache(raw_folder, tmp_path):
+    paths = sorted(os.listdir(raw_folder))
+    cache = PreprocessCache(tmp_path / "cache")
+    expected = [
+        np.asarray(preprocess_image(Image.open(raw_folder / path)).convert("RGB"))
+        for path in paths
+    ]
+
+    missed = list(preprocessed_stream(paths, raw_folder, cache))
+    found = list(preprocessed_stream(paths, raw_folder, cache))
+
+    # The images processed on a miss are not encoded and decoded before augmenting them
+    assert all(np.array_equal(a, e) for (_, _, a), e in zip(missed, expected))
+    assert cache.hits == 20 and len(found) == 20
+    assert found[0][:2] == missed[0][:2]
+
+
+def test_preprocess_cache_invalidation_and_eviction(tmp_path):
+    cache = PreprocessCache(tmp_path, max_size=10, parameters={"target_size": [1, 1]})
+    assert cache.validate()
+    cache.put(cache.key(b"a"), b"123456")
+    cache.put(cache.key(b"b"), b"123456")
+    os.utime(cache.entry_path(cache.key(b"a")), (1, 1))
+    os.utime(cache.entry_path(cache.key(b"b")), (2, 2))
+    assert not cache.validate()
+    assert cache.get(cache.key(b"a")) == b"123456"
+
+    assert cache.evict() == 1
+    assert cache.get(cache.key(b"b")) is None
+    assert cache.get(cache.key(b"a")) == b"123456"
+
+    changed = PreprocessCache(tmp_path, max_size=10, parameters={"target_size": [2, 2]})
+    assert changed.validate()
+    assert changed.get(changed.key(b"a")) is None
+
+
+def test_preprocess_cache_concurrent_invalidation(tmp_path):
+    # Shards validating a stale cache while others write to it must not fail
+    path = tmp_path / "cache"
+    PreprocessCache(path, parameters={"target_size": [1, 1]}).validate()
+    errors = []
+
+    def shard(i):
+        cache = PreprocessCache(path, parameters={"target_size": [2, 2]})
+        try:
+            cache.validate()
+            for j in range(50):
+                cache.put(cache.key(f"{i}-{j}".encode()), b"123456")
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=shard, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    assert not PreprocessCache(path, parameters={"target_size": [2, 2]}).validate()
+
+
+def test_split_images_hash(tmp_path):
+    augmented = tmp_path / "augmented"
+    augmented.mkdir()
+    for i in range(10):
+        for copy in range(3):
+            (augmented / f"{i}-{i * 3 + copy}_0_1_0_0_1_0_0.jpg").write_bytes(b"jpg")
+    (augmented / "99-30_0_0_0_0_0_0_0.jpg").write_bytes(b"jpg")
+    split_dir = tmp_path / "splits"
+
+    total = split_images(split_dir, "hash", augmented)
+
+    assert total == 31
+    assert os.listdir(augmented) == ["99-30_0_0_0_0_0_0_0.jpg"]
+    splits = {}
+    for split in ["train", "valid", "test"]:
+        assert sorted(os.listdir(split_dir / split)) == ["Bad Welding", "Good Welding"]
+        for name in os.listdir(split_dir / split / "Bad Welding"):
+            splits.setdefault(name.split("-")[0], set()).add(split)
+            bad = os.stat(split_dir / split / "Bad Welding" / name)
+            good = os.stat(split_dir / split / "Good Welding" / name)
+            assert bad.st_ino == good.st_ino
+    assert len(splits) == 10
+    assert all(len(s) == 1 for s in splits.values())
+    assert all(hash_split(f"{i}") in splits[str(i)] for i in range(10))
+
+
+def test_split_images_tfrecord(tmp_path):
+    from service.tfrecord_dataset import load_index
+
+    augmented = tmp_path / "augmented"
+    augmented.mkdir()
+    for i in range(6):
+        data = np.random.randint(0, 256, (32, 32, 3), dtype=np.uint8)
+        Image.fromarray(data).save(augmented / f"{i}-{i}_0_1_0_0_1_0_0.jpg")
+    split_dir = tmp_path / "splits"
+
+    total = split_images(split_dir, "hash", augmented, split_format="tfrecord")
+
+    assert total == 6
+    indexes = [load_index(split_dir / split) for split in ["train", "valid", "test"]]
+    assert sum(index["count"] for index in indexes) == 6